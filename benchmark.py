@@ -0,0 +1,208 @@
+"""
+Throughput benchmarks for the RX path, run against the simulated device backend.
+
+    python benchmark.py --frames 300 --rx_sample_rate 10e6 --device_args realtime=0
+
+Takes the same options as server.py (conf/server/default.ini is read as well) plus
+the benchmark options below. With realtime=1 in --device_args the simulated radio
+produces samples at rx_sample_rate and drops them when the host falls behind, so
+dropped frames show whether a rate is sustainable. With realtime=0 the radio is
+never the bottleneck and the reported Msps is the ceiling of the host path.
+
+    python benchmark.py --bench latency --latency_frame_samps 500,2000,64000
+
+compares capture to client latency across frame sizes (--rx_frame_samps).
+"""
+import argparse
+import sys
+import threading
+import time
+
+import numpy as np
+from loguru import logger
+
+import server
+
+
+class BenchResult():
+    def __init__(self, name, samples, elapsed, latencies, dropped_samples, frame_size):
+        self.name = name
+        self.samples = samples
+        self.elapsed = elapsed
+        self.latencies = np.asarray(latencies)
+        self.dropped_frames = int(np.ceil(dropped_samples / frame_size))
+
+    @property
+    def msps(self):
+        return self.samples / self.elapsed / 1e6 if self.elapsed else 0.0
+
+    def report(self):
+        p50, p90, p99 = np.percentile(self.latencies, [50, 90, 99]) * 1e3 if len(self.latencies) else (0, 0, 0)
+        worst = self.latencies.max() * 1e3 if len(self.latencies) else 0
+        return (f"{self.name:<10} {self.msps:8.2f} Msps | latency p50 {p50:7.3f} ms  p90 {p90:7.3f} ms  "
+                f"p99 {p99:7.3f} ms  max {worst:7.3f} ms | dropped frames {self.dropped_frames}")
+
+
+class ReconnectResult():
+    def __init__(self, latencies, shutdown_time):
+        self.latencies = np.asarray(latencies)
+        self.shutdown_time = shutdown_time
+
+    def report(self):
+        p50, p90, p99 = np.percentile(self.latencies, [50, 90, 99]) * 1e3
+        return (f"{'reconnect':<10} {len(self.latencies):5d} cycles | connect to first frame p50 {p50:7.3f} ms  "
+                f"p90 {p90:7.3f} ms  p99 {p99:7.3f} ms | shutdown {self.shutdown_time * 1e3:7.3f} ms")
+
+
+def dropped_samples(transceiver):
+    """Samples the (simulated) device discarded because the host did not drain it in time."""
+    return getattr(transceiver.rx_streamer, 'dropped_samples', 0)
+
+
+def bench_read(transceiver, frames):
+    """Call Transceiver.read back to back. Latency is the time each read call takes."""
+    types = transceiver.uhd.types
+    stream_cmd = types.StreamCMD(types.StreamMode.start_cont)
+    stream_cmd.stream_now = True
+    transceiver.rx_streamer.issue_stream_cmd(stream_cmd)
+
+    dropped_before = dropped_samples(transceiver)
+    latencies = []
+    samples = 0
+    start = time.perf_counter()
+    for _ in range(frames):
+        toc = time.perf_counter()
+        data = transceiver.read()
+        latencies.append(time.perf_counter() - toc)
+        if data is not None:
+            samples += data.shape[-1]
+    elapsed = time.perf_counter() - start
+
+    transceiver.rx_streamer.issue_stream_cmd(types.StreamCMD(types.StreamMode.stop_cont))
+    return BenchResult('read', samples, elapsed, latencies,
+                       dropped_samples(transceiver) - dropped_before, transceiver.num_samps)
+
+
+def bench_loopback(transceiver, frames, port, clients=1):
+    """
+    Stream through RX_Node.run to client.Sampler instances over loopback. Latency is the
+    time from the frame's capture (stamped in the frame header) to a client finishing its
+    recv. Msps is summed over all clients.
+    """
+    from client import Sampler
+
+    latencies = []
+    received = []
+    skipped = []
+
+    def consume():
+        while True:
+            try:
+                sampler = Sampler(('localhost', port))
+                break
+            except ConnectionRefusedError:
+                time.sleep(0.01)
+        with sampler:
+            for _ in range(frames):
+                data = sampler.next()
+                if len(data) == 0:
+                    logger.error("Server closed the stream early")
+                    break
+                latencies.append(time.time() - sampler.header.capture_time)
+                received.append(len(data))
+            skipped.append(sampler.skipped)
+
+    rx_node = server.RX_Node(transceiver)
+    dropped_before = dropped_samples(transceiver)
+    start = time.perf_counter()
+    rx_node.start()
+    consumers = [threading.Thread(target=consume) for _ in range(clients)]
+    for consumer in consumers:
+        consumer.start()
+    for consumer in consumers:
+        consumer.join()
+    elapsed = time.perf_counter() - start
+    rx_node.stop()
+    rx_node.join()
+
+    # Frames a client queue dropped show up as sequence gaps at that client
+    dropped = (dropped_samples(transceiver) - dropped_before) * clients + sum(skipped) * transceiver.num_samps
+    return BenchResult(f'loopback{clients}' if clients > 1 else 'loopback', sum(received), elapsed, latencies, dropped, transceiver.num_samps)
+
+
+def bench_reconnect(transceiver, cycles, port):
+    """Connect, take one frame and disconnect, over and over, then time the node's shutdown."""
+    from client import Sampler
+
+    rx_node = server.RX_Node(transceiver)
+    rx_node.start()
+    latencies = []
+    for _ in range(cycles):
+        toc = time.perf_counter()
+        with Sampler(('localhost', port)) as sampler:
+            sampler.next()
+        latencies.append(time.perf_counter() - toc)
+    rx_node.stop()
+    rx_node.join()
+    return ReconnectResult(latencies, rx_node.shutdown_time)
+
+
+def bench_latency(args, frame_sizes):
+    """
+    Capture to client latency through RX_Node for each frame size, with a fresh
+    Transceiver per setting. Run with realtime=1 so frames fill at the real rate.
+    """
+    from client import LatencyProbe
+
+    reports = []
+    for frame_size in frame_sizes:
+        settings = argparse.Namespace(**vars(args))
+        settings.rx_frame_samps = frame_size
+        transceiver = server.Transceiver(settings)
+        rx_node = server.RX_Node(transceiver)
+        rx_node.start()
+        with LatencyProbe(('localhost', args.rx_port)) as probe:
+            # Skip the first frames, they include connection setup
+            probe.measure(10)
+            reports.append(f"{'latency':<10} " + probe.report(probe.measure(args.frames)))
+        rx_node.stop()
+        rx_node.join()
+    return reports
+
+
+def main():
+    parser = server.build_parser()
+    # Latency runs build one Transceiver per frame size, which would all want the metrics port
+    parser.set_defaults(device='sim', metrics_port=0)
+    parser.add('--frames', type=int, default=200, help="Frames to capture per benchmark")
+    parser.add('--clients', type=int, default=1, help="Clients connected at once in the loopback benchmark")
+    parser.add('--bench', choices=['read', 'loopback', 'reconnect', 'latency', 'all'], default='all', help="Which benchmark to run")
+    parser.add('--latency_frame_samps', type=str, default='1000,4000,16000,64000', help="Comma separated frame sizes the latency benchmark compares")
+    args = parser.parse_args()
+
+    logger.remove()
+    logger.add(sys.stderr, level="DEBUG") if args.verbose else logger.add(sys.stderr, level="INFO")
+
+    if args.bench == 'latency':
+        # Not part of 'all', it needs realtime=1 to mean anything
+        print(f"rx_sample_rate {args.rx_sample_rate / 1e6:g} Msps, device {args.device} {args.device_args}")
+        for report in bench_latency(args, [int(size) for size in args.latency_frame_samps.split(',')]):
+            print(report)
+        return
+
+    transceiver = server.Transceiver(args)
+    results = []
+    if args.bench in ('read', 'all'):
+        results.append(bench_read(transceiver, args.frames))
+    if args.bench in ('loopback', 'all'):
+        results.append(bench_loopback(transceiver, args.frames, args.rx_port, args.clients))
+    if args.bench in ('reconnect', 'all'):
+        results.append(bench_reconnect(transceiver, min(args.frames, 50), args.rx_port))
+
+    print(f"rx_sample_rate {args.rx_sample_rate / 1e6:g} Msps, {args.frames} frames of {transceiver.num_samps} samples, device {args.device} {args.device_args}")
+    for result in results:
+        print(result.report())
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,6 @@
 import argparse
 import sys
+import threading
 import time
 import numpy as np
 from functools import partial
@@ -13,32 +14,172 @@ from matplotlib.animation import FuncAnimation
 from matplotlib.widgets import Slider
 plt.style.use('dark_background')
 
-from timer_gen import timer_gen
+import dsp
+import protocol
 
 
-def contains_signal(data, threshold):
-        # squared_magnitudes = np.square(data).real
-        # return np.sum(squared_magnitudes > threshold)
-        return np.sum(data > threshold)
+# Frame size of servers that predate the handshake
+LEGACY_FRAME_SIZE = 64000
+
+
+class StreamSocket(NumpySocket):
+    """
+    Connection to the RX node. Frames come out as complex64 whatever format they travel in.
+    With the frame protocol the returned array is reused, so it is only valid until the next call.
+    """
+    def __init__(self, addr, stream='iq', channel=0, device_channels=None, formats=('sc16', 'fc32'), protocols=protocol.PROTOCOLS, policy=None, queue_frames=None, **settings):
+        super().__init__()
+        self.connect(addr)
+        # stream 'ddc' asks for the server's down-converted channel instead of the full band,
+        # 'channel' for one channel of the server's channelizer and 'spectrum' for PSD rows
+        # (settings: fft_size, overlap, window, averages)
+        hello = {'stream': stream, 'channel': channel, 'formats': list(formats), 'protocols': list(protocols), **settings}
+        # Device channels of a multi-channel capture to receive, e.g. [0, 1]. With more than
+        # one, frames are (channels, samples) arrays in this order
+        if device_channels is not None:
+            hello['device_channels'] = list(device_channels)
+        # How the server should queue frames for this client when it falls behind
+        if policy is not None:
+            hello['policy'] = policy
+        if queue_frames is not None:
+            hello['queue_frames'] = queue_frames
+        # Servers without the handshake stream fc32 NumpySocket messages
+        self.stream_info = protocol.request_stream(self, **hello) or {'stream': 'iq', 'format': 'fc32'}
+        self.stream = self.stream_info.get('stream', 'iq')
+        self.format = self.stream_info['format']
+        self.protocol = self.stream_info.get('protocol', 'npy')
+        # Samples per frame (per channel), as set by the server's rx_frame_samps
+        self.frame_size = self.stream_info.get('frame_size', LEGACY_FRAME_SIZE)
+        self.device_channels = self.stream_info.get('device_channels', [0])
+        self.reader = protocol.FrameReader(self) if self.protocol == 'frame' else None
+        self.header = None
+        self.skipped = 0
+        self.converted = np.empty(0, dtype=np.complex64)
+        logger.debug(f"Receiving {self.stream} stream as {self.format} ({self.protocol})")
+        
+    def track(self, header):
+        # Sequence gaps are frames the server dropped for this client
+        if self.header is not None:
+            self.skipped += header.seq - self.header.seq - 1
+        self.header = header
+        
+    def next(self):
+        if self.reader is None:
+            data = self.recv()
+        else:
+            data = self.reader.read()
+            if len(data):
+                self.track(self.reader.header)
+        if data.dtype == protocol.SC16 or data.dtype == np.int16:
+            shape = data.shape[:-1] + (data.shape[-1] // 2,) if data.dtype == np.int16 else data.shape
+            if self.converted.shape != shape:
+                self.converted = np.empty(shape, dtype=np.complex64)
+            return protocol.sc16_to_fc32(data, out=self.converted)
+        return data
     
-class Sampler(NumpySocket):
+class Transmitter(NumpySocket):
+    """
+    Connection to the TX node. Frames passed to transmit() are sent back to back and
+    played out gaplessly as long as they arrive faster than the radio consumes them.
+    """
     def __init__(self, addr):
         super().__init__()
         self.connect(addr)
+        self.stream_info = protocol.request_stream(self, formats=['fc32'], protocols=['frame'])
+        if self.stream_info is None:
+            raise ConnectionError("Server has no TX node handshake")
+        self.seq = 0
         
-    def next(self):
-        return self.recv()
+    def transmit(self, data):
+        protocol.send_frame(self, np.ascontiguousarray(data, dtype=np.complex64), self.seq)
+        self.seq += 1
     
-    # TODO: Add static typing for func Callable
-    def loop(self):
-        try:
-            while True:
-                data = self.next()
+class Sampler(StreamSocket):
+    """
+    Headless client. Iterating over it, or over frames() for batches and copies, receives
+    without allocating per frame. loop() feeds every frame to loop_func.
+    """
+    def __init__(self, addr, **stream):
+        super().__init__(addr, **stream)
+        # Headers of the frames in the batch frames() yielded last
+        self.headers = []
+        
+    def __iter__(self):
+        return self.frames()
+    
+    def frames(self, batch=None, pool=3, copy=False):
+        """
+        Yield frames until the server closes the stream, as complex64 (float32 for spectrum
+        rows). Frames are received straight into pool preallocated buffers that are reused
+        in turn, so a yielded array is only valid for the next pool - 1 iterations. Pass
+        copy=True for arrays the caller owns, or a larger pool to hold on to more of them.
+        With batch=K each item is K consecutive frames stacked along a new first axis. A
+        batch is cut short if the frame shape changes, e.g. when a ddc frame comes out one
+        sample shorter.
+        """
+        slots = []
+        index = 0
+        filled = 0
+        while True:
+            if self.reader is None:
+                # NumpySocket allocates every message, the legacy protocol can't receive in place
+                data = self.recv()
                 if len(data) == 0:
-                    logger.error("Nothing returned. Needs to close")
                     break
+                header = None
+                shape = data.shape[:-1] + (data.shape[-1] // 2,) if data.dtype == np.int16 else data.shape
+                dtype = data.dtype if data.dtype == np.float32 else np.dtype(np.complex64)
+            else:
+                header = self.reader.read_header()
+                if header is None:
+                    break
+                shape = (header.count,) if header.channels == 1 else (header.channels, header.count)
+                dtype = header.dtype if header.dtype == np.float32 else np.dtype(np.complex64)
+            if not slots or slots[0].shape[1:] != shape or slots[0].dtype != dtype:
+                if filled:
+                    yield self.batch(slots[index][:filled], batch, copy)
+                # Yielded buffers are left to the caller, the new pool doesn't overwrite them
+                slots = [np.empty((batch or 1,) + shape, dtype=dtype) for _ in range(pool)]
+                index = filled = 0
+            out = slots[index][filled]
+            if header is None:
+                if data.dtype == np.int16:
+                    protocol.sc16_to_fc32(data, out=out)
                 else:
-                    self.loop_func(data)
+                    np.copyto(out, data)
+            elif header.dtype == dtype:
+                if len(self.reader.read_payload(header, out.reshape(-1).view(np.uint8))) == 0 and out.size:
+                    break
+            else:
+                # sc16 on the wire: receive into the reader's buffer and scale into the slot
+                data = self.reader.read_payload(header)
+                if len(data) == 0 and out.size:
+                    break
+                protocol.sc16_to_fc32(data, out=out)
+            if header is not None:
+                self.track(header)
+                if filled == 0:
+                    self.headers = []
+                self.headers.append(header)
+            filled += 1
+            if filled == (batch or 1):
+                yield self.batch(slots[index], batch, copy)
+                index = (index + 1) % pool
+                filled = 0
+        if filled:
+            yield self.batch(slots[index][:filled], batch, copy)
+            
+    @staticmethod
+    def batch(frames, batch, copy):
+        frames = frames if batch else frames[0]
+        return frames.copy() if copy else frames
+    
+    # TODO: Add static typing for func Callable
+    def loop(self):
+        try:
+            for data in self.frames():
+                self.loop_func(data)
+            logger.error("Nothing returned. Needs to close")
         except KeyboardInterrupt as e:
             pass
         except ValueError as e:
@@ -53,26 +194,116 @@ class Sampler(NumpySocket):
         logger.debug("Exiting Sampler loop")
         
 class SignalFinder(Sampler):
-    def __init__(self, addr):
+    def __init__(self, addr, threshold_db=10.0):
         super().__init__(addr)
+        self.detector = dsp.BurstDetector(threshold_db=threshold_db)
         
     def loop_func(self, data):
-        if contains_signal(data, 0.004):
-            logger.debug('Signal found')
+        for burst in self.detector.process(data):
+            logger.debug(f'Signal found: samples {burst.start}-{burst.stop}, {burst.power_db:.1f} dB, SNR {burst.snr_db:.1f} dB')
 
-class Animator(NumpySocket):
-    def __init__(self, addr):
-        super().__init__()
-        self.connect(addr)
-    
-    def next(self):
-        return self.recv()
+class LatencyProbe(Sampler):
+    """
+    Measures capture to client latency from the capture time the server stamps into
+    every frame header. Both ends read the wall clock, so across hosts the numbers are
+    only as good as their clock sync (NTP, PTP).
+    """
+    def __init__(self, addr, **stream):
+        super().__init__(addr, protocols=['frame'], **stream)
+        if self.protocol != 'frame':
+            raise ConnectionError("Server doesn't send frame headers, nothing to measure")
+        self.latencies = []
+        
+    def measure(self, frames):
+        """Receive up to frames frames and return their latencies (s)."""
+        latencies = []
+        for _ in range(frames):
+            if len(self.next()) == 0:
+                break
+            latencies.append(time.time() - self.header.capture_time)
+        self.latencies.extend(latencies)
+        return np.array(latencies)
+        
+    def report(self, latencies=None):
+        latencies = np.asarray(self.latencies if latencies is None else latencies)
+        if len(latencies) == 0:
+            return "no frames"
+        p50, p90, p99 = np.percentile(latencies, [50, 90, 99]) * 1e3
+        # Frames are stamped once full, so the first sample of a frame is older by the fill time
+        fill = self.frame_size / self.stream_info.get('sample_rate', np.inf) * 1e3
+        return (f"{self.frame_size} samples/frame (fill {fill:.3f} ms), {len(latencies)} frames | latency p50 {p50:7.3f} ms  "
+                f"p90 {p90:7.3f} ms  p99 {p99:7.3f} ms  max {latencies.max() * 1e3:7.3f} ms | skipped {self.skipped}")
+        
+    def loop_func(self, data):
+        self.latencies.append(time.time() - self.header.capture_time)
+        if len(self.latencies) % 100 == 0:
+            logger.info(self.report(self.latencies[-100:]))
+            
+    def loop_exit(self):
+        logger.info(self.report())
+
+class Animator(StreamSocket):
+    """
+    Receives on a background thread, so drawing never holds up the stream and a slow
+    display doesn't push back on the server. The thread copies each frame into one of
+    three buffers and keeps only the newest. next() hands that one to the GUI and
+    display_skipped counts the frames replaced before the GUI got to them. receive_func
+    sees every frame, on the receive thread, for work that must not skip any.
+    """
+    def __init__(self, addr, **stream):
+        super().__init__(addr, **stream)
+        self.buffers = [None, None, None]
+        self.latest_index = None
+        self.shown_index = None
+        self.ended = False
+        self.display_skipped = 0
+        self.frame_ready = threading.Condition()
+        self.receiver = None
     
     def loop(self):
         self.loop_init()
         plt.show()
             
         self.loop_exit()
+        
+    def receive(self):
+        while True:
+            try:
+                data = StreamSocket.next(self)
+            except (OSError, ValueError):
+                data = np.array([])
+            if len(data) == 0:
+                break
+            self.receive_func(data)
+            with self.frame_ready:
+                index = next(i for i in range(3) if i not in (self.latest_index, self.shown_index))
+            buffer = self.buffers[index]
+            if buffer is None or buffer.shape != data.shape or buffer.dtype != data.dtype:
+                buffer = self.buffers[index] = np.empty_like(data)
+            np.copyto(buffer, data)
+            with self.frame_ready:
+                if self.latest_index is not None:
+                    self.display_skipped += 1
+                self.latest_index = index
+                self.frame_ready.notify()
+        with self.frame_ready:
+            self.ended = True
+            self.frame_ready.notify()
+        
+    def next(self):
+        """Newest frame not shown yet, waiting for one if needed. Empty once the stream ended."""
+        if self.receiver is None:
+            self.receiver = threading.Thread(target=self.receive, daemon=True)
+            self.receiver.start()
+        with self.frame_ready:
+            self.frame_ready.wait_for(lambda: self.latest_index is not None or self.ended)
+            if self.latest_index is None:
+                return np.array([])
+            self.shown_index, self.latest_index = self.latest_index, None
+            return self.buffers[self.shown_index]
+        
+    def receive_func(self, data):
+        pass
             
     def loop_init(self):
         pass
@@ -81,36 +312,47 @@ class Animator(NumpySocket):
         pass
     
     def loop_exit(self):
-        logger.debug("Exiting Animator loop")
+        logger.debug(f"Exiting Animator loop, {self.display_skipped} frames not displayed")
         
 class Waterfall(Animator):
-    def __init__(self, addr):
+    """
+    Waterfall from the IQ stream. Each row is the Welch average of every fft_size
+    segment of one frame, computed in one batched FFT. Rows are written into a ring
+    that holds every row twice, so the newest iterations rows are always one
+    contiguous view and nothing is shifted per frame.
+    """
+    def __init__(self, addr, fft_size=512, window='hann'):
         super().__init__(addr)
+        self.fft_size = fft_size
+        self.psd = dsp.WelchPSD(fft_size=fft_size, overlap=0.0, window=window)
         
     def loop_init(self):
-        iterations = 200
-        self.fft_size = 512
-        self.waterfall_data = np.zeros((iterations, self.fft_size))
+        self.iterations = 200
+        self.ring = np.full((2 * self.iterations, self.fft_size), -120.0, dtype=np.float32)
+        # Row the next frame overwrites, which is also where the view of the oldest row starts
+        self.row = 0
         
         plt.rcParams['toolbar'] = 'None'
         self.fig, self.ax = plt.subplots()
         self.fig.set_size_inches(8, 10)
         
-        self.im = self.ax.imshow(self.waterfall_data, cmap='viridis', vmin=-0.1, vmax=3.0)
-        
-        sample_rate = 2000000
+        sample_rate = self.stream_info.get('sample_rate', 2000000)
         self.freq_range = sample_rate / 2000 # Half sample_rate and convert to kHz
-        # time_domain = buffer_size * iterations * decimator / sample_rate
-        self.time_domain = 64000 * iterations / sample_rate
-        plt.imshow(self.waterfall_data, extent=[-self.freq_range, self.freq_range, 0, self.time_domain], aspect='auto')
+        # The Animator skips frames it can't draw in time, so rows are not evenly spaced in time
+        self.im = self.ax.imshow(self.rows(), cmap='viridis', vmin=-100, vmax=0, origin='lower',
+                                 extent=[-self.freq_range, self.freq_range, 0, self.iterations], aspect='auto')
         
         self.ax.set_xlabel('Frequency (kHz)')
-        self.ax.set_ylabel('Time (s)')
+        self.ax.set_ylabel('Rows')
         self.ax.set_title('Waterfall Plot')
-        self.fig.colorbar(self.im, label='Amplitude')
+        self.fig.colorbar(self.im, label='Power (dB)')
         
         self.ani = FuncAnimation(self.fig, self.loop_func, blit=True, interval=0)
         
+    def rows(self):
+        """The last iterations rows, oldest first, as a view of the ring."""
+        return self.ring[self.row:self.row + self.iterations]
+        
     def loop_func(self, frame):
         data = self.next()
         if len(data) == 0:
@@ -118,27 +360,103 @@ class Waterfall(Animator):
             self.ani.event_source.stop()
             plt.close()
             return self.im,
-        else:
-            freq_domain = np.fft.fftshift(np.fft.fft(data, n=self.fft_size))
-            max_magnitude_index = np.abs(freq_domain)
-            self.waterfall_data[1:, :] = self.waterfall_data[:-1, :]
-            self.waterfall_data[0, :] = max_magnitude_index
-            
-            self.im.set_array(self.waterfall_data)
-            self.im.set_extent([-self.freq_range, self.freq_range, 0, self.time_domain])
-            
+        for row in self.psd.process(data):
+            self.ring[self.row] = row
+            self.ring[self.row + self.iterations] = row
+            self.row = (self.row + 1) % self.iterations
+        self.im.set_array(self.rows())
         return self.im,
 
+class SpectrumWaterfall(Animator):
+    """Waterfall of the server's 'spectrum' stream. Only the PSD bins cross the network."""
+    def __init__(self, addr, fft_size=512, overlap=0.5, window='hann', averages=0):
+        super().__init__(addr, stream='spectrum', fft_size=fft_size, overlap=overlap, window=window, averages=averages)
+        
+    def loop_init(self):
+        iterations = 200
+        self.fft_size = self.stream_info['fft_size']
+        self.waterfall_data = np.full((iterations, self.fft_size), -120.0)
+        
+        plt.rcParams['toolbar'] = 'None'
+        self.fig, self.ax = plt.subplots()
+        self.fig.set_size_inches(8, 10)
+        
+        self.freq_range = self.stream_info['sample_rate'] / 2000 # Half sample_rate and convert to kHz
+        self.im = self.ax.imshow(self.waterfall_data, cmap='viridis', vmin=-100, vmax=0,
+                                 extent=[-self.freq_range, self.freq_range, 0, iterations], aspect='auto')
+        
+        self.ax.set_xlabel('Frequency (kHz)')
+        self.ax.set_ylabel('Rows')
+        self.ax.set_title('Waterfall Plot (server spectrum)')
+        self.fig.colorbar(self.im, label='Power (dB)')
+        
+        self.ani = FuncAnimation(self.fig, self.loop_func, blit=True, interval=0)
+        
+    def loop_func(self, frame):
+        data = self.next()
+        if len(data) == 0:
+            logger.error('Fatal error with receiving data, breaking from animation (Server probably closed)')
+            self.ani.event_source.stop()
+            plt.close()
+            return self.im,
+        # One or more PSD rows per message, newest last
+        rows = np.atleast_2d(data)[::-1][:len(self.waterfall_data)]
+        self.waterfall_data[len(rows):, :] = self.waterfall_data[:-len(rows), :]
+        self.waterfall_data[:len(rows), :] = rows
+        self.im.set_array(self.waterfall_data)
+        return self.im,
+
+class MinMaxDecimator():
+    """
+    Reduces a frame to the min and max of each of bins equal slices, interleaved, with
+    x holding the slice starts twice. Plotted, that is the same envelope every sample
+    would draw, since a screen shows one column per pixel anyway, at a fraction of the
+    points. component picks what is drawn of complex frames: 'i', 'q' or 'magnitude'.
+    """
+    COMPONENTS = ('i', 'q', 'magnitude')
+    
+    def __init__(self, bins, component='i'):
+        if component not in self.COMPONENTS:
+            raise ValueError(f"Unknown component {component}. Choose from {list(self.COMPONENTS)}")
+        self.bins = bins
+        self.component = component
+        self.length = None
+        
+    def values(self, data):
+        if not np.iscomplexobj(data):
+            return data
+        if self.component == 'i':
+            return data.real
+        if self.component == 'q':
+            return data.imag
+        return np.abs(data)
+        
+    def process(self, data):
+        values = self.values(data)
+        if len(values) != self.length:
+            self.length = len(values)
+            bins = max(min(self.bins, self.length), 1)
+            self.edges = np.linspace(0, self.length, bins + 1).astype(np.intp)[:-1]
+            self.x = np.repeat(self.edges, 2)
+            self.out = np.empty(2 * bins, dtype=values.dtype)
+        pairs = self.out.reshape(-1, 2)
+        np.minimum.reduceat(values, self.edges, out=pairs[:, 0])
+        np.maximum.reduceat(values, self.edges, out=pairs[:, 1])
+        return self.out
+        
 class Linegraph(Animator):
-    def __init__(self, addr):
+    def __init__(self, addr, component='i'):
         super().__init__(addr)
+        self.component = component
         
     def loop_init(self):
-        init_data = np.zeros(64000, dtype=np.complex64)
         self.fig, self.ax = plt.subplots()
-        self.ax.set_xlim(0, 64000)
-        self.ax.set_ylim(-0.1,0.1)
-        self.line, = self.ax.plot(init_data)
+        self.ax.set_xlim(0, self.frame_size)
+        self.ax.set_ylim(0 if self.component == 'magnitude' else -0.1, 0.1)
+        # About one min/max pair per pixel column
+        self.decimator = MinMaxDecimator(int(self.ax.bbox.width), self.component)
+        y = self.decimator.process(np.zeros(self.frame_size, dtype=np.float32))
+        self.line, = self.ax.plot(self.decimator.x, y)
         
         self.ani = FuncAnimation(self.fig, self.loop_func, blit=True, interval=0)
         
@@ -150,34 +468,46 @@ class Linegraph(Animator):
             plt.close()
             return self.line,
         else:
-            self.line.set_ydata(data)
+            self.line.set_data(self.decimator.x, self.decimator.process(data))
             return self.line,
         
 class LinegraphSignalFinder(Animator):
-    def __init__(self, addr):
+    def __init__(self, addr, component='magnitude'):
         super().__init__(addr)
+        self.component = component
         
     def loop_init(self):
-        init_data = np.zeros(64000, dtype=np.complex64)
         self.fig, self.ax = plt.subplots()
         plt.subplots_adjust(bottom=0.25)
-        self.ax.set_xlim(0, 64000)
-        self.ax.set_ylim(-0.1,0.1)
-        self.line, = self.ax.plot(init_data)
+        self.ax.set_xlim(0, self.frame_size)
+        # The threshold line is an amplitude, so it lines up with the magnitude
+        self.ax.set_ylim(0 if self.component == 'magnitude' else -0.1, 0.1)
+        self.decimator = MinMaxDecimator(int(self.ax.bbox.width), self.component)
+        y = self.decimator.process(np.zeros(self.frame_size, dtype=np.float32))
+        self.line, = self.ax.plot(self.decimator.x, y)
         
+        # The slider sets the detection threshold above the tracked noise floor
+        self.detector = dsp.BurstDetector(threshold_db=10.0)
+        self.found = False
         def on_slider_change(val):
-            self.threshold = val
+            self.detector.threshold = 10 ** (val / 10)
         
         self.threshold_line = self.ax.axhline(y=0.025, color='r', linestyle='--', label='Horizontal Line')
-        self.threshold = 0.0
         self.slider_ax = plt.axes([0.125, 0.1, 0.8, 0.05])
-        self.slider = Slider(self.slider_ax, 'Threshold', 0.0, 0.1, valinit=self.threshold)
+        self.slider = Slider(self.slider_ax, 'Threshold (dB)', 0.0, 30.0, valinit=10.0)
         self.slider.on_changed(on_slider_change)
         
         self.ani = FuncAnimation(self.fig, self.loop_func, blit=True, interval=0)
         
+        # Only the timing printout uses it, and the module is not part of this repo
+        from timer_gen import timer_gen
         self.timer = timer_gen()
         
+    def receive_func(self, data):
+        # Every frame goes through the detector, also the ones never drawn
+        bursts = self.detector.process(data)
+        self.found = bool(bursts) or self.detector.pending is not None
+        
     def loop_func(self, frame):
         data = self.next()
         print(next(self.timer))
@@ -187,9 +517,10 @@ class LinegraphSignalFinder(Animator):
             plt.close()
             return self.line,
         else:
-            self.line.set_ydata(data)
-            self.threshold_line.set_ydata(self.threshold)
-            if contains_signal(data, self.threshold):
+            self.line.set_data(self.decimator.x, self.decimator.process(data))
+            # Amplitude the averaged power has to exceed
+            self.threshold_line.set_ydata([np.sqrt(self.detector.level())] * 2)
+            if self.found:
                 print('Found signal', end="\r")
             else:
                 print('No signal     ', end="\r")
@@ -201,6 +532,7 @@ def main():
     parser = argparse.ArgumentParser(description="Arguments for setting up client of UHD_Transceiver")
     parser.add_argument('--remote', type=str, default='', help="Remote address of UHD_Transceiver server")
     parser.add_argument('--port', type=int, default=12345, help="Remote port of UHD_Transceiver server")
+    parser.add_argument('--component', choices=MinMaxDecimator.COMPONENTS, default='magnitude', help="What the line graph draws of the IQ samples")
     parser.add_argument('--verbose', '-v', action='store_true', help="Enable verbose mode")
     args = parser.parse_args()
     
@@ -217,11 +549,11 @@ def main():
     # waterfall.loop()
     # time.sleep(0.2)
     
-    # linegraph = Linegraph(server_addr)
+    # linegraph = Linegraph(server_addr, args.component)
     # linegraph.loop()
     # time.sleep(0.2)
     
-    linegraph = LinegraphSignalFinder(server_addr)
+    linegraph = LinegraphSignalFinder(server_addr, args.component)
     linegraph.loop()
     time.sleep(0.2)
 
@@ -0,0 +1,305 @@
+"""
+Vectorized DSP stages applied to captured frames. Every stage keeps whatever state
+it needs between calls, so feeding consecutive frames gives the same output as
+processing the whole stream at once.
+"""
+from collections import namedtuple
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+import protocol
+
+
+def as_fc32(data):
+    """complex64 view of a frame, converting sc16 frames."""
+    if data.dtype == protocol.SC16 or data.dtype == np.int16:
+        return protocol.sc16_to_fc32(data)
+    return data
+
+
+def lowpass_taps(num_taps, cutoff):
+    """Hamming windowed-sinc lowpass with unity DC gain. cutoff is in cycles/sample (0 to 0.5)."""
+    n = np.arange(num_taps) - (num_taps - 1) / 2
+    taps = 2 * cutoff * np.sinc(2 * cutoff * n) * np.hamming(num_taps)
+    return (taps / taps.sum()).astype(np.float32)
+
+
+class FIRDecimator():
+    """Decimating FIR that only computes the outputs it keeps. History carries over between frames."""
+    def __init__(self, taps, decimation):
+        self.taps = np.ascontiguousarray(taps[::-1])
+        self.decimation = decimation
+        self.history = np.zeros(len(taps) - 1, dtype=np.complex64)
+        # Index into the next frame of the first sample that ends an output window
+        self.skip = 0
+
+    def process(self, data):
+        x = np.concatenate((self.history, data))
+        windows = sliding_window_view(x, len(self.taps))[self.skip::self.decimation]
+        out = windows @ self.taps
+        self.skip = self.skip + len(out) * self.decimation - len(data)
+        self.history = x[len(x) - len(self.history):]
+        return out.astype(np.complex64, copy=False)
+
+
+class NCO():
+    """Mixes by -offset Hz. The oscillator is tabulated per frame size and the phase carries over."""
+    def __init__(self, sample_rate, offset):
+        self.step = -2 * np.pi * offset / sample_rate
+        self.phase = 0.0
+        self.table = np.empty(0, dtype=np.complex64)
+
+    def process(self, data):
+        n = len(data)
+        if len(self.table) != n:
+            self.table = np.exp(1j * self.step * np.arange(n)).astype(np.complex64)
+        out = data * self.table
+        out *= np.complex64(np.exp(1j * self.phase))
+        self.phase = (self.phase + self.step * n) % (2 * np.pi)
+        return out
+
+
+class DDC():
+    """
+    Digital down-converter: NCO mix of offset Hz to baseband followed by a
+    decimating lowpass. Output rate is sample_rate / decimation.
+    """
+    def __init__(self, sample_rate, offset, decimation, num_taps=None, bandwidth=0.8):
+        self.sample_rate = sample_rate
+        self.offset = offset
+        self.decimation = decimation
+        self.output_rate = sample_rate / decimation
+        num_taps = num_taps or 8 * decimation + 1
+        self.nco = NCO(sample_rate, offset)
+        self.fir = FIRDecimator(lowpass_taps(num_taps, bandwidth * 0.5 / decimation), decimation)
+
+    def process(self, data):
+        return self.fir.process(self.nco.process(as_fc32(data)))
+
+
+class Channelizer():
+    """
+    Critically sampled polyphase FFT filter bank. Splits the band into num_channels
+    channels spaced sample_rate / num_channels apart, each decimated by num_channels,
+    with one windowed fold and one FFT per output block. Channel k is centered on
+    k * sample_rate / num_channels (FFT order, so the upper half are negative offsets).
+    """
+    def __init__(self, sample_rate, num_channels, taps_per_channel=8):
+        self.sample_rate = sample_rate
+        self.num_channels = num_channels
+        self.output_rate = sample_rate / num_channels
+        self.taps_per_channel = taps_per_channel
+        taps = lowpass_taps(num_channels * taps_per_channel, 0.5 / num_channels)
+        # Windows are in time order, the filter runs backwards over them
+        self.window = np.ascontiguousarray(taps[::-1])
+        self.history = np.zeros(len(taps) - 1, dtype=np.complex64)
+        self.skip = 0
+
+    def channel_offset(self, channel):
+        """Offset from the capture center frequency of a channel (Hz)."""
+        if channel >= self.num_channels / 2:
+            channel -= self.num_channels
+        return channel * self.output_rate
+
+    def process(self, data):
+        """Return a (num_channels, blocks) array. Row k is channel k."""
+        data = as_fc32(data)
+        x = np.concatenate((self.history, data))
+        windows = sliding_window_view(x, len(self.window))[self.skip::self.num_channels]
+        self.skip = self.skip + len(windows) * self.num_channels - len(data)
+        self.history = x[len(x) - len(self.history):]
+        # Newest sample first, folded into taps_per_channel rows of num_channels and summed
+        weighted = (windows * self.window)[:, ::-1]
+        folded = weighted.reshape(len(windows), self.taps_per_channel, self.num_channels).sum(axis=1)
+        channels = np.fft.ifft(folded, axis=1) * self.num_channels
+        return np.ascontiguousarray(channels.T, dtype=np.complex64)
+
+
+WINDOWS = {
+    'hann': np.hanning,
+    'hamming': np.hamming,
+    'blackman': np.blackman,
+    'rect': np.ones,
+}
+
+
+class WelchPSD():
+    """
+    Welch averaged power spectrum. Segments of fft_size overlapping by overlap (fraction)
+    are windowed and transformed in one batched FFT. Every averages segments make one
+    output row, in dB and fftshifted. averages=0 makes one row per process() call.
+    Segments and partial averages carry over between calls.
+    """
+    def __init__(self, fft_size=512, overlap=0.5, window='hann', averages=0):
+        if window not in WINDOWS:
+            raise ValueError(f"Unknown window {window}. Choose from {list(WINDOWS)}")
+        self.fft_size = fft_size
+        self.step = max(fft_size - int(fft_size * overlap), 1)
+        self.window = WINDOWS[window](fft_size).astype(np.float32)
+        self.scale = np.float32(1 / np.sum(self.window ** 2))
+        self.averages = averages
+        self.history = np.zeros(0, dtype=np.complex64)
+        self.accumulated = np.zeros(fft_size)
+        self.count = 0
+
+    def to_db(self, power):
+        return (10 * np.log10(np.fft.fftshift(power, axes=-1) + 1e-20)).astype(np.float32)
+
+    def process(self, data):
+        """Return a (rows, fft_size) float32 array of PSD rows in dB. May have no rows."""
+        x = np.concatenate((self.history, as_fc32(data)))
+        segments = max((len(x) - self.fft_size) // self.step + 1, 0)
+        if not segments:
+            # Not one whole segment yet, keep it all for the next call
+            self.history = x
+            return np.zeros((0, self.fft_size), dtype=np.float32)
+        windows = sliding_window_view(x, self.fft_size)[::self.step][:segments]
+        self.history = x[segments * self.step:]
+        spectrum = np.fft.fft(windows * self.window, axis=1)
+        power = (spectrum.real ** 2 + spectrum.imag ** 2) * self.scale
+        if self.averages == 0:
+            return self.to_db(power.mean(axis=0, keepdims=True))
+
+        need = self.averages - self.count
+        if segments < need:
+            self.accumulated += power.sum(axis=0)
+            self.count += segments
+            return np.zeros((0, self.fft_size), dtype=np.float32)
+        first = (self.accumulated + power[:need].sum(axis=0)) / self.averages
+        rest = power[need:]
+        full = len(rest) // self.averages
+        blocks = rest[:full * self.averages].reshape(full, self.averages, self.fft_size).mean(axis=1)
+        leftover = rest[full * self.averages:]
+        self.accumulated = leftover.sum(axis=0)
+        self.count = len(leftover)
+        return self.to_db(np.vstack((first, blocks)))
+
+
+# Absolute sample indices [start, stop) and powers in dB (power relative to full scale)
+Burst = namedtuple('Burst', 'start stop power_db peak_db snr_db')
+
+
+# Lowest noise floor (power) BurstDetector will use. Far below sc16 quantization noise,
+# but keeps an all-zero stretch of input from pinning the floor at 0
+NOISE_FLOOR = 1e-20
+
+
+class BurstDetector():
+    """
+    CFAR burst detector. Power is averaged over a sliding window of window samples and
+    compared to threshold_db above a noise floor that follows the median of the signal
+    free windows. Runs closer than min_gap samples are merged and shorter than min_len
+    dropped. The window, noise floor and any burst in progress carry over between
+    frames, so a burst that straddles frames comes out once, whole. Start and stop are
+    corrected for the window's ramp, which puts a clean step on the exact sample.
+    """
+    def __init__(self, window=64, threshold_db=10.0, min_gap=None, min_len=None, noise_alpha=0.1):
+        self.window = window
+        self.threshold = 10 ** (threshold_db / 10)
+        self.min_gap = window if min_gap is None else min_gap
+        self.min_len = window if min_len is None else min_len
+        self.noise_alpha = noise_alpha
+        self.history = np.zeros(window - 1, dtype=np.float32)
+        self.noise = None
+        # Absolute index of the next sample
+        self.offset = 0
+        # Last run, kept while it is open or may still merge with the next one:
+        # [rise, fall, sum of averaged power, peak], fall is None while open
+        self.pending = None
+
+    def level(self):
+        return self.noise * self.threshold
+
+    def burst(self, rise, fall, total, peak):
+        power = total / (fall - rise)
+        noise = self.noise
+        level = self.level()
+        # The averaged power ramps over window samples at each edge. Undo the delay to the crossing
+        ramp = self.window / max(power - noise, 1e-30)
+        start = max(rise - int(np.floor((level - noise) * ramp)), rise - self.window + 1)
+        stop = min(max(fall + 1 - int(np.ceil((power - level) * ramp)), start + 1), fall)
+        return Burst(int(start), int(stop), float(10 * np.log10(power)), float(10 * np.log10(peak)),
+                     float(10 * np.log10(max(power - noise, 1e-30) / noise)))
+
+    def process(self, data):
+        """Return the bursts that ended with this frame."""
+        x = as_fc32(data)
+        n = len(x)
+        if n == 0:
+            return []
+        window = self.window
+        power = x.real ** 2 + x.imag ** 2
+        padded = np.concatenate((self.history, power))
+        self.history = padded[len(padded) - (window - 1):]
+        sums = np.concatenate(([0.0], np.cumsum(padded, dtype=np.float64)))
+        # smooth[i] is the mean power of the window ending at sample i of this frame
+        smooth = (sums[window:] - sums[:-window]) / window
+
+        cells = smooth[::window]
+        if self.noise is None or self.noise <= NOISE_FLOOR:
+            # First frame, or the floor collapsed on all-zero input. With a zero level every
+            # sample would be above it and never quiet again, so start over from this frame
+            self.noise = max(float(np.median(cells)), NOISE_FLOOR)
+        level = self.level()
+        above = smooth > level
+        quiet = cells[cells <= level]
+        if len(quiet):
+            self.noise = max(self.noise + self.noise_alpha * (float(np.median(quiet)) - self.noise), NOISE_FLOOR)
+
+        was_open = self.pending is not None and self.pending[1] is None
+        edges = np.diff(above.view(np.int8), prepend=np.int8(was_open))
+        rises = np.flatnonzero(edges == 1)
+        falls = np.flatnonzero(edges == -1)
+        if was_open:
+            rises = np.concatenate(([0], rises))
+        if above[-1]:
+            falls = np.concatenate((falls, [n]))
+        offset = self.offset
+        self.offset += n
+
+        bursts = []
+        if len(rises):
+            smooth_sums = np.concatenate(([0.0], np.cumsum(smooth)))
+            totals = smooth_sums[falls] - smooth_sums[rises]
+            # Gaps are below the level and runs above it, so the max up to the next rise is the run's peak
+            peaks = np.maximum.reduceat(smooth, rises)
+            # Merge runs separated by less than min_gap
+            first = np.concatenate(([True], rises[1:] - falls[:-1] >= self.min_gap))
+            starts = np.flatnonzero(first)
+            ends = np.concatenate((starts[1:], [len(rises)])) - 1
+            rises, falls = rises[starts] + offset, falls[ends] + offset
+            totals = np.add.reduceat(totals, starts)
+            peaks = np.maximum.reduceat(peaks, starts)
+            runs = [[rises[0], falls[0], totals[0], peaks[0]]]
+            # Only the first and last run need the Python path, the rest are filtered here
+            middle = np.flatnonzero(falls[1:-1] - rises[1:-1] >= self.min_len) + 1
+            runs += [[rises[i], falls[i], totals[i], peaks[i]] for i in middle]
+            if len(rises) > 1:
+                runs.append([rises[-1], falls[-1], totals[-1], peaks[-1]])
+
+            head = runs[0]
+            if self.pending is not None:
+                rise, fall, total, peak = self.pending
+                if fall is None or head[0] - fall < self.min_gap:
+                    runs[0] = [rise, head[1], total + head[2], max(peak, head[3])]
+                elif fall - rise >= self.min_len:
+                    bursts.append(self.burst(rise, fall, total, peak))
+            self.pending = None
+            tail = runs.pop()
+            for rise, fall, total, peak in runs:
+                if fall - rise >= self.min_len:
+                    bursts.append(self.burst(rise, fall, total, peak))
+            if tail[1] == self.offset:
+                tail[1] = None
+                self.pending = tail
+            elif tail[1] > self.offset - self.min_gap:
+                self.pending = tail
+            elif tail[1] - tail[0] >= self.min_len:
+                bursts.append(self.burst(*tail))
+        elif self.pending is not None and self.pending[1] <= self.offset - self.min_gap:
+            rise, fall, total, peak = self.pending
+            self.pending = None
+            if fall - rise >= self.min_len:
+                bursts.append(self.burst(rise, fall, total, peak))
+        return bursts
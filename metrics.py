@@ -0,0 +1,155 @@
+"""
+Health metrics in the Prometheus text format, served over plain HTTP.
+
+Counters and histograms are updated inline and cost an integer add (plus a bisect
+for histograms), so they stay on at full sample rate. Values that already live
+somewhere else (queue depths, per client totals) are read by collectors only when
+the endpoint is scraped. Updates are not locked. A rare lost increment between
+threads is acceptable for monitoring.
+"""
+import bisect
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# Seconds, from one recv chunk on a fast host to a stalled network send
+LATENCY_BUCKETS = (1e-5, 5e-5, 1e-4, 5e-4, 1e-3, 5e-3, 0.01, 0.05, 0.1, 0.5, 1.0)
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in labels) + '}'
+
+
+class Counter():
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.value = 0
+        self.children = {}
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def labels(self, **labels):
+        """Child counter for one label set, e.g. counter.labels(code='overflow').inc()."""
+        key = tuple(sorted(labels.items()))
+        if key not in self.children:
+            self.children[key] = Counter(self.name, self.help)
+        return self.children[key]
+
+    def samples(self):
+        if not self.children:
+            return [(self.name, (), self.value)]
+        return [(self.name, key, child.value) for key, child in self.children.items()]
+
+
+class Histogram():
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.bounds = list(buckets)
+        # One count per bucket plus +Inf
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+    def samples(self):
+        samples = []
+        total = 0
+        for bound, count in zip(self.bounds + ['+Inf'], self.counts):
+            total += count
+            samples.append((f'{self.name}_bucket', (('le', bound),), total))
+        samples.append((f'{self.name}_sum', (), self.sum))
+        samples.append((f'{self.name}_count', (), total))
+        return samples
+
+
+class Rate():
+    """Gauge of how fast counter grew between the last two scrapes (per second)."""
+    def __init__(self, name, help, counter):
+        self.name = name
+        self.help = help
+        self.counter = counter
+        self.last = (time.perf_counter(), counter.value)
+
+    def samples(self):
+        now, value = time.perf_counter(), self.counter.value
+        last_time, last_value = self.last
+        self.last = (now, value)
+        return [(self.name, (), (value - last_value) / (now - last_time) if now > last_time else 0.0)]
+
+
+class Registry():
+    def __init__(self):
+        self.metrics = {}
+        self.collectors = {}
+        self.server = None
+
+    def counter(self, name, help):
+        return self.register('counter', Counter(name, help))
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS):
+        return self.register('histogram', Histogram(name, help, buckets))
+
+    def rate(self, name, help, counter):
+        return self.register('gauge', Rate(name, help, counter))
+
+    def register(self, kind, metric):
+        self.metrics[metric.name] = (kind, metric)
+        return metric
+
+    def collect(self, key, collector):
+        """
+        Register collector(), called on every scrape. It returns (name, kind, help, samples)
+        tuples, samples being (labels dict, value) pairs. Registering the same key replaces
+        the previous collector, so a restarted node doesn't report twice.
+        """
+        self.collectors[key] = collector
+
+    def render(self):
+        lines = []
+        for name, (kind, metric) in self.metrics.items():
+            lines.append(f'# HELP {name} {metric.help}')
+            lines.append(f'# TYPE {name} {kind}')
+            lines.extend(f'{sample}{format_labels(labels)} {value}' for sample, labels, value in metric.samples())
+        for collector in list(self.collectors.values()):
+            for name, kind, help, samples in collector():
+                lines.append(f'# HELP {name} {help}')
+                lines.append(f'# TYPE {name} {kind}')
+                lines.extend(f'{name}{format_labels(sorted(labels.items()))} {value}' for labels, value in samples)
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, host, port):
+        """Serve render() at /metrics from a daemon thread."""
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/metrics', '/'):
+                    self.send_error(404)
+                    return
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def shutdown(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
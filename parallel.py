@@ -0,0 +1,280 @@
+"""
+Client side processing spread over several processes.
+
+    python parallel.py --workers 4 --fft_size 1024
+
+A receiver process drains the socket into slots of a shared memory ring and hands
+out slot indices. A pool of worker processes maps the slots, runs the processing
+function on each frame and sends back its (small) result, so sample arrays are
+never pickled. Results come back in frame order. Heavy per-frame analysis then
+scales with the cores of the client host instead of backing up the stream.
+
+Workers see each frame on its own, so the processing function can't carry state
+from one frame to the next. Stateful work (e.g. BurstDetector) belongs in the
+consumer of the results, or on the server.
+"""
+import argparse
+import multiprocessing as mp
+import os
+import queue
+import sys
+import traceback
+from functools import partial
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+from loguru import logger
+
+import dsp
+import protocol
+from client import StreamSocket
+
+
+# Room for frames a little longer than the handshake's frame_size (ddc and channel
+# frames vary by a sample or so with the filter phase)
+SLOT_HEADROOM = 64
+
+
+class SharedFrameRing():
+    """
+    slots frames of up to slot_size samples in one shared memory block. Created without
+    a name, attached by name. The creator unlinks it once every process is done.
+    """
+    def __init__(self, slots, slot_size, dtype, name=None):
+        self.dtype = np.dtype(dtype)
+        self.slot_size = slot_size
+        nbytes = slots * slot_size * self.dtype.itemsize
+        self.shm = shared_memory.SharedMemory(name=name, create=name is None, size=nbytes if name is None else 0)
+        self.frames = np.ndarray((slots, slot_size), dtype=self.dtype, buffer=self.shm.buf)
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def frame(self, slot, header):
+        """View of the frame in slot, shaped like the frame header says."""
+        data = self.frames[slot, :header.channels * header.count]
+        return data if header.channels == 1 else data.reshape(header.channels, header.count)
+
+    def close(self):
+        # Views into the block have to go before the mapping can be closed
+        self.frames = None
+        self.shm.close()
+
+    def unlink(self):
+        self.shm.unlink()
+
+
+def receive(addr, stream, control, slot_count, free, tasks, workers, stop, skipped):
+    """Receiver process: handshake, then fill free slots and queue them for the workers."""
+    try:
+        sock = StreamSocket(addr, protocols=['frame'], **stream)
+    except (OSError, ValueError) as e:
+        control.send(e)
+        return
+    if sock.protocol != 'frame':
+        control.send(ConnectionError("Server doesn't speak the frame protocol"))
+        return
+    control.send(sock.stream_info)
+    name, slot_size, dtype = control.recv()
+    ring = SharedFrameRing(slot_count, slot_size, dtype, name)
+    reader = sock.reader
+    index = 0
+    out = data = None
+    try:
+        while not stop.is_set():
+            header = reader.read_header()
+            if header is None:
+                break
+            count = header.channels * header.count
+            if count > slot_size:
+                logger.warning(f"Frame {header.seq} of {count} samples doesn't fit a {slot_size} sample slot, skipped")
+                reader.read_payload(header)
+                continue
+            # Blocks while the workers hold every slot. The server's queue for this client
+            # then fills up and its overflow policy decides what is lost
+            slot = None
+            while slot is None and not stop.is_set():
+                try:
+                    slot = free.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            if slot is None:
+                break
+            out = ring.frames[slot, :count]
+            if header.dtype == ring.dtype:
+                data = reader.read_payload(header, out.view(np.uint8))
+            else:
+                # sc16 on the wire, scaled into the slot
+                data = reader.read_payload(header)
+                if len(data):
+                    protocol.sc16_to_fc32(data.reshape(-1), out=out)
+            if len(data) == 0 and count:
+                break
+            sock.track(header)
+            skipped.value = sock.skipped
+            tasks.put((index, slot, header))
+            index += 1
+    except (OSError, ValueError) as e:
+        logger.error(f"Receiving stopped: {e}")
+    finally:
+        for _ in range(workers):
+            tasks.put(None)
+        out = data = None
+        ring.close()
+        sock.close()
+
+
+def work(func, name, slot_count, slot_size, dtype, free, tasks, results):
+    """Worker process: run func on every frame it is handed and send back the result."""
+    ring = SharedFrameRing(slot_count, slot_size, dtype, name)
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        index, slot, header = task
+        data = ring.frame(slot, header)
+        data.flags.writeable = False
+        try:
+            result, error = func(data, header), None
+        except Exception:
+            result, error = None, traceback.format_exc()
+        # SimpleQueue pickles in put, so the result is copied before the slot is reused
+        # even if it refers to the frame
+        results.put((index, header, result, error))
+        data = result = None
+        free.put(slot)
+    results.put(None)
+    ring.close()
+
+
+class ParallelPipeline():
+    """
+    Receives a stream in one process and runs func(data, header) on every frame in
+    workers processes. func must be picklable (a module level function or a partial
+    of one) and gets a read-only view of the frame, valid only during the call.
+    results() yields (header, result) in frame order. stream takes the StreamSocket
+    options (stream, device_channels, policy, ...).
+    """
+    def __init__(self, addr, func, workers=None, slots=None, **stream):
+        self.workers = workers or max(os.cpu_count() - 1, 1)
+        # Enough slots that every worker has one frame while the receiver fills another
+        slot_count = slots or 2 * self.workers + 1
+        ctx = mp.get_context()
+        # Every process must share the parent's resource tracker, or the first one to exit
+        # takes the shared memory with it
+        resource_tracker.ensure_running()
+        self.free = ctx.Queue()
+        self.tasks = ctx.SimpleQueue()
+        self.results_queue = ctx.SimpleQueue()
+        self.stop_event = ctx.Event()
+        self.skipped = ctx.Value('q', 0)
+        for slot in range(slot_count):
+            self.free.put(slot)
+
+        control, child_control = ctx.Pipe()
+        self.receiver = ctx.Process(target=receive, name='receiver', daemon=True,
+                                    args=(addr, stream, child_control, slot_count, self.free, self.tasks,
+                                          self.workers, self.stop_event, self.skipped))
+        self.receiver.start()
+        info = control.recv()
+        if isinstance(info, Exception):
+            self.receiver.join()
+            raise info
+        self.stream_info = info
+        if info.get('stream') == 'spectrum':
+            # An averaging spectrum frame carries up to max_rows rows of frame_size bins
+            slot_size = info.get('max_rows', 1) * info.get('frame_size', 0)
+            dtype = np.float32
+        else:
+            channels = len(info.get('device_channels', [0])) if info.get('stream', 'iq') == 'iq' else 1
+            slot_size = channels * (info.get('frame_size', 0) + SLOT_HEADROOM)
+            dtype = np.complex64
+        self.ring = SharedFrameRing(slot_count, slot_size, dtype)
+        self.pool = [ctx.Process(target=work, name=f'worker{i}', daemon=True,
+                                 args=(func, self.ring.name, slot_count, slot_size, dtype, self.free, self.tasks, self.results_queue))
+                     for i in range(self.workers)]
+        for worker in self.pool:
+            worker.start()
+        control.send((self.ring.name, slot_size, dtype))
+        logger.info(f"Processing {info.get('stream', 'iq')} frames on {self.workers} workers with {slot_count} shared slots")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def results(self):
+        """Yield (header, result) for every frame in order, until the stream ends."""
+        pending = {}
+        next_index = 0
+        running = self.workers
+        while running:
+            item = self.results_queue.get()
+            if item is None:
+                running -= 1
+                continue
+            index, header, result, error = item
+            if error is not None:
+                raise RuntimeError(f"Processing frame {header.seq} failed:\n{error}")
+            pending[index] = (header, result)
+            while next_index in pending:
+                yield pending.pop(next_index)
+                next_index += 1
+
+    def close(self):
+        self.stop_event.set()
+        self.receiver.join(1)
+        if self.receiver.is_alive():
+            # Stuck in a recv from a server that went quiet
+            self.receiver.terminate()
+            self.receiver.join()
+            for _ in self.pool:
+                self.tasks.put(None)
+        for worker in self.pool:
+            worker.join(1)
+            if worker.is_alive():
+                worker.terminate()
+                worker.join()
+        if self.skipped.value:
+            logger.warning(f"Server dropped {self.skipped.value} frames because the workers fell behind")
+        self.ring.close()
+        self.ring.unlink()
+
+
+def spectrum_peak(data, header, fft_size=1024):
+    """Frequency bin (from the center) and level (dB) of the strongest Welch PSD bin of a frame's first channel."""
+    rows = dsp.WelchPSD(fft_size=fft_size).process(data if data.ndim == 1 else data[0])
+    if len(rows) == 0:
+        return None
+    peak = int(np.argmax(rows[0]))
+    return peak - fft_size // 2, float(rows[0][peak])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Analyse the RX stream of UHD_Transceiver on several cores")
+    parser.add_argument('--remote', type=str, default='', help="Remote address of UHD_Transceiver server")
+    parser.add_argument('--port', type=int, default=12345, help="Remote port of UHD_Transceiver server")
+    parser.add_argument('--workers', type=int, default=0, help="Worker processes. 0 uses all cores but one")
+    parser.add_argument('--slots', type=int, default=0, help="Frames in the shared memory ring. 0 uses two per worker plus one")
+    parser.add_argument('--fft_size', type=int, default=1024, help="FFT size of the per-frame spectrum")
+    parser.add_argument('--verbose', '-v', action='store_true', help="Enable verbose mode")
+    args = parser.parse_args()
+
+    logger.remove()
+    logger.add(sys.stderr, level="DEBUG") if args.verbose else logger.add(sys.stderr, level="INFO")
+
+    server_addr = (args.remote, args.port) if args.remote else ('localhost', args.port)
+    with ParallelPipeline(server_addr, partial(spectrum_peak, fft_size=args.fft_size), args.workers or None, args.slots or None) as pipeline:
+        bin_width = pipeline.stream_info.get('sample_rate', 0) / args.fft_size
+        try:
+            for header, peak in pipeline.results():
+                if peak is not None:
+                    logger.info(f"Frame {header.seq}: peak at {peak[0] * bin_width / 1e3:+.1f} kHz, {peak[1]:.1f} dB")
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+import asyncio
+import threading
+from collections import deque, namedtuple
+
+
+# A captured frame: sequence number, device time of the first sample, host time the
+# capture completed and the samples
+Frame = namedtuple('Frame', 'seq timestamp capture_time data')
+
+
+class FrameQueue():
+    """
+    Bounded frame queue between a producer and a consumer stage.
+
+    When the queue is full put() follows the overflow policy:
+        block        wait for the consumer to make room
+        drop_oldest  discard the oldest queued frame and queue the new one
+        drop_newest  discard the new frame
+    Every discarded frame is counted in dropped. notify, if given, is called after
+    every queued frame and on close (e.g. to wake up an event loop).
+    """
+    POLICIES = ('block', 'drop_oldest', 'drop_newest')
+
+    def __init__(self, maxsize, policy='block', notify=None):
+        if policy not in self.POLICIES:
+            raise ValueError(f"Unknown overflow policy {policy}. Choose from {self.POLICIES}")
+        if maxsize < 1:
+            raise ValueError("FrameQueue needs room for at least one frame")
+        self.maxsize = maxsize
+        self.policy = policy
+        self.frames = deque()
+        self.lock = threading.Lock()
+        self.not_empty = threading.Condition(self.lock)
+        self.not_full = threading.Condition(self.lock)
+        self.notify = notify
+        self.closed = False
+        self.queued = 0
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self.frames)
+
+    def put(self, frame, timeout=None):
+        queued = self._put(frame, timeout)
+        if queued and self.notify is not None:
+            self.notify()
+        return queued
+
+    def _put(self, frame, timeout):
+        """Queue a frame. Returns False if the frame was not queued (dropped, timed out or closed)."""
+        with self.lock:
+            if self.closed:
+                return False
+            if len(self.frames) >= self.maxsize:
+                if self.policy == 'drop_newest':
+                    self.dropped += 1
+                    return False
+                elif self.policy == 'drop_oldest':
+                    self.frames.popleft()
+                    self.dropped += 1
+                elif not self.not_full.wait_for(lambda: self.closed or len(self.frames) < self.maxsize, timeout):
+                    return False
+                elif self.closed:
+                    return False
+            self.frames.append(frame)
+            self.queued += 1
+            self.not_empty.notify()
+            return True
+
+    def get(self, timeout=None):
+        """Return the oldest frame, or None if nothing arrived before timeout or the queue is closed and empty."""
+        with self.lock:
+            if not self.not_empty.wait_for(lambda: self.closed or self.frames, timeout):
+                return None
+            if not self.frames:
+                return None
+            frame = self.frames.popleft()
+            self.not_full.notify()
+            return frame
+
+    def wait_for(self, count, timeout=None):
+        """Wait until count frames are queued or the queue is closed. Returns the number queued."""
+        with self.lock:
+            self.not_empty.wait_for(lambda: self.closed or len(self.frames) >= count, timeout)
+            return len(self.frames)
+
+    def close(self):
+        """Wake up every waiting producer and consumer. Queued frames can still be drained with get()."""
+        with self.lock:
+            self.closed = True
+            self.not_empty.notify_all()
+            self.not_full.notify_all()
+        if self.notify is not None:
+            self.notify()
+
+
+
+class AsyncFrameQueue():
+    """
+    FrameQueue for one producer and one consumer coroutine on the same event loop.
+    Same overflow policies and counters. Only put() with the block policy ever waits.
+    """
+    def __init__(self, maxsize, policy='block'):
+        if policy not in FrameQueue.POLICIES:
+            raise ValueError(f"Unknown overflow policy {policy}. Choose from {FrameQueue.POLICIES}")
+        if maxsize < 1:
+            raise ValueError("AsyncFrameQueue needs room for at least one frame")
+        self.maxsize = maxsize
+        self.policy = policy
+        self.frames = deque()
+        self.ready = asyncio.Event()
+        self.space = asyncio.Event()
+        self.closed = False
+        self.queued = 0
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self.frames)
+
+    async def put(self, frame):
+        """Queue a frame. Returns False if the frame was not queued (dropped or closed)."""
+        while len(self.frames) >= self.maxsize and not self.closed:
+            if self.policy == 'drop_newest':
+                self.dropped += 1
+                return False
+            if self.policy == 'drop_oldest':
+                self.frames.popleft()
+                self.dropped += 1
+                break
+            self.space.clear()
+            await self.space.wait()
+        if self.closed:
+            return False
+        self.frames.append(frame)
+        self.queued += 1
+        self.ready.set()
+        return True
+
+    async def get(self):
+        """Return the oldest frame, or None once the queue is closed and empty."""
+        while not self.frames:
+            if self.closed:
+                return None
+            self.ready.clear()
+            await self.ready.wait()
+        frame = self.frames.popleft()
+        self.space.set()
+        return frame
+
+    def close(self):
+        self.closed = True
+        self.ready.set()
+        self.space.set()
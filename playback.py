@@ -0,0 +1,128 @@
+"""
+Serves a recording through RX_Node, so clients can be developed and load tested
+against real captures without a radio.
+
+    python playback.py --playback_file recordings/capture-0000.sigmf-data --playback_mode fast --playback_loop
+
+Takes the same options as server.py (conf/server/default.ini is read as well).
+SigMF recordings bring their own sample rate and center frequency; raw files
+(.bin from FileSaver, .cf32 from BurstRecorder) are complex64 at --rx_sample_rate.
+"""
+import json
+import os
+import sys
+import time
+
+import numpy as np
+from loguru import logger
+
+import protocol
+import server
+from pipeline import Frame
+
+
+SIGMF_DTYPES = {'cf32_le': np.dtype(np.complex64), 'ci16_le': protocol.SC16}
+
+
+class Playback(server.RX_Source):
+    """
+    Stands in for Transceiver on the RX side. Frames are read-only slices of the memory
+    mapped file, handed to the node without a copy, so they stay valid for as long as
+    anyone holds them. realtime paces frames at the recorded sample rate, otherwise
+    they go out as fast as the clients take them, and clients get the block policy
+    unless they ask for another. Playback starts with the first client. With loop the
+    file starts over at the end, else the node shuts down once clients have drained
+    their queues.
+    """
+    # Slices of the file stay valid, a client may take as long as it likes to send one
+    reuses_frames = False
+    
+    def __init__(self, args):
+        super().__init__(args)
+        self.path = args.playback_file
+        self.realtime = args.playback_mode == 'realtime'
+        self.loop = args.playback_loop
+        if not self.realtime:
+            # Fast playback outruns every client, so a dropping default would lose most of the file
+            self.rx_overflow_policy = 'block'
+
+        dtype = np.dtype(np.complex64)
+        data_path = self.path
+        self.start_time = 0.0
+        base, ext = os.path.splitext(self.path)
+        if ext in ('.sigmf-data', '.sigmf-meta'):
+            data_path = base + '.sigmf-data'
+            with open(base + '.sigmf-meta') as f:
+                meta = json.load(f)
+            dtype = SIGMF_DTYPES[meta['global']['core:datatype']]
+            self.rx_sample_rate = meta['global'].get('core:sample_rate', self.rx_sample_rate)
+            if meta.get('captures'):
+                capture = meta['captures'][0]
+                self.rx_center_freq = capture.get('core:frequency', self.rx_center_freq)
+                self.rx_gain = capture.get('uhd:rx_gain', self.rx_gain)
+                self.start_time = capture.get('uhd:device_time', 0.0)
+        # Recordings hold one channel
+        self.rx_device_channels = [0]
+        self.rx_center_freqs = [self.rx_center_freq]
+        self.rx_gains = [self.rx_gain]
+        self.rx_cpu_format = 'sc16' if dtype == protocol.SC16 else 'fc32'
+        # A plain ndarray over the mapping, so slices are views and not memmap instances
+        self.samples = np.memmap(data_path, dtype=dtype, mode='r').view(np.ndarray)
+        if len(self.samples) == 0:
+            raise ValueError(f"{data_path} holds no samples")
+        self.position = 0
+        self.played = 0
+        self.started = None
+        logger.info(f"Playing {data_path}: {len(self.samples)} samples of {self.rx_cpu_format} at {self.rx_sample_rate / 1e6:g} Msps"
+                    f" ({'realtime' if self.realtime else 'fast'}{', looped' if self.loop else ''})")
+
+        self.serve_metrics(args.metrics_port)
+
+    def start_streaming(self):
+        # Nobody would see the start of the file otherwise
+        logger.info("Playback starts when the first client connects")
+        while not self.rx_node.clients and not self.rx_node.kill_rx.is_set():
+            time.sleep(0.01)
+        self.started = time.perf_counter()
+        self.played = 0
+
+    def stop_streaming(self):
+        pass
+
+    def read_frame(self):
+        """Next frame of the file. Raises EOFError at the end of a file that doesn't loop."""
+        if self.position >= len(self.samples):
+            if not self.loop:
+                raise EOFError(self.path)
+            self.position = 0
+        stop = min(self.position + self.num_samps, len(self.samples))
+        data = self.samples[self.position:stop]
+        timestamp = self.start_time + self.position / self.rx_sample_rate
+        self.position = stop
+        self.played += len(data)
+        if self.realtime:
+            # A frame is due once its last sample would have been captured
+            wait = self.started + self.played / self.rx_sample_rate - time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
+        self.frame_seq += 1
+        self.rx_frames.inc()
+        self.rx_samples.inc(len(data))
+        return Frame(self.frame_seq, timestamp, time.time(), data)
+
+
+def main():
+    parser = server.build_parser()
+    parser.add('--playback_file', type=str, required=True, help="Recording to serve. SigMF (.sigmf-data/.sigmf-meta) or raw complex64")
+    parser.add('--playback_mode', choices=['realtime', 'fast'], default='realtime', help="Pace frames at the recorded sample rate, or send as fast as clients take them")
+    parser.add('--playback_loop', action='store_true', help="Start over at the end of the file")
+    args = parser.parse_args()
+
+    logger.remove()
+    logger.add(sys.stderr, level="DEBUG") if args.verbose else logger.add(sys.stderr, level="INFO")
+
+    Playback(args).start_rx_node_forever()
+
+
+if __name__ == "__main__":
+    main()
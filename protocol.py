@@ -0,0 +1,183 @@
+"""
+Connection handshake, frame protocol and sample format helpers shared by server.py and client.py.
+
+Right after connecting a client sends a hello message listing what it understands,
+and the server answers with what it picked. Messages are MAGIC, a big endian uint32
+length and a JSON body. Clients that send nothing (older clients) get the legacy
+stream after HELLO_TIMEOUT, and older servers never answer, which the client notices
+because their first bytes are not MAGIC.
+
+After the handshake each frame is a fixed FRAME_HEADER followed by the raw sample
+buffer, sent without copying the samples (send_frame, or the transport's writelines
+on the server) and received with recv_into a reusable buffer.
+Peers that don't negotiate the 'frame' protocol fall back to NumpySocket messages.
+"""
+import asyncio
+import json
+import socket
+import struct
+from io import BytesIO
+from collections import namedtuple
+
+import numpy as np
+
+
+MAGIC = b'UHDT'
+HEADER = struct.Struct('!4sI')
+HELLO_TIMEOUT = 0.5
+
+# Complex int16 samples as the radio delivers them with the "sc16" cpu format
+SC16 = np.dtype([('i', np.int16), ('q', np.int16)])
+SC16_SCALE = np.float32(1 / 32768)
+FORMATS = {'fc32': np.dtype(np.complex64), 'sc16': SC16}
+
+FRAME_MAGIC = b'UHDF'
+FRAME_VERSION = 1
+# magic, version, dtype code, channels, samples per channel, sequence number,
+# device time of the first sample, host wall clock time the frame was captured
+FRAME_HEADER = struct.Struct('!4sBBHIQdd')
+DTYPE_CODES = {1: np.dtype(np.complex64), 2: SC16, 3: np.dtype(np.float32)}
+CODES = {dtype: code for code, dtype in DTYPE_CODES.items()}
+PROTOCOLS = ('frame', 'npy')
+
+FrameHeader = namedtuple('FrameHeader', 'dtype channels count seq timestamp capture_time')
+
+
+def sc16_to_fc32(data, out=None):
+    """Scale interleaved int16 I/Q (SC16 or int16 pairs) to complex64 in one vectorized pass."""
+    iq = data.view(np.int16)
+    if out is None:
+        out = np.empty(iq.shape[:-1] + (iq.shape[-1] // 2,), dtype=np.complex64)
+    np.multiply(iq, SC16_SCALE, out=out.view(np.float32))
+    return out
+
+
+def recv_into_exactly(sock, view):
+    """Fill view from the socket. Returns False if the peer closed the connection first."""
+    received = 0
+    size = len(view)
+    while received < size:
+        count = socket.socket.recv_into(sock, view[received:])
+        if count == 0:
+            return False
+        received += count
+    return True
+
+
+def recv_exactly(sock, size):
+    """Read exactly size bytes with the plain socket recv (NumpySocket overrides recv)."""
+    buffer = bytearray(size)
+    if not recv_into_exactly(sock, memoryview(buffer)):
+        raise ConnectionResetError("Connection closed during handshake")
+    return bytes(buffer)
+
+
+def pack_message(message):
+    body = json.dumps(message).encode()
+    return HEADER.pack(MAGIC, len(body)) + body
+
+
+def send_message(sock, message):
+    socket.socket.sendall(sock, pack_message(message))
+
+
+def recv_message(sock):
+    magic, length = HEADER.unpack(recv_exactly(sock, HEADER.size))
+    if magic != MAGIC:
+        raise ValueError(f"Bad handshake magic {magic}")
+    return json.loads(recv_exactly(sock, length))
+
+
+def peek_magic(sock):
+    """True if the next bytes on the socket are a handshake message. Nothing is consumed."""
+    head = socket.socket.recv(sock, len(MAGIC), socket.MSG_PEEK | socket.MSG_WAITALL)
+    return head == MAGIC
+
+
+async def read_hello(reader, timeout=HELLO_TIMEOUT):
+    """Server side: return the client's hello, or None for a legacy client that sent nothing."""
+    try:
+        magic, length = HEADER.unpack(await asyncio.wait_for(reader.readexactly(HEADER.size), timeout))
+    except asyncio.TimeoutError:
+        return None
+    if magic != MAGIC:
+        raise ValueError(f"Bad handshake magic {magic}")
+    return json.loads(await reader.readexactly(length))
+
+
+def request_stream(sock, **hello):
+    """Client side: send hello and return the server's reply, or None if the server predates the handshake."""
+    send_message(sock, hello)
+    if not peek_magic(sock):
+        return None
+    return recv_message(sock)
+
+
+def pack_frame(data, seq, timestamp=0.0, capture_time=0.0):
+    """Return the frame header and a byte view of the samples. Nothing is copied."""
+    channels, count = (1, data.shape[-1]) if data.ndim == 1 else data.shape
+    header = FRAME_HEADER.pack(FRAME_MAGIC, FRAME_VERSION, CODES[data.dtype], channels, count, seq, timestamp, capture_time)
+    return header, memoryview(data.reshape(-1).view(np.uint8))
+
+
+def pack_npy(data):
+    """Encode data the way NumpySocket.sendall does, for peers on the legacy protocol."""
+    f = BytesIO()
+    np.savez(f, frame=data)
+    return f'{f.getbuffer().nbytes}:'.encode() + f.getvalue()
+
+
+def send_frame(sock, data, seq, timestamp=0.0, capture_time=0.0):
+    """Send header and samples with scatter-gather sendmsg, without copying the samples."""
+    header, payload = pack_frame(data, seq, timestamp, capture_time)
+    buffers = [memoryview(header), payload]
+    while buffers:
+        sent = sock.sendmsg(buffers)
+        # Drop whatever went out. Blocking sockets normally send everything at once
+        while buffers and sent >= len(buffers[0]):
+            sent -= len(buffers[0])
+            buffers.pop(0)
+        if buffers:
+            buffers[0] = buffers[0][sent:]
+
+
+class FrameReader():
+    """
+    Receives frames with recv_into a buffer that is reused for every frame, so the
+    returned array is only valid until the next read().
+    """
+    def __init__(self, sock):
+        self.sock = sock
+        self.header_buffer = bytearray(FRAME_HEADER.size)
+        self.buffer = np.empty(0, dtype=np.uint8)
+        self.header = None
+
+    def read_header(self):
+        """Read the next frame header, or return None once the peer closed the connection."""
+        if not recv_into_exactly(self.sock, memoryview(self.header_buffer)):
+            return None
+        magic, version, code, channels, count, seq, timestamp, capture_time = FRAME_HEADER.unpack(self.header_buffer)
+        if magic != FRAME_MAGIC or version != FRAME_VERSION:
+            raise ValueError(f"Bad frame header {magic} version {version}")
+        self.header = FrameHeader(DTYPE_CODES[code], channels, count, seq, timestamp, capture_time)
+        return self.header
+
+    def read_payload(self, header, buffer=None):
+        """Receive the samples that follow header into buffer (uint8, large enough) or the reusable buffer."""
+        nbytes = header.channels * header.count * header.dtype.itemsize
+        if buffer is None:
+            if self.buffer.nbytes < nbytes:
+                self.buffer = np.empty(nbytes, dtype=np.uint8)
+            buffer = self.buffer
+        payload = buffer[:nbytes]
+        if not recv_into_exactly(self.sock, memoryview(payload)):
+            return np.array([])
+        data = payload.view(header.dtype)
+        return data if header.channels == 1 else data.reshape(header.channels, header.count)
+
+    def read(self):
+        """Return the next frame, or an empty array once the peer closed the connection."""
+        header = self.read_header()
+        if header is None:
+            return np.array([])
+        return self.read_payload(header)
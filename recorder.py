@@ -0,0 +1,333 @@
+"""
+Recorders that save the RX stream to disk.
+
+    python recorder.py --mode bursts --out bursts --pre 0.01 --post 0.01 --threshold_db 10
+    python recorder.py --mode stream --out recordings --segment_mb 1024 --segment_seconds 600
+
+BurstRecorder keeps the last few seconds in memory and only writes bursts the
+detector finds, with some history before and after each one. Bursts are appended
+to one data file (complex64, the SigMF cf32_le layout) and described one JSON
+line each in index.jsonl. Memory stays fixed and the disk only grows with bursts.
+
+SigMFRecorder keeps everything, as rotating SigMF recordings.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from collections import deque
+from datetime import datetime, timezone
+
+import numpy as np
+from loguru import logger
+
+import dsp
+import protocol
+from client import Sampler
+
+
+SIGMF_DATATYPES = {np.dtype(np.complex64): 'cf32_le', protocol.SC16: 'ci16_le'}
+
+
+class SampleHistory():
+    """Circular buffer of the last capacity samples, addressed by absolute sample index."""
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.buffer = np.zeros(capacity, dtype=np.complex64)
+        # Absolute index one past the newest sample
+        self.end = 0
+
+    def start(self):
+        """Absolute index of the oldest sample still held."""
+        return max(self.end - self.capacity, 0)
+
+    def append(self, data):
+        n = len(data)
+        if n > self.capacity:
+            self.end += n - self.capacity
+            data = data[n - self.capacity:]
+            n = self.capacity
+        pos = self.end % self.capacity
+        first = min(n, self.capacity - pos)
+        self.buffer[pos:pos + first] = data[:first]
+        self.buffer[:n - first] = data[first:]
+        self.end += n
+
+    def read(self, start, stop):
+        """Views of samples [start, stop), clipped to what is held. One or two parts when it wraps."""
+        start = max(start, self.start())
+        stop = min(stop, self.end)
+        if stop <= start:
+            return []
+        pos = start % self.capacity
+        count = stop - start
+        if pos + count <= self.capacity:
+            return [self.buffer[pos:pos + count]]
+        return [self.buffer[pos:], self.buffer[:pos + count - self.capacity]]
+
+
+class BurstRecorder(Sampler):
+    """
+    Writes every burst the detector reports plus pre seconds before and post seconds
+    after it. Runs unattended: memory is the history ring (history seconds) and a
+    few pending bursts, and each burst is on disk, flushed, as soon as its post
+    trigger samples have arrived. Bursts longer than the history lose their start.
+    """
+    def __init__(self, addr, directory='bursts', pre=0.01, post=0.01, history=2.0, threshold_db=10.0, window=64):
+        super().__init__(addr)
+        # Servers without the handshake don't say, assume the defaults
+        self.sample_rate = self.stream_info.get('sample_rate', 2e6)
+        self.center_freq = self.stream_info.get('center_freq', 0.0)
+        self.pre = int(pre * self.sample_rate)
+        self.post = int(post * self.sample_rate)
+        self.history = SampleHistory(int(history * self.sample_rate))
+        self.detector = dsp.BurstDetector(window=window, threshold_db=threshold_db)
+        # (absolute index, device time, host time) of the first sample of each held frame
+        self.frame_times = deque()
+        self.waiting = deque()
+        self.recorded = 0
+
+        os.makedirs(directory, exist_ok=True)
+        self.data_path = os.path.join(directory, 'bursts.cf32')
+        self.data_file = open(self.data_path, 'ab')
+        self.index_file = open(os.path.join(directory, 'index.jsonl'), 'a')
+        logger.info(f"Recording bursts to {directory}")
+
+    def times(self, index):
+        """Device and host time of an absolute sample index, from the frame it belongs to."""
+        frame_index, device_time, host_time = self.frame_times[0]
+        for entry in self.frame_times:
+            if entry[0] > index:
+                break
+            frame_index, device_time, host_time = entry
+        offset = (index - frame_index) / self.sample_rate
+        return device_time + offset, host_time + offset
+
+    def frequency(self, burst):
+        """Frequency of the strongest FFT bin of the burst (Hz)."""
+        parts = self.history.read(burst.start, burst.stop)
+        samples = np.concatenate(parts)[:1 << 16] if parts else np.zeros(1, dtype=np.complex64)
+        spectrum = np.abs(np.fft.fft(samples))
+        offset = np.fft.fftfreq(len(samples), 1 / self.sample_rate)[np.argmax(spectrum)]
+        return self.center_freq + float(offset)
+
+    def write(self, burst):
+        start = max(burst.start - self.pre, self.history.start())
+        stop = min(burst.stop + self.post, self.history.end)
+        # Only a burst whose own start was overwritten lost anything. Near the start of the
+        # stream the pre trigger samples were simply never there
+        if burst.start < self.history.start():
+            logger.warning(f"Burst at sample {burst.start} outgrew the history, its start is lost")
+        offset = self.data_file.tell()
+        for part in self.history.read(start, stop):
+            self.data_file.write(part)
+        self.data_file.flush()
+        device_time, host_time = self.times(start)
+        record = {
+            'offset': offset // np.dtype(np.complex64).itemsize,
+            'samples': stop - start,
+            'trigger': burst.start - start,
+            'burst_samples': burst.stop - burst.start,
+            'device_time': device_time,
+            'host_time': host_time,
+            'sample_rate': self.sample_rate,
+            'center_freq': self.center_freq,
+            'frequency': self.frequency(burst),
+            'power_db': burst.power_db,
+            'peak_db': burst.peak_db,
+            'snr_db': burst.snr_db,
+        }
+        self.index_file.write(json.dumps(record) + '\n')
+        self.index_file.flush()
+        self.recorded += 1
+        logger.debug(f"Recorded burst {self.recorded}: {record['burst_samples']} samples, SNR {burst.snr_db:.1f} dB")
+
+    def loop_func(self, data):
+        index = self.history.end
+        if self.header is not None:
+            self.frame_times.append((index, self.header.timestamp, self.header.capture_time))
+        else:
+            self.frame_times.append((index, 0.0, time.time()))
+        while len(self.frame_times) > 1 and self.frame_times[1][0] <= self.history.start():
+            self.frame_times.popleft()
+        self.history.append(data)
+        self.waiting.extend(self.detector.process(data))
+        while self.waiting and self.waiting[0].stop + self.post <= self.history.end:
+            self.write(self.waiting.popleft())
+
+    def loop_exit(self):
+        # Whatever post trigger history there is
+        while self.waiting:
+            self.write(self.waiting.popleft())
+        self.data_file.close()
+        self.index_file.close()
+        logger.info(f"Recorded {self.recorded} bursts to {self.data_path}")
+
+
+def iso_time(secs):
+    return datetime.fromtimestamp(secs, timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+
+class SigMFRecorder(Sampler):
+    """
+    Streams the whole capture to SigMF recordings. With the frame protocol every frame
+    is received straight into a memory mapped, preallocated segment file, so samples
+    go from the socket to the page cache without another copy, and the data is on
+    disk as it arrives. sc16 streams are stored as they travel (ci16_le), at half the
+    size. A new segment starts when the current one is full (segment_mb) or older
+    than segment_seconds. Each segment's .sigmf-meta is written when it opens and
+    rewritten as captures are added: one at the start and one after every gap.
+    next() returns frames as stored, sc16 included, and they stay valid.
+    """
+    def __init__(self, addr, directory='recordings', segment_mb=1024, segment_seconds=0, prefix='capture'):
+        super().__init__(addr, formats=('sc16', 'fc32'))
+        self.sample_rate = self.stream_info.get('sample_rate', 2e6)
+        self.center_freq = self.stream_info.get('center_freq', 0.0)
+        self.gain = self.stream_info.get('gain')
+        self.directory = directory
+        self.prefix = prefix
+        self.segment_bytes = int(segment_mb * 2**20)
+        self.segment_seconds = segment_seconds
+        self.segment_index = -1
+        self.segment = None
+        self.position = 0
+        self.recorded = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def open_segment(self, dtype, nbytes):
+        self.segment_index += 1
+        self.base = os.path.join(self.directory, f"{self.prefix}-{self.segment_index:04d}")
+        size = max(self.segment_bytes // nbytes, 1) * nbytes
+        # Sparse until written, so preallocating costs no disk time
+        self.segment = np.memmap(self.base + '.sigmf-data', dtype=np.uint8, mode='w+', shape=(size,))
+        self.dtype = dtype
+        self.position = 0
+        self.opened = time.time()
+        self.captures = []
+        logger.info(f"Recording to {self.base}.sigmf-data")
+
+    def close_segment(self):
+        if self.segment is None:
+            return
+        self.segment.flush()
+        # Frames handed out are views of the mapping. It goes away with the last of them,
+        # and truncating keeps every byte they cover in the file
+        self.segment = None
+        os.truncate(self.base + '.sigmf-data', self.position)
+        self.write_meta()
+        logger.debug(f"Closed {self.base} with {self.position // self.dtype.itemsize} samples")
+
+    def write_meta(self):
+        meta = {
+            'global': {
+                'core:datatype': SIGMF_DATATYPES[self.dtype],
+                'core:sample_rate': self.sample_rate,
+                'core:version': '1.0.0',
+                'core:num_channels': 1,
+                'core:recorder': 'UHD_Transceiver recorder.py',
+            },
+            'captures': self.captures,
+            'annotations': [],
+        }
+        # Written to a temporary file first so a crash never leaves a truncated meta file
+        with open(self.base + '.sigmf-meta.tmp', 'w') as f:
+            json.dump(meta, f, indent=2)
+        os.replace(self.base + '.sigmf-meta.tmp', self.base + '.sigmf-meta')
+
+    def add_capture(self, header):
+        count = header.count if header is not None else 0
+        capture_time = header.capture_time if header is not None else time.time()
+        capture = {
+            'core:sample_start': self.position // self.dtype.itemsize,
+            'core:frequency': self.center_freq,
+            # capture_time stamps the end of the frame
+            'core:datetime': iso_time(capture_time - count / self.sample_rate),
+        }
+        if header is not None:
+            capture['uhd:device_time'] = header.timestamp
+        if self.gain is not None:
+            capture['uhd:rx_gain'] = self.gain
+        self.captures.append(capture)
+        self.write_meta()
+
+    def reserve(self, dtype, nbytes, header=None, gap=False):
+        """Byte view of the segment where the next nbytes go, rotating first if needed."""
+        rotate = (self.segment is None or dtype != self.dtype or self.position + nbytes > len(self.segment)
+                  or (self.segment_seconds and time.time() - self.opened > self.segment_seconds))
+        if rotate:
+            self.close_segment()
+            self.open_segment(dtype, nbytes)
+        if rotate or gap:
+            self.add_capture(header)
+        return self.segment[self.position:self.position + nbytes]
+
+    def next(self):
+        if self.reader is None:
+            # NumpySocket messages can't be received in place, copy them in instead
+            data = super().next()
+            if len(data):
+                self.reserve(data.dtype, data.nbytes)[:] = data.view(np.uint8)
+                self.position += data.nbytes
+                self.recorded += len(data)
+            return data
+        header = self.reader.read_header()
+        if header is None:
+            return np.array([])
+        gap = self.header is not None and header.seq != self.header.seq + 1
+        if gap:
+            self.skipped += header.seq - self.header.seq - 1
+        self.header = header
+        nbytes = header.channels * header.count * header.dtype.itemsize
+        data = self.reader.read_payload(header, self.reserve(header.dtype, nbytes, header, gap))
+        if len(data):
+            self.position += nbytes
+            self.recorded += header.count
+        return data
+
+    def frames(self, batch=None, pool=3, copy=False):
+        """
+        Frames are received into the segment instead of a buffer pool, so they stay valid
+        and pool is ignored. Batches would need a copy out of the segment, so there are none.
+        """
+        if batch:
+            raise ValueError("SigMFRecorder yields single frames")
+        while True:
+            data = self.next()
+            if len(data) == 0:
+                break
+            yield data.copy() if copy else data
+
+    def loop_exit(self):
+        self.close_segment()
+        logger.info(f"Recorded {self.recorded} samples in {self.segment_index + 1} segment(s), {self.skipped} frames lost")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Record the RX stream of UHD_Transceiver to disk")
+    parser.add_argument('--remote', type=str, default='', help="Remote address of UHD_Transceiver server")
+    parser.add_argument('--port', type=int, default=12345, help="Remote port of UHD_Transceiver server")
+    parser.add_argument('--mode', choices=['bursts', 'stream'], default='bursts', help="Record only detected bursts or the whole stream as SigMF")
+    parser.add_argument('--out', type=str, default='recordings', help="Output directory")
+    parser.add_argument('--pre', type=float, default=0.01, help="Seconds recorded before each burst")
+    parser.add_argument('--post', type=float, default=0.01, help="Seconds recorded after each burst")
+    parser.add_argument('--history', type=float, default=2.0, help="Seconds of stream held in memory")
+    parser.add_argument('--threshold_db', type=float, default=10.0, help="Detection threshold above the noise floor (dB)")
+    parser.add_argument('--segment_mb', type=float, default=1024, help="Size of each SigMF segment file (MiB)")
+    parser.add_argument('--segment_seconds', type=float, default=0, help="Start a new SigMF segment after this many seconds. 0 rotates by size only")
+    parser.add_argument('--verbose', '-v', action='store_true', help="Enable verbose mode")
+    args = parser.parse_args()
+
+    logger.remove()
+    logger.add(sys.stderr, level="DEBUG") if args.verbose else logger.add(sys.stderr, level="INFO")
+
+    server_addr = (args.remote, args.port) if args.remote else ('localhost', args.port)
+    if args.mode == 'bursts':
+        recorder = BurstRecorder(server_addr, args.out, args.pre, args.post, args.history, args.threshold_db)
+    else:
+        recorder = SigMFRecorder(server_addr, args.out, args.segment_mb, args.segment_seconds)
+    recorder.loop()
+
+
+if __name__ == "__main__":
+    main()
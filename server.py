@@ -1,158 +1,1255 @@
+import asyncio
+import concurrent.futures
 import configparser
+import heapq
 import socket
 import threading
+import time
 import numpy as np
 import sys, os
 
-import uhd
 from loguru import logger
 
 from IPython import embed
 
-from numpysocket import NumpySocket
+import dsp
+import metrics
+import protocol
+import waveforms
+from pipeline import AsyncFrameQueue, Frame, FrameQueue
 
 import configargparse
 
+import sim_uhd
 
-class Transceiver():
+try:
+    import uhd
+except ImportError:
+    # Only needed for --device uhd. The simulated backend runs without the UHD bindings.
+    uhd = None
+
+# asyncio socket transports send writelines() buffers with one sendmsg call, without joining them
+WRITELINES_SENDMSG = sys.version_info >= (3, 12)
+
+
+def load_backend(device):
+    """Return the module providing usrp/types for the requested device backend."""
+    if device == 'sim':
+        return sim_uhd
+    if uhd is None:
+        raise RuntimeError("UHD python bindings are not installed. Use --device sim to run without a radio.")
+    return uhd
+
+def per_channel(values, default, channels, name):
+    """One value per channel: values as given, or default for every channel."""
+    if not values:
+        return [default] * len(channels)
+    if len(values) != len(channels):
+        raise ValueError(f"{name} needs one value per channel in rx_device_channels {channels}, got {values}")
+    return list(values)
+
+
+class RX_Source():
+    """
+    RX settings, metrics and node handling shared by the frame sources RX_Node serves
+    from (Transceiver and playback.Playback). A source adds start_streaming,
+    stop_streaming and read_frame.
+    """
+    # Frames are slots of a ring that capture overwrites, so clients may only hold them for a while
+    reuses_frames = True
+    
     def __init__(self, args):
-        self.tx_sample_rate = args.tx_sample_rate
-        self.tx_center_freq = args.tx_center_freq
-        self.tx_channel_freq = args.tx_channel_freq
-        # self.tx_antenna = args.tx_antenna
-        self.tx_gain = args.tx_gain
-        
         self.rx_sample_rate = args.rx_sample_rate
         self.rx_center_freq = args.rx_center_freq
         self.rx_channel_freq = args.rx_channel_freq
         # self.rx_antenna = args.rx_antenna
         self.rx_gain = args.rx_gain
+        # Device channels captured together, one row each. Per channel tuning defaults to
+        # rx_center_freq and rx_gain
+        self.rx_device_channels = args.rx_device_channels
+        self.rx_center_freqs = per_channel(args.rx_center_freqs, self.rx_center_freq, self.rx_device_channels, 'rx_center_freqs')
+        self.rx_gains = per_channel(args.rx_gains, self.rx_gain, self.rx_device_channels, 'rx_gains')
+        self.rx_cpu_format = args.rx_cpu_format
+        self.rx_decimation = args.rx_decimation
+        self.rx_channels = args.rx_channels
+        self.spectrum = {
+            'fft_size': args.spectrum_fft_size,
+            'overlap': args.spectrum_overlap,
+            'window': args.spectrum_window,
+            'averages': args.spectrum_averages,
+        }
         
         self.remote = args.remote
         self.rx_port = args.rx_port
+        self.rx_queue_frames = args.rx_queue_frames
+        self.rx_overflow_policy = args.rx_overflow_policy
+        self.ring_frames = args.rx_ring_frames
+        # Samples per frame. A frame leaves the server only once it is full, so this sets the
+        # latency floor (frame_samps / rx_sample_rate) and the per-frame overhead
+        self.num_samps = args.rx_frame_samps
+        self.frame_seq = -1
+        
+        self.metrics = metrics.Registry()
+        self.rx_frames = self.metrics.counter('uhd_rx_frames_total', "Frames captured")
+        self.rx_samples = self.metrics.counter('uhd_rx_samples_total', "Samples captured")
+        self.metrics.rate('uhd_rx_frames_per_second', "Frames captured per second since the previous scrape", self.rx_frames)
+        self.client_send_latency = self.metrics.histogram('uhd_rx_client_send_seconds', "Time to write and drain one frame to an RX client")
+        self.frame_latency = self.metrics.histogram('uhd_rx_frame_latency_seconds', "Time from a frame's capture until it was drained to an RX client")
+        
+    def serve_metrics(self, port):
+        """Serve the registry once the source has registered all of its metrics."""
+        if port:
+            self.metrics.serve('0.0.0.0' if self.remote else '127.0.0.1', port)
+            logger.info(f"Serving metrics on port {port}")
+        
+    def start_rx_node(self):
+        self.rx_node = RX_Node(self)
+        self.rx_node.start()
+        
+    def start_rx_node_forever(self):
+        # One node serves every client, so there is nothing to restart between connections
+        self.start_rx_node()
+        try:
+            while self.rx_node.is_alive():
+                self.rx_node.join(0.5)
+        except KeyboardInterrupt as e:
+            logger.info("Keyboard interrupt hit. Stopping rx_node")
+            self.rx_node.stop()
+            self.rx_node.join()
+            
+    def stop_rx_node(self):
+        self.rx_node.stop()
+        
         
-        self.usrp = uhd.usrp.MultiUSRP()
-        self.stream_args = uhd.usrp.StreamArgs("fc32", "sc16")
+class Transceiver(RX_Source):
+    def __init__(self, args):
+        super().__init__(args)
+        self.tx_sample_rate = args.tx_sample_rate
+        self.tx_center_freq = args.tx_center_freq
+        self.tx_channel_freq = args.tx_channel_freq
+        # self.tx_antenna = args.tx_antenna
+        self.tx_gain = args.tx_gain
+        
+        self.tx_port = args.tx_port
+        self.tx_queue_frames = args.tx_queue_frames
+        self.tx_prefill_frames = args.tx_prefill_frames
+        
+        self.uhd = load_backend(args.device)
+        self.usrp = self.uhd.usrp.MultiUSRP(args.device_args)
+        self.stream_args = self.uhd.usrp.StreamArgs("fc32", "sc16")
         self.usrp.set_tx_rate(self.tx_sample_rate)
         self.usrp.set_tx_freq(self.tx_center_freq)
         self.usrp.set_tx_gain(self.tx_gain)
         # TODO: Add antenna selection with self.tx_antenna
         self.tx_streamer = self.usrp.get_tx_stream(self.stream_args)
-        self.tx_metadata = uhd.types.TXMetadata()
+        # Empty send that ends a burst. send wants one row per streamer channel, even for no samples
+        self.tx_end_of_burst = np.zeros((self.tx_streamer.get_num_channels(), 0), dtype=np.complex64)
+        self.tx_metadata = self.uhd.types.TXMetadata()
+        self.waveforms = waveforms.WaveformCache(int(args.tx_cache_mb * 2**20))
+        self.tx_replay = None
+        self.rx_start_delay = args.rx_start_delay
+        # Extra timeout for the first recv after start_streaming
+        self.rx_start_wait = 0.0
+        self.schedule_lead = args.schedule_lead
+        self.scheduler = None
         
-        self.usrp.set_rx_rate(self.rx_sample_rate, 0)
-        self.usrp.set_rx_freq(uhd.libpyuhd.types.tune_request(self.rx_center_freq), 0)
-        self.usrp.set_rx_gain(self.rx_gain, 0)
+        for chan, freq, gain in zip(self.rx_device_channels, self.rx_center_freqs, self.rx_gains):
+            self.usrp.set_rx_rate(self.rx_sample_rate, chan)
+            self.usrp.set_rx_freq(self.uhd.libpyuhd.types.tune_request(freq), chan)
+            self.usrp.set_rx_gain(gain, chan)
 
-        st_args = uhd.usrp.StreamArgs("fc32", "sc16")
-        st_args.channels = [0]
-        self.rx_metadata = uhd.types.RXMetadata()
+        # One streamer for all channels, so one recv fills every row of a chunk and the
+        # channels stay sample aligned
+        st_args = self.uhd.usrp.StreamArgs(self.rx_cpu_format, "sc16")
+        st_args.channels = list(self.rx_device_channels)
+        self.rx_metadata = self.uhd.types.RXMetadata()
         self.rx_streamer = self.usrp.get_rx_stream(st_args)
 
         
         
-        self.buffer_size = 2000
-        self.recv_buffer = np.zeros((1, self.buffer_size), np.complex64)
-        self.num_samps = 64000
-        self.samples = np.zeros(64000, dtype=np.complex64)
+        # Samples asked for per recv call. 0 lets one call fill the rest of the frame
+        self.chunk_samps = args.rx_chunk_samps or self.num_samps
+        # Frames are received straight into this ring. read() hands out read-only views of
+        # its slots, so a frame stays valid until the ring wraps around ring_frames reads later.
+        # A slot is (channels, samples). With one channel the view is the plain row.
+        self.ring = np.zeros((self.ring_frames, len(self.rx_device_channels), self.num_samps), dtype=protocol.FORMATS[self.rx_cpu_format])
+        self.ring_views = [self.readonly(slot[0] if len(slot) == 1 else slot) for slot in self.ring]
+        self.ring_index = 0
+        # recv only writes into C-contiguous buffers. A column range of several rows isn't
+        # one, so chunks of multi-channel frames are received here and copied into the slot
+        self.rx_staging = np.empty(len(self.rx_device_channels) * self.chunk_samps, dtype=self.ring.dtype)
+        self.frame_timestamp = 0.0
+        self.frame_capture_time = 0.0
+        
+        self.rx_chunks = self.metrics.counter('uhd_rx_chunks_total', "recv calls on the RX streamer")
+        self.rx_errors = self.metrics.counter('uhd_rx_errors_total', "RX metadata errors per recv call, by error code (overflow, timeout, late, ...)")
+        self.rx_recv_latency = self.metrics.histogram('uhd_rx_recv_seconds', "Time spent in one recv call")
+        self.tx_samples = self.metrics.counter('uhd_tx_samples_total', "Samples handed to the TX streamer")
+        self.tx_send_latency = self.metrics.histogram('uhd_tx_send_seconds', "Time spent in one TX send call")
+        self.serve_metrics(args.metrics_port)
+        
+    @staticmethod
+    def readonly(array):
+        view = array.view()
+        view.flags.writeable = False
+        return view
+        
+    def recv(self, buffer, metadata, timeout=0.1):
+        """rx_streamer.recv with per-chunk accounting."""
+        toc = time.perf_counter()
+        received = self.rx_streamer.recv(buffer, metadata, timeout)
+        self.rx_recv_latency.observe(time.perf_counter() - toc)
+        self.rx_chunks.inc()
+        if metadata.error_code != self.uhd.types.RXMetadataErrorCode.none:
+            self.rx_errors.labels(code=getattr(metadata.error_code, 'name', str(metadata.error_code))).inc()
+        return received
+    
+    def recv_into(self, frame, start, metadata, timeout=0.1, staging=None):
+        """
+        recv up to chunk_samps samples into frame[:, start:] of a (channels, samples) frame.
+        Non-contiguous targets go through staging (rx_staging by default).
+        """
+        count = min(self.chunk_samps, frame.shape[1] - start)
+        target = frame[:, start:start + count]
+        if target.flags.c_contiguous:
+            return self.recv(target, metadata, timeout)
+        staging = self.rx_staging if staging is None else staging
+        chunk = staging[:frame.shape[0] * count].reshape(frame.shape[0], count)
+        received = self.recv(chunk, metadata, timeout)
+        target[:, :received] = chunk[:, :received]
+        return received
+    
+    def tx_send(self, data, metadata, timeout=0.1):
+        """tx_streamer.send with per-call accounting."""
+        toc = time.perf_counter()
+        sent = self.tx_streamer.send(data, metadata, timeout)
+        self.tx_send_latency.observe(time.perf_counter() - toc)
+        self.tx_samples.inc(sent)
+        return sent
         
     def read(self):
-        for i in range(self.num_samps//self.buffer_size):
-            self.rx_streamer.recv(self.recv_buffer, self.rx_metadata)
-            self.samples[i*self.buffer_size:(i+1)*self.buffer_size] = self.recv_buffer[0]
-        if not self.rx_metadata.error_code == uhd.types.RXMetadataErrorCode.none:
-            logger.warning(self.rx_metadata.error_code)
-        return self.samples
+        """
+        Capture the next frame into the ring and return a read-only view of it, or None if
+        the stream timed out before the frame was filled.
+        """
+        slot = self.ring_index
+        frame = self.ring[slot]
+        filled = 0
+        self.frame_timestamp = 0.0
+        while filled < self.num_samps:
+            # The first recv after a timed start also waits out the start delay
+            received = self.recv_into(frame, filled, self.rx_metadata, self.rx_start_wait + 0.1)
+            self.rx_start_wait = 0.0
+            if filled == 0 and received and self.rx_metadata.has_time_spec:
+                self.frame_timestamp = self.rx_metadata.time_spec.get_real_secs()
+            filled += received
+            error_code = self.rx_metadata.error_code
+            if error_code == self.uhd.types.RXMetadataErrorCode.none:
+                continue
+            logger.warning(error_code)
+            if error_code == self.uhd.types.RXMetadataErrorCode.timeout:
+                # Stream is not running. Don't spin on recv, and don't publish a frame that
+                # is partly stale. The slot is reused by the next read
+                return None
+        self.ring_index = (slot + 1) % self.ring_frames
+        self.frame_seq += 1
+        self.frame_capture_time = time.time()
+        self.rx_frames.inc()
+        self.rx_samples.inc(filled)
+        return self.ring_views[slot]
+    
+    def start_streaming(self):
+        stream_cmd = self.uhd.types.StreamCMD(self.uhd.types.StreamMode.start_cont)
+        if self.rx_start_delay > 0:
+            # Start on a known device time instead of whenever the command gets there
+            stream_cmd.stream_now = False
+            stream_cmd.time_spec = self.uhd.types.TimeSpec(self.time_now() + self.rx_start_delay)
+            self.rx_start_wait = self.rx_start_delay
+        else:
+            stream_cmd.stream_now = True
+        self.rx_streamer.issue_stream_cmd(stream_cmd)
         
-    def send(self, data):
-        samps_sent = self.tx_streamer.send(data, self.tx_metadata)
+    def stop_streaming(self):
+        self.rx_streamer.issue_stream_cmd(self.uhd.types.StreamCMD(self.uhd.types.StreamMode.stop_cont))
         
-    def start_rx_node(self):
-        self.rx_node = RX_Node(self)
-        self.rx_node.start()
+    def read_frame(self):
+        """Like read, but with the sequence number and timestamps the frame protocol carries."""
+        data = self.read()
+        if data is None:
+            return None
+        return Frame(self.frame_seq, self.frame_timestamp, self.frame_capture_time, data)
         
-    def start_rx_node_forever(self):
-        try:
-            while True:
-                # TODO: Is creation of new thread inefficient. Can we reuse the same thread.
-                self.rx_node = RX_Node(self)
-                self.rx_node.start()
-                self.rx_node.join()
-        except KeyboardInterrupt as e:
-            # TODO: This needs to be fixed. rx_node is not terminating. Hanging on connect
-            logger.info("Keyboard interrupt hit. This needs to be fixed. rx_node is not terminating. Hanging on connect")
-            self.rx_node.stop()
-            self.rx_node.join()
+    def send(self, data, timeout=0.1):
+        """Transmit data as one complete burst."""
+        self.tx_metadata.has_time_spec = False
+        self.tx_metadata.start_of_burst = True
+        self.tx_metadata.end_of_burst = True
+        return self.tx_send(data, self.tx_metadata, timeout)
+        
+    def time_now(self):
+        """Current device time (s)."""
+        return self.usrp.get_time_now().get_real_secs()
+    
+    def capture_at(self, when, num_samps, seq=0, timeout=0.1):
+        """
+        Capture num_samps samples starting exactly at device time when (s). Returns a
+        Frame, or None if the device rejected the command as late or the capture broke off.
+        """
+        types = self.uhd.types
+        stream_cmd = types.StreamCMD(types.StreamMode.num_done)
+        stream_cmd.num_samps = num_samps
+        stream_cmd.stream_now = False
+        stream_cmd.time_spec = types.TimeSpec(when)
+        self.rx_streamer.issue_stream_cmd(stream_cmd)
+        
+        data = np.zeros((len(self.rx_device_channels), num_samps), dtype=protocol.FORMATS[self.rx_cpu_format])
+        # Own staging buffer, the capture thread may be using rx_staging
+        staging = np.empty(len(self.rx_device_channels) * self.chunk_samps, dtype=data.dtype) if len(data) > 1 else None
+        metadata = types.RXMetadata()
+        timestamp = when
+        filled = 0
+        # The first recv has to wait for the start time
+        recv_timeout = max(when - self.time_now(), 0) + timeout
+        while filled < num_samps:
+            received = self.recv_into(data, filled, metadata, recv_timeout, staging)
+            if filled == 0 and received and metadata.has_time_spec:
+                timestamp = metadata.time_spec.get_real_secs()
+            filled += received
+            recv_timeout = timeout
+            if metadata.error_code != types.RXMetadataErrorCode.none:
+                logger.warning(f"Capture at {when:.6f}: {metadata.error_code}")
+                return None
+        return Frame(seq, timestamp, time.time(), data[0] if len(data) == 1 else data)
+    
+    def send_at(self, when, data, timeout=0.1):
+        """Transmit data as one burst starting at device time when (s)."""
+        metadata = self.uhd.types.TXMetadata()
+        metadata.has_time_spec = True
+        metadata.time_spec = self.uhd.types.TimeSpec(when)
+        metadata.start_of_burst = True
+        metadata.end_of_burst = True
+        # send may block until the device has room, which is up to the start time
+        return self.tx_send(data, metadata, max(when - self.time_now(), 0) + timeout)
+    
+    def start_scheduler(self):
+        self.scheduler = Scheduler(self, self.schedule_lead)
+        self.scheduler.start()
+        return self.scheduler
+    
+    def stop_scheduler(self):
+        if self.scheduler is not None:
+            self.scheduler.stop()
+            self.scheduler = None
+        
+    def tone(self, offset=None, amplitude=0.5):
+        """Cached loopable tone, at tx_channel_freq unless an offset (Hz) is given."""
+        offset = self.tx_channel_freq if offset is None else offset
+        return self.waveforms.get('tone', sample_rate=self.tx_sample_rate, offset=offset, amplitude=amplitude)
+    
+    def fsk(self, bits, symbol_rate, deviation, offset=None, amplitude=0.5, gap=0.0):
+        """Cached FSK burst of bits at tx_channel_freq unless an offset (Hz) is given."""
+        offset = self.tx_channel_freq if offset is None else offset
+        return self.waveforms.get('fsk', sample_rate=self.tx_sample_rate, offset=offset, deviation=deviation,
+                                  symbol_rate=symbol_rate, bits=list(bits), amplitude=amplitude, gap=gap)
+    
+    def send_loop(self, data, repeats=None):
+        """Replay data back to back in the background, repeats times or until stop_loop()."""
+        self.stop_loop()
+        self.tx_replay = TX_Replay(self, data, repeats)
+        self.tx_replay.start()
+        return self.tx_replay
+    
+    def stop_loop(self):
+        if self.tx_replay is not None:
+            self.tx_replay.stop()
+            self.tx_replay.join()
+            self.tx_replay = None
+        
+    def start_tx_node(self):
+        self.tx_node = TX_Node(self)
+        self.tx_node.start()
+        
+    def stop_tx_node(self):
+        self.tx_node.stop()
+        
+        
+class ScheduleWorker(threading.Thread):
+    """Runs queued jobs in start time order, each lead seconds (device time) before it is due."""
+    def __init__(self, transceiver, execute, lead):
+        threading.Thread.__init__(self, daemon=True)
+        self.transceiver = transceiver
+        self.execute = execute
+        self.lead = lead
+        self.jobs = []
+        self.jobs_changed = threading.Condition()
+        self.kill_worker = threading.Event()
+        self.executed = 0
+        self.missed = 0
+        
+    def add(self, when, job_id, *args):
+        with self.jobs_changed:
+            heapq.heappush(self.jobs, (when, job_id, args))
+            self.jobs_changed.notify()
+            
+    def __len__(self):
+        return len(self.jobs)
+        
+    def next_job(self):
+        """Wait for the earliest job to come within lead of its start time and take it off the queue."""
+        with self.jobs_changed:
+            while not self.kill_worker.is_set():
+                if not self.jobs:
+                    self.jobs_changed.wait(0.5)
+                    continue
+                due = self.jobs[0][0] - self.lead - self.transceiver.time_now()
+                if due <= 0:
+                    return heapq.heappop(self.jobs)
+                # A new earlier job wakes us up
+                self.jobs_changed.wait(due)
+        return None
+        
+    def run(self):
+        while True:
+            job = self.next_job()
+            if job is None:
+                break
+            when, job_id, args = job
+            if when < self.transceiver.time_now():
+                # Still handed over, the device reports it as late
+                self.missed += 1
+                logger.warning(f"Scheduled job {job_id} at {when:.6f} is late")
+            self.execute(when, job_id, *args)
+            self.executed += 1
+            
+    def stop(self):
+        self.kill_worker.set()
+        with self.jobs_changed:
+            self.jobs_changed.notify()
             
+        
+class Scheduler():
+    """
+    Queues RX captures and TX bursts at absolute device times, as far ahead as needed.
     
-    def stop_rx_node(self):
-        self.rx_node.stop()
+    Each direction has a worker that hands the next command to the radio lead seconds
+    before it starts. The radio starts it on the exact sample, so Python only has to
+    be less than lead late. Captures of one worker run back to back, so they must not
+    overlap. Finished captures go to captures, as Frames whose seq is the job id.
+    The RX part can't run alongside an RX_Node and the TX part not alongside a
+    TX_Node or a loop, they share the streamers.
+    """
+    def __init__(self, transceiver, lead=0.05, capture_frames=64):
+        self.transceiver = transceiver
+        self.captures = FrameQueue(capture_frames, 'drop_oldest')
+        self.rx = ScheduleWorker(transceiver, self.capture, lead)
+        self.tx = ScheduleWorker(transceiver, self.burst, lead)
+        self.job_ids = iter(range(1 << 62))
+        self.failed = 0
+        
+    def start(self):
+        self.rx.start()
+        self.tx.start()
+        
+    def capture_at(self, when, num_samps):
+        """Schedule a capture of num_samps samples at device time when (s). Returns the job id."""
+        job_id = next(self.job_ids)
+        self.rx.add(when, job_id, num_samps)
+        return job_id
+    
+    def send_at(self, when, data):
+        """Schedule a burst of data at device time when (s). Returns the job id."""
+        job_id = next(self.job_ids)
+        self.tx.add(when, job_id, data)
+        return job_id
+    
+    def capture(self, when, job_id, num_samps):
+        frame = self.transceiver.capture_at(when, num_samps, seq=job_id)
+        if frame is None:
+            self.failed += 1
+            return
+        self.captures.put(frame)
+        
+    def burst(self, when, job_id, data):
+        self.transceiver.send_at(when, data)
+        
+    def pending(self):
+        return len(self.rx) + len(self.tx)
+        
+    def stop(self):
+        self.rx.stop()
+        self.tx.stop()
+        self.rx.join()
+        self.tx.join()
+        self.captures.close()
+        
+    
+class TX_Replay(threading.Thread):
+    """
+    Sends one buffer over and over as a single burst. The buffer goes to tx_streamer
+    as it is, so nothing is generated or copied per repeat. Don't run it alongside a
+    TX_Node, they share the streamer.
+    """
+    def __init__(self, transmitter, data, repeats=None):
+        threading.Thread.__init__(self, daemon=True)
+        self.transmitter = transmitter
+        # pyuhd's send converts anything but a writeable C array, on every call. Cached
+        # waveforms are read-only, so they are copied once here instead
+        self.data = np.require(data, dtype=np.complex64, requirements=['C', 'W'])
+        self.repeats = repeats
+        self.sent = 0
+        self.kill_replay = threading.Event()
         
+    def run(self):
+        metadata = self.transmitter.uhd.types.TXMetadata()
+        metadata.has_time_spec = False
+        metadata.start_of_burst = True
+        metadata.end_of_burst = False
+        while not self.kill_replay.is_set() and (self.repeats is None or self.sent < self.repeats):
+            self.transmitter.tx_send(self.data, metadata)
+            metadata.start_of_burst = False
+            self.sent += 1
+        metadata.end_of_burst = True
+        self.transmitter.tx_send(self.transmitter.tx_end_of_burst, metadata)
+        logger.debug(f"Replayed {self.sent} times ({self.sent * len(self.data)} samples)")
+        
+    def stop(self):
+        self.kill_replay.set()
         
+    
+class TX_Feeder(threading.Thread):
+    """
+    Keeps tx_streamer busy from the jitter buffer. A burst starts once prefill frames
+    are buffered. If the buffer runs dry the burst is ended cleanly and the feeder
+    buffers up again, instead of letting the radio underflow until data shows up.
+    """
+    def __init__(self, node, frames):
+        threading.Thread.__init__(self, daemon=True)
+        self.node = node
+        self.transmitter = node.transmitter
+        self.frames = frames
+        self.metadata = node.transmitter.uhd.types.TXMetadata()
+        self.in_burst = False
+        # How long a get may wait before the buffer counts as starved: one frame's duration
+        self.frame_time = 0.1
+        
+    def send(self, data, start_of_burst=False, end_of_burst=False):
+        self.metadata.has_time_spec = False
+        self.metadata.start_of_burst = start_of_burst
+        self.metadata.end_of_burst = end_of_burst
+        sent = self.transmitter.tx_send(data, self.metadata)
+        self.node.samples_sent += sent
+        return sent
+    
+    def end_burst(self):
+        self.send(self.transmitter.tx_end_of_burst, end_of_burst=True)
+        self.in_burst = False
+        
+    def run(self):
+        # After a client leaves the buffer is played out, after stop() it is abandoned
+        while (not self.frames.closed or len(self.frames)) and not self.node.kill_tx.is_set():
+            if not self.in_burst:
+                self.frames.wait_for(self.node.prefill_frames)
+            frame = self.frames.get(timeout=self.frame_time if self.in_burst else None)
+            if frame is None:
+                if self.in_burst and not self.frames.closed:
+                    logger.warning("TX buffer ran dry, ending burst")
+                    self.node.starved += 1
+                    self.end_burst()
+                continue
+            data = frame.data
+            self.frame_time = max(len(data) / self.transmitter.tx_sample_rate, 0.01)
+            if not self.in_burst:
+                self.node.bursts += 1
+            self.send(data, start_of_burst=not self.in_burst)
+            self.in_burst = True
+        if self.in_burst:
+            self.end_burst()
+    
+    
 class TX_Node(threading.Thread):
-    def __init__(self):
+    """
+    Receives sample frames from a client and transmits them as one continuous burst.
+    
+    Frames are received straight into a pool of slot buffers and queued in a jitter
+    buffer with the block policy, so a full buffer pushes back on the client through
+    TCP instead of dropping samples. TX_Feeder drains it into tx_streamer while a
+    monitor thread counts the async messages the radio reports (underflows, sequence
+    and time errors, burst acks). Clients are served one at a time.
+    """
+    def __init__(self, transmitter):
         threading.Thread.__init__(self)
+        self.transmitter = transmitter
+        self.queue_frames = transmitter.tx_queue_frames
+        self.prefill_frames = min(transmitter.tx_prefill_frames, self.queue_frames)
+        self.kill_tx = threading.Event()
+        self.frames = None
+        self.connection = None
+        
+        self.frames_received = 0
+        self.samples_sent = 0
+        self.bursts = 0
+        self.starved = 0
+        self.underflows = 0
+        self.seq_errors = 0
+        self.time_errors = 0
+        self.burst_acks = 0
+        self.peak_fill = 0
+        
+        # Queued frames, one the feeder is sending and one being received
+        self.slots = [np.empty(0, dtype=np.uint8) for _ in range(self.queue_frames + 2)]
+        self.slot_index = 0
+        
+        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server_socket.bind(('0.0.0.0', transmitter.tx_port))
+        self.server_socket.listen()
+        # Wake up now and then to notice stop()
+        self.server_socket.settimeout(0.5)
+        transmitter.metrics.collect('tx_node', self.collect_metrics)
+        
+    def buffer_fill(self):
+        """Fraction of the jitter buffer in use."""
+        return len(self.frames) / self.queue_frames if self.frames is not None else 0.0
+    
+    def stats(self):
+        return {
+            'frames_received': self.frames_received,
+            'samples_sent': self.samples_sent,
+            'bursts': self.bursts,
+            'buffer_fill': self.buffer_fill(),
+            'peak_fill': self.peak_fill / self.queue_frames,
+            'starved': self.starved,
+            'underflows': self.underflows,
+            'seq_errors': self.seq_errors,
+            'time_errors': self.time_errors,
+            'burst_acks': self.burst_acks,
+        }
+        
+    def collect_metrics(self):
+        return [
+            ('uhd_tx_queue_depth', 'gauge', "Frames in the TX jitter buffer", [({}, len(self.frames) if self.frames is not None else 0)]),
+            ('uhd_tx_queue_peak', 'gauge', "Most frames the TX jitter buffer held", [({}, self.peak_fill)]),
+            ('uhd_tx_frames_received_total', 'counter', "Frames received from TX clients", [({}, self.frames_received)]),
+            ('uhd_tx_bursts_total', 'counter', "TX bursts started", [({}, self.bursts)]),
+            ('uhd_tx_starved_total', 'counter', "Times the TX jitter buffer ran dry mid burst", [({}, self.starved)]),
+            ('uhd_tx_events_total', 'counter', "Async TX messages from the device, by event", [
+                ({'event': 'underflow'}, self.underflows),
+                ({'event': 'seq_error'}, self.seq_errors),
+                ({'event': 'time_error'}, self.time_errors),
+                ({'event': 'burst_ack'}, self.burst_acks),
+            ]),
+        ]
+        
+    def monitor(self):
+        """Count async TX messages until the node stops."""
+        codes = self.transmitter.uhd.types.TXMetadataEventCode
+        async_metadata = self.transmitter.uhd.types.TXAsyncMetadata()
+        while not self.kill_tx.is_set():
+            if not self.transmitter.tx_streamer.recv_async_msg(async_metadata, 0.1):
+                continue
+            event_code = async_metadata.event_code
+            if event_code in (codes.underflow, codes.underflow_in_packet):
+                self.underflows += 1
+                logger.warning(f"TX underflow at {async_metadata.time_spec.get_real_secs():.6f}")
+            elif event_code in (codes.seq_error, codes.seq_error_in_burst):
+                self.seq_errors += 1
+                logger.warning(f"TX sequence error")
+            elif event_code == codes.time_error:
+                self.time_errors += 1
+                logger.warning(f"TX time error, a burst was scheduled in the past")
+            elif event_code == codes.burst_ack:
+                self.burst_acks += 1
     
+    def negotiate(self, connection):
+        connection.settimeout(protocol.HELLO_TIMEOUT)
+        hello = protocol.recv_message(connection)
+        connection.settimeout(None)
+        if 'frame' not in hello.get('protocols', []):
+            raise ValueError("TX clients have to speak the frame protocol")
+        protocol.send_message(connection, {
+            'format': 'fc32',
+            'protocol': 'frame',
+            'queue_frames': self.queue_frames,
+            'prefill_frames': self.prefill_frames,
+            'sample_rate': self.transmitter.tx_sample_rate,
+            'center_freq': self.transmitter.tx_center_freq,
+        })
+        
+    def receive(self, reader):
+        """Receive the next frame into a free slot, or return None once the client is gone."""
+        header = reader.read_header()
+        if header is None:
+            return None
+        nbytes = header.channels * header.count * header.dtype.itemsize
+        slot = self.slot_index
+        self.slot_index = (slot + 1) % len(self.slots)
+        if self.slots[slot].nbytes < nbytes:
+            self.slots[slot] = np.empty(nbytes, dtype=np.uint8)
+        data = reader.read_payload(header, self.slots[slot])
+        if header.count and not len(data):
+            return None
+        if data.ndim > 1:
+            data = data[0]
+        if data.dtype == np.float32:
+            raise ValueError("TX frames must hold complex samples")
+        return Frame(header.seq, header.timestamp, time.time(), dsp.as_fc32(data))
+        
+    def serve(self, connection, addr):
+        try:
+            self.negotiate(connection)
+        except (OSError, ValueError) as e:
+            logger.warning(f"TX handshake with {addr} failed: {e}")
+            return
+        logger.info(f"Transmitting from {addr}")
+        reader = protocol.FrameReader(connection)
+        self.frames = FrameQueue(self.queue_frames, 'block')
+        feeder = TX_Feeder(self, self.frames)
+        feeder.start()
+        try:
+            while not self.kill_tx.is_set():
+                frame = self.receive(reader)
+                if frame is None:
+                    break
+                self.frames_received += 1
+                # Blocks while the buffer is full, which stops reading from the client
+                if not self.frames.put(frame):
+                    break
+                self.peak_fill = max(self.peak_fill, len(self.frames))
+        except (OSError, ValueError) as e:
+            logger.warning(f"TX connection to {addr} failed: {e}")
+        self.frames.close()
+        feeder.join()
+        logger.info(f"TX client {addr} done: {self.stats()}")
+        
     def run(self):
-        pass
+        monitor = threading.Thread(target=self.monitor, daemon=True)
+        monitor.start()
+        logger.info("Waiting for TX connections...")
+        while not self.kill_tx.is_set():
+            try:
+                connection, addr = self.server_socket.accept()
+            except socket.timeout:
+                continue
+            connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.connection = connection
+            with connection:
+                self.serve(connection, addr)
+            self.connection = None
+        self.server_socket.close()
+        monitor.join()
+    
+    def stop(self):
+        self.kill_tx.set()
+        connection = self.connection
+        if connection is not None:
+            try:
+                # Makes a blocked recv return so the session winds down
+                connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        frames = self.frames
+        if frames is not None:
+            frames.close()
+        
+        
+class RX_Capture(threading.Thread):
+    """Drains the radio as fast as it delivers and feeds frames into a FrameQueue."""
+    def __init__(self, receiver, frames):
+        threading.Thread.__init__(self, daemon=True)
+        self.receiver = receiver
+        self.frames = frames
+        self.kill_capture = threading.Event()
+        self.captured = 0
+        
+    def run(self):
+        try:
+            self.receiver.start_streaming()
+            while not self.kill_capture.is_set():
+                try:
+                    frame = self.receiver.read_frame()
+                except EOFError:
+                    logger.info("Source ended")
+                    break
+                if frame is None:
+                    # Timed out, nothing captured
+                    continue
+                self.captured += 1
+                # With the block policy put times out now and then so stop() is noticed
+                while not self.frames.put(frame, timeout=0.1):
+                    if self.frames.policy != 'block' or self.frames.closed or self.kill_capture.is_set():
+                        break
+        except Exception:
+            logger.exception(f"Capture failed after {self.captured} frames")
+        finally:
+            # Closing the queue is what ends the node and its clients, so it happens whatever went wrong
+            try:
+                self.receiver.stop_streaming()
+            finally:
+                self.frames.close()
+        logger.debug(f"Capture stopped after {self.captured} frames")
+        
+    def stop(self):
+        self.kill_capture.set()
+        
+    
+class RX_Client():
+    """Sends the shared capture stream to one connected client from its own bounded queue."""
+    def __init__(self, node, reader, writer):
+        self.node = node
+        self.receiver = node.receiver
+        self.reader = reader
+        self.writer = writer
+        self.addr = writer.get_extra_info('peername')
+        # Before Python 3.12 header and samples go out in two writes. Without this a small
+        # frame's samples can wait for the header's ACK
+        writer.get_extra_info('socket').setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        # drain() returns only once the transport buffer is empty, see send()
+        writer.transport.set_write_buffer_limits(high=0)
+        self.frames = None
+        # Sequence number of the ring frame the transport may still hold, see send()
+        self.sending = None
+        self.sent = 0
+        self.bytes_sent = 0
+        self.connected_at = time.perf_counter()
+        # Accept to first frame written, the latency a (re)connecting client sees
+        self.connect_latency = None
+        
+    async def negotiate(self):
+        """Agree on format, protocol and queueing with the client. Clients without a hello get fc32 over NumpySocket."""
+        hello = await protocol.read_hello(self.reader)
+        legacy = hello is None
+        if legacy:
+            logger.debug(f"No hello from {self.addr}, streaming legacy fc32")
+            hello = {}
+        self.stream = hello.get('stream', 'iq')
+        self.channel = int(hello.get('channel', 0))
+        if self.stream not in self.node.streams():
+            logger.warning(f"{self.addr} asked for unavailable stream {self.stream}, sending iq")
+            self.stream = 'iq'
+        if self.stream == 'channel' and not 0 <= self.channel < self.receiver.rx_channels:
+            raise ValueError(f"channel {self.channel} out of range, the channelizer has {self.receiver.rx_channels}")
+        # Device channels the client wants, as rows of the capture. The first one unless asked
+        # otherwise, so single channel clients keep getting one dimensional frames
+        captured = self.receiver.rx_device_channels
+        device_channels = [int(chan) for chan in hello.get('device_channels', captured[:1])]
+        if not device_channels or any(chan not in captured for chan in device_channels):
+            raise ValueError(f"device_channels {device_channels} not in the captured channels {captured}")
+        self.rows = [captured.index(chan) for chan in device_channels]
+        if self.stream != 'iq' and len(self.rows) > 1:
+            raise ValueError(f"{self.stream} streams are computed from one device channel, got {device_channels}")
+        self.select = self.selector(self.rows, len(captured))
+        # Clients sharing a product key share one processor and one computation per frame
+        self.product = (self.stream,)
+        if self.stream != 'iq':
+            # Processors keep state, so each device channel gets its own
+            self.product += (self.rows[0],)
+        if self.stream == 'spectrum':
+            spectrum = {key: type(default)(hello.get(key, default)) for key, default in self.receiver.spectrum.items()}
+            if (spectrum['window'] not in dsp.WINDOWS or not 0 <= spectrum['overlap'] < 1
+                    or not 2 <= spectrum['fft_size'] <= self.node.SPECTRUM_MAX_FFT_SIZE
+                    or not 0 <= spectrum['averages'] <= self.node.SPECTRUM_MAX_AVERAGES):
+                raise ValueError(f"Bad spectrum settings {spectrum}")
+            self.product += tuple(spectrum.items())
+        if self.stream in self.node.PROCESSED_STREAMS:
+            # Set up here, so settings the processor can't take fail this handshake and not the dispatcher
+            self.node.processor(self.product)
+        # Only the raw capture can travel as sc16. Processed streams are complex64
+        self.stream_format = self.receiver.rx_cpu_format if self.stream == 'iq' and self.receiver.rx_cpu_format in hello.get('formats', []) else 'fc32'
+        self.stream_protocol = 'frame' if 'frame' in hello.get('protocols', []) else 'npy'
+        policy = hello.get('policy', self.receiver.rx_overflow_policy)
+        if policy not in FrameQueue.POLICIES:
+            policy = self.receiver.rx_overflow_policy
+        queue_frames = max(1, min(int(hello.get('queue_frames', self.receiver.rx_queue_frames)), self.node.max_queue_frames))
+        self.frames = AsyncFrameQueue(queue_frames, policy)
+        if not legacy:
+            self.writer.write(protocol.pack_message({
+                'stream': self.stream,
+                'format': self.stream_format,
+                'protocol': self.stream_protocol,
+                'policy': policy,
+                'queue_frames': queue_frames,
+                'device_channels': device_channels,
+                'gain': self.receiver.rx_gains[self.rows[0]],
+                'gains': [self.receiver.rx_gains[row] for row in self.rows],
+                **self.node.stream_info(self.product, self.channel, self.rows),
+            }))
+        logger.info(f"Streaming {self.stream} as {self.stream_format} ({self.stream_protocol}, {policy} x{queue_frames}) to {self.addr}")
+    
+    @staticmethod
+    def selector(rows, captured):
+        """Index that picks rows out of a captured frame. Adjacent rows give a view, not a copy."""
+        if captured == 1:
+            # Single channel frames are one dimensional already
+            return slice(None)
+        if len(rows) == 1:
+            return rows[0]
+        if rows == list(range(rows[0], rows[-1] + 1)):
+            return slice(rows[0], rows[-1] + 1)
+        return rows
+    
+    def encode(self, data):
+        """Put a captured frame in the negotiated format."""
+        if self.stream_format == 'sc16' or data.dtype != protocol.SC16:
+            return data
+        return protocol.sc16_to_fc32(data)
+    
+    async def send(self, frame):
+        data = frame.data
+        if self.stream == 'iq':
+            data = data[self.select]
+        elif self.stream == 'channel':
+            # The channelizer output holds every channel, one per row
+            data = data[self.channel]
+        if data.size == 0:
+            # e.g. a spectrum that is still averaging
+            return
+        encoded = self.encode(data)
+        toc = time.perf_counter()
+        if self.stream_protocol == 'frame':
+            # The samples go to the socket straight from the ring. What the kernel doesn't take
+            # right away stays in the transport, as a view of the ring slot on Python 3.12+ and
+            # not a copy. With a high water mark of 0 drain() waits until the transport let go
+            # of it. Until then the dispatcher watches the slot and cuts the client off before
+            # capture comes back around to it.
+            if self.stream == 'iq' and encoded is data and self.receiver.reuses_frames:
+                self.sending = frame.seq
+            header, payload = protocol.pack_frame(encoded, frame.seq, frame.timestamp, frame.capture_time)
+            if WRITELINES_SENDMSG:
+                # Header and samples in one sendmsg call
+                self.writer.writelines([header, payload])
+            else:
+                # Older transports join what writelines gets, a copy of every frame
+                self.writer.write(header)
+                self.writer.write(payload)
+        elif encoded.dtype == protocol.SC16:
+            # Interleaved int16 I/Q: half the bytes of complex64
+            self.writer.write(protocol.pack_npy(encoded.view(np.int16)))
+        else:
+            self.writer.write(protocol.pack_npy(encoded))
+        await self.writer.drain()
+        self.sending = None
+        self.receiver.client_send_latency.observe(time.perf_counter() - toc)
+        self.receiver.frame_latency.observe(time.time() - frame.capture_time)
+        self.bytes_sent += encoded.nbytes
+    
+    async def serve(self):
+        try:
+            await self.negotiate()
+        except (OSError, ValueError, asyncio.IncompleteReadError) as e:
+            logger.warning(f"Handshake with {self.addr} failed: {e}")
+            await self.close()
+            return
+        self.node.add_client(self)
+        try:
+            while True:
+                frame = await self.frames.get()
+                if frame is None:
+                    break
+                await self.send(frame)
+                if self.sent == 0:
+                    self.connect_latency = time.perf_counter() - self.connected_at
+                    logger.debug(f"First frame to {self.addr} {self.connect_latency * 1e3:.1f} ms after accept")
+                self.sent += 1
+        except ConnectionError:
+            logger.info(f"Connection reset by {self.addr}")
+        finally:
+            self.node.remove_client(self)
+            self.frames.close()
+            await self.close()
+            if self.frames.dropped:
+                logger.warning(f"Dropped {self.frames.dropped} frames ({self.frames.policy}) for {self.addr} because it was too slow")
+            logger.debug(f"Sent {self.sent} frames to {self.addr}")
+        
+    async def close(self):
+        if self.sending is not None:
+            # A send broke off, the rest of its ring slot must not go out after capture reused it
+            self.writer.transport.abort()
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except (ConnectionError, OSError):
+            # Already reset by the peer, or cut off by the node
+            pass
+        
+    def stop(self):
+        if self.frames is not None:
+            self.frames.close()
+        self.writer.close()
+        
+    def abort(self):
+        """Cut the client off, dropping whatever its transport still holds."""
+        logger.warning(f"Disconnecting {self.addr}, it stopped reading while frame {self.sending} was going out of the ring")
+        self.sending = None
+        self.frames.close()
+        self.writer.transport.abort()
         
     
 class RX_Node(threading.Thread):
+    """
+    Captures continuously and broadcasts every frame to all connected clients.
+    
+    The node thread runs an asyncio loop that owns the listening socket and every
+    client connection. The capture thread hands frames over through a FrameQueue
+    that wakes the loop. Each client gets its own queue and overflow policy, so a
+    slow client only loses its own frames, and clients come and go without touching
+    the capture. A client with the block policy is lossless but can stall the capture
+    for everyone.
+    """
+    # Frames between the capture thread and the event loop
+    DISPATCH_FRAMES = 4
+    # Streams derived from the capture, computed once per frame for all their subscribers
+    PROCESSED_STREAMS = ('ddc', 'channel', 'spectrum')
+    # Largest spectrum a client may ask for, and most segments averaged per row
+    SPECTRUM_MAX_FFT_SIZE = 1 << 16
+    SPECTRUM_MAX_AVERAGES = 1 << 16
+    
     # TODO: Add static typing
     def __init__(self, receiver):
         threading.Thread.__init__(self)
         self.receiver = receiver
+        # The source may need its node, e.g. Playback waits for the first client
+        receiver.rx_node = self
+        self.clients = []
+        # Connection handler tasks, so shutdown can wait for every socket to close
+        self.connections = set()
+        self.loop = None
         self.kill_rx = threading.Event()
-        # self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        # self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        # self.server_socket.bind(('0.0.0.0', receiver.rx_port)) if receiver.remote else self.server_socket.bind(('localhost', receiver.rx_port))
-        # self.server_socket.listen(1)
+        self.stop_requested = None
+        self.shutdown_time = None
+        
+        # A client may hold one frame while sending plus its queue, the dispatcher holds one,
+        # the dispatch queue is full and capture is writing one more. A client that just went
+        # away may leave one more in its closing transport, which still sends from the ring.
+        # All of them must fit in the ring before the oldest view gets overwritten.
+        self.max_queue_frames = receiver.ring_frames - self.DISPATCH_FRAMES - 4
+        # Frames capture can get ahead of the one being dispatched: the dispatch queue, the
+        # frame being captured and the one it starts as soon as the dispatcher takes the next.
+        # A client that is still sending a frame this much older is cut off, see RX_Client.send
+        self.send_window = receiver.ring_frames - self.DISPATCH_FRAMES - 2
+        if self.max_queue_frames < 1:
+            raise ValueError(f"rx_ring_frames must be at least {self.DISPATCH_FRAMES + 5}")
+        if receiver.rx_queue_frames > self.max_queue_frames:
+            logger.warning(f"rx_queue_frames limited to {self.max_queue_frames} by rx_ring_frames ({receiver.ring_frames})")
+        self.frames = FrameQueue(self.DISPATCH_FRAMES, 'block', notify=self.wake)
+        # Stateful stream processors, created on first subscription. They run on one worker
+        # thread so the event loop keeps serving sockets meanwhile (numpy releases the GIL).
+        self.processors = {}
+        self.dsp_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='rx_dsp')
         
-        self.server_socket = NumpySocket()
+        # Bind here so a busy port fails in the caller, not in the thread
+        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.server_socket.bind(('0.0.0.0', receiver.rx_port))
         self.server_socket.listen()
-
-        logger.info("Waiting for a connection...")
-        # TODO: Propagate KeyboardException to break the accept loop
-        self.conn, self.addr = self.server_socket.accept()
-        logger.info(f"Connected to: {self.addr}")
-    
-    def run(self):
-        """Send continuous stream of data."""
+        receiver.metrics.collect('rx_node', self.collect_metrics)
         
-        stream_cmd = uhd.types.StreamCMD(uhd.types.StreamMode.start_cont)
-        # INIT_DELAY = 0.05
-        # stream_cmd.time_spec = uhd.types.TimeSpec(self.usrp.get_time_now().get_real_secs() + INIT_DELAY)
-        stream_cmd.stream_now = True
-        self.receiver.rx_streamer.issue_stream_cmd(stream_cmd)
-        # sent_packets = []
+    def collect_metrics(self):
+        clients = self.clients
+        addr = lambda client: {'client': f"{client.addr[0]}:{client.addr[1]}", 'stream': client.stream}
+        return [
+            ('uhd_rx_dispatch_queue_depth', 'gauge', "Frames waiting between capture and dispatch", [({}, len(self.frames))]),
+            ('uhd_rx_clients', 'gauge', "Connected RX clients", [({}, len(clients))]),
+            ('uhd_rx_client_queue_depth', 'gauge', "Frames queued for each client", [(addr(c), len(c.frames)) for c in clients]),
+            ('uhd_rx_client_frames_sent_total', 'counter', "Frames sent to each client", [(addr(c), c.sent) for c in clients]),
+            ('uhd_rx_client_bytes_sent_total', 'counter', "Sample bytes sent to each client", [(addr(c), c.bytes_sent) for c in clients]),
+            ('uhd_rx_client_dropped_frames_total', 'counter', "Frames dropped from each client's queue", [(addr(c), c.frames.dropped) for c in clients]),
+        ]
         
-        while not self.kill_rx.is_set():
-            data = self.receiver.read()
+    def wake(self):
+        """Called from the capture thread after each frame and when it closes the queue."""
+        loop = self.loop
+        if loop is not None and not loop.is_closed():
             try:
-                self.conn.sendall(data)
-            except ConnectionResetError:
-                logger.warning('Connection reset by client')
+                loop.call_soon_threadsafe(self.frames_ready.set)
+            except RuntimeError:
+                # The loop closed in between, nobody is waiting anymore
+                pass
+        
+    def streams(self):
+        """Names of the streams clients can subscribe to."""
+        streams = ['iq', 'spectrum']
+        if self.receiver.rx_decimation > 1:
+            streams.append('ddc')
+        if self.receiver.rx_channels > 1:
+            streams.append('channel')
+        return streams
+    
+    def stream_info(self, product, channel=0, rows=(0,)):
+        """Rate, tuning and frame size of a stream, sent to clients in the handshake."""
+        stream = product[0]
+        center_freq = self.receiver.rx_center_freqs[rows[0]]
+        if stream == 'spectrum':
+            settings = dict(product[2:])
+            # Welch segments one frame can complete, and the rows they make with averaging
+            step = max(settings['fft_size'] - int(settings['fft_size'] * settings['overlap']), 1)
+            segments = (self.receiver.num_samps - 1) // step + 1
+            averages = settings['averages']
+            return {
+                **settings,
+                'frame_size': settings['fft_size'],
+                'max_rows': (segments + averages - 1) // averages if averages else 1,
+                'bin_width': self.receiver.rx_sample_rate / settings['fft_size'],
+                'sample_rate': self.receiver.rx_sample_rate,
+                'center_freq': center_freq,
+            }
+        if stream == 'channel':
+            channelizer = self.processor(product)
+            return {
+                'channel': channel,
+                'frame_size': self.receiver.num_samps // self.receiver.rx_channels,
+                'sample_rate': channelizer.output_rate,
+                'center_freq': center_freq + channelizer.channel_offset(channel),
+            }
+        if stream == 'ddc':
+            return {
+                'frame_size': self.receiver.num_samps // self.receiver.rx_decimation,
+                'sample_rate': self.receiver.rx_sample_rate / self.receiver.rx_decimation,
+                'center_freq': center_freq + self.receiver.rx_channel_freq,
+            }
+        return {
+            'frame_size': self.receiver.num_samps,
+            'sample_rate': self.receiver.rx_sample_rate,
+            'center_freq': center_freq,
+            'center_freqs': [self.receiver.rx_center_freqs[row] for row in rows],
+        }
+    
+    def processor(self, product):
+        if product not in self.processors:
+            stream = product[0]
+            if stream == 'ddc':
+                self.processors[product] = dsp.DDC(self.receiver.rx_sample_rate, self.receiver.rx_channel_freq, self.receiver.rx_decimation)
+            elif stream == 'channel':
+                # One filter bank pass serves every channel index
+                self.processors[product] = dsp.Channelizer(self.receiver.rx_sample_rate, self.receiver.rx_channels)
+            elif stream == 'spectrum':
+                self.processors[product] = dsp.WelchPSD(**dict(product[2:]))
+        return self.processors[product]
+    
+    def process(self, frame, products):
+        """
+        Compute every subscribed processed stream for one frame. Runs on the dsp thread.
+        A stream that fails is left out, so only its own clients lose it.
+        """
+        processed = {}
+        for product in products:
+            # Processed streams read one device channel, product[1] is its row
+            data = frame.data if frame.data.ndim == 1 else frame.data[product[1]]
+            try:
+                processed[product] = frame._replace(data=self.processor(product).process(data))
+            except Exception:
+                logger.exception(f"{product[0]} stream failed on frame {frame.seq}, disconnecting its clients")
+                self.processors.pop(product, None)
+        return processed
+        
+    def add_client(self, client):
+        self.clients = self.clients + [client]
+        logger.info(f"{len(self.clients)} client(s) connected")
+        
+    def remove_client(self, client):
+        self.clients = [c for c in self.clients if c is not client]
+        
+    async def handle_connection(self, reader, writer):
+        logger.info(f"Connected to: {writer.get_extra_info('peername')}")
+        task = asyncio.current_task()
+        self.connections.add(task)
+        try:
+            await RX_Client(self, reader, writer).serve()
+        finally:
+            self.connections.discard(task)
+    
+    async def dispatch(self):
+        """Move frames from the capture thread to every client's queue."""
+        while True:
+            await self.frames_ready.wait()
+            self.frames_ready.clear()
+            while True:
+                frame = self.frames.get(timeout=0)
+                if frame is None:
+                    break
+                # clients is replaced, never mutated, so iterating a snapshot is safe
+                clients = self.clients
+                for client in clients:
+                    if client.sending is not None and frame.seq - client.sending >= self.send_window:
+                        client.abort()
+                products = {('iq',): frame}
+                processed = {client.product for client in clients if client.stream in self.PROCESSED_STREAMS}
+                if processed:
+                    products.update(await self.loop.run_in_executor(self.dsp_executor, self.process, frame, processed))
+                for client in clients:
+                    if client.product in products:
+                        await client.frames.put(products[client.product])
+                    else:
+                        # Its stream failed, the client goes once it sent what it has
+                        client.frames.close()
+            if self.frames.closed:
                 break
-            # sent_packets.append(np.copy(data))
+        # Capture is over, whether stopped or because the source ended
+        self.shutdown.set()
+    
+    async def serve(self):
+        self.frames_ready = asyncio.Event()
+        self.shutdown = asyncio.Event()
+        self.loop = asyncio.get_running_loop()
+        # Frames captured before the loop existed woke nobody
+        self.frames_ready.set()
+        if self.kill_rx.is_set():
+            # stop() came in before the loop existed
+            self.shutdown.set()
+        server = await asyncio.start_server(self.handle_connection, sock=self.server_socket)
+        logger.info("Waiting for connections...")
+        dispatcher = asyncio.create_task(self.dispatch())
         
-        stream_cmd = uhd.types.StreamCMD(uhd.types.StreamMode.stop_cont)
-        self.receiver.rx_streamer.issue_stream_cmd(stream_cmd)
-        self.conn.close()
-        self.server_socket.close()
-        logger.debug('Conn and socket closed')
+        await self.shutdown.wait()
+        server.close()
+        if not self.kill_rx.is_set():
+            # The source ended. Give clients a moment to drain their queues before disconnecting them
+            for client in self.clients:
+                client.frames.close()
+            deadline = self.loop.time() + 5
+            while self.clients and self.loop.time() < deadline:
+                await asyncio.sleep(0.01)
+        clients = self.clients
+        for client in clients:
+            client.stop()
+        if self.connections:
+            # Let the connections flush and close, but cut off peers that stopped reading.
+            # Otherwise the loop ends with their sockets still open
+            _, pending = await asyncio.wait(self.connections, timeout=1)
+            if pending:
+                for client in clients:
+                    client.writer.transport.abort()
+                await asyncio.wait(pending)
+        self.frames.close()
+        self.frames_ready.set()
+        await dispatcher
+        await server.wait_closed()
+        self.dsp_executor.shutdown()
+    
+    def run(self):
+        """Send continuous stream of data. Capture runs on its own thread so a slow client never stalls the radio."""
+        
+        self.capture = RX_Capture(self.receiver, self.frames)
+        self.capture.start()
+        asyncio.run(self.serve())
         
-        # sent_samples = np.concatenate(sent_packets)
-        # logger.debug(f"Total sent: {len(sent_samples)}")
-        # sent_samples.tofile('sent_samples.bin')
-        # logger.debug(f"{len(sent_samples)} written to sent_samples.bin")
+        self.capture.stop()
+        self.capture.join()
+        if self.stop_requested is not None:
+            self.shutdown_time = time.perf_counter() - self.stop_requested
+        logger.debug(f"RX node stopped after {self.capture.captured} frames, shutdown took {(self.shutdown_time or 0) * 1e3:.1f} ms")
     
     def stop(self):
+        self.stop_requested = time.perf_counter()
         self.kill_rx.set()
+        loop = self.loop
+        if loop is not None and not loop.is_closed():
+            try:
+                loop.call_soon_threadsafe(self.shutdown.set)
+            except RuntimeError:
+                # The node stopped on its own in between
+                pass
         
-def main():
-    
+def build_parser():
     parser = configargparse.ArgParser(default_config_files=['conf/server/default.ini'])
     # p.add('-c', '--my-config', is_config_file=True, help='config file path')
     # TODO: Add specific choices for sample_rate
@@ -167,10 +1264,38 @@ def main():
     parser.add('--rx_channel_freq', type=float, required=True, help="Channel frequency for receiver. Offset from center (Hz). Example: 40000")
     # parser.add_argument('--rx_antenna', type=str, help="")
     parser.add('--rx_gain', type=int, required=True, help="Gain for RX. Example: 20")
+    parser.add('--rx_device_channels', type=int, nargs='+', default=[0], help="Device channels to capture. Frames hold one row per channel. Example: 0 1, or [0, 1] in the config file")
+    parser.add('--rx_center_freqs', type=float, nargs='+', help="Center frequency of each channel in rx_device_channels (Hz). Defaults to rx_center_freq for all")
+    parser.add('--rx_gains', type=int, nargs='+', help="Gain of each channel in rx_device_channels. Defaults to rx_gain for all")
     parser.add('--verbose', '-v', action='store_true', help="Enable verbose mode")
     parser.add('--remote', '-r', action='store_true', help="Enable remote access")
     parser.add('--rx_port', type=int, default=12345, help="Server port for RX Node")
+    parser.add('--tx_port', type=int, default=12346, help="Server port for TX Node")
+    parser.add('--metrics_port', type=int, default=12347, help="HTTP port serving Prometheus metrics at /metrics. Local only unless --remote. 0 disables it")
+    parser.add('--tx_queue_frames', type=int, default=16, help="Frames the TX jitter buffer holds. A full buffer stops reading from the client")
+    parser.add('--tx_cache_mb', type=float, default=64, help="Memory cap of the TX waveform cache (MiB)")
+    parser.add('--tx_prefill_frames', type=int, default=4, help="Frames buffered before a TX burst starts, and again after the buffer ran dry")
+    parser.add('--rx_cpu_format', choices=['fc32', 'sc16'], default='fc32', help="Host sample format for RX. sc16 keeps int16 I/Q and halves the bytes sent to clients that accept it")
+    parser.add('--rx_decimation', type=int, default=1, help="Decimation of the 'ddc' stream, which mixes rx_channel_freq to baseband. 1 disables it. Example: 40")
+    parser.add('--rx_channels', type=int, default=1, help="Number of channels the polyphase channelizer splits the band into for the 'channel' stream. 1 disables it. Example: 16")
+    parser.add('--spectrum_fft_size', type=int, default=512, help="Default FFT size of the 'spectrum' stream")
+    parser.add('--spectrum_overlap', type=float, default=0.5, help="Default overlap (fraction) of the 'spectrum' stream's Welch segments")
+    parser.add('--spectrum_window', choices=list(dsp.WINDOWS), default='hann', help="Default window of the 'spectrum' stream")
+    parser.add('--spectrum_averages', type=int, default=0, help="Default segments averaged per 'spectrum' row. 0 makes one row per frame")
+    parser.add('--rx_frame_samps', type=int, default=64000, help="Samples per RX frame. Smaller frames reach clients sooner, larger ones cost less per sample. Example: 2000 for low latency")
+    parser.add('--rx_chunk_samps', type=int, default=0, help="Samples per recv call on the RX streamer. 0 asks for the rest of the frame in one call")
+    parser.add('--rx_ring_frames', type=int, default=32, help="Number of frames in the RX capture ring. Returned frames stay valid for this many reads")
+    parser.add('--rx_queue_frames', type=int, default=16, help="Frames buffered for each client between capture and network send")
+    parser.add('--rx_overflow_policy', choices=FrameQueue.POLICIES, default='drop_oldest', help="Default for what to do with frames when a client's queue is full. Clients may ask for their own")
+    parser.add('--rx_start_delay', type=float, default=0.0, help="Start continuous RX this long (s) after the command, on device time. 0 starts immediately")
+    parser.add('--schedule_lead', type=float, default=0.05, help="How long (s) before their start time scheduled captures and bursts are handed to the device")
+    parser.add('--device', choices=['uhd', 'sim'], default='uhd', help="Device backend. 'sim' generates a synthetic stream without a radio")
+    parser.add('--device_args', type=str, default='', help="Device args passed to MultiUSRP. Example: type=b200 or, for sim, tone=25000:0.05,realtime=1")
+    return parser
 
+def main():
+    
+    parser = build_parser()
     args = parser.parse_args()
 
 
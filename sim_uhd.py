@@ -0,0 +1,438 @@
+"""
+Simulated stand-in for the parts of the ``uhd`` python module used by server.py.
+
+The module mirrors the ``uhd`` layout (``usrp``, ``types``, ``libpyuhd.types``) so
+it can be dropped in wherever the real bindings are used. The signal is described
+with a UHD style device args string, e.g.
+
+    noise=0.001,tone=25000:0.05,burst=0.5:0.02:0.1:40000,realtime=1
+
+tone=<offset Hz>:<amplitude> may be given several times (separated by ';').
+burst=<period s>:<duration s>:<amplitude>:<offset Hz> adds periodic bursts.
+realtime=0 generates samples as fast as they are asked for (benchmarking),
+realtime=1 paces the stream at the sample rate and reports overflows when the
+host does not keep up.
+"""
+import threading
+import time
+from collections import deque
+from enum import Enum
+from types import SimpleNamespace
+
+import numpy as np
+from loguru import logger
+
+
+class RXMetadataErrorCode(Enum):
+    none = 0
+    timeout = 1
+    late = 2
+    broken_chain = 4
+    overflow = 8
+    alignment = 12
+    bad_packet = 15
+
+
+class StreamMode(Enum):
+    start_cont = 97
+    stop_cont = 111
+    num_done = 100
+    num_more = 109
+
+
+class TXMetadataEventCode(Enum):
+    burst_ack = 1
+    underflow = 2
+    seq_error = 4
+    time_error = 8
+    underflow_in_packet = 16
+    seq_error_in_burst = 32
+    user_payload = 64
+
+
+class TimeSpec():
+    def __init__(self, secs=0.0):
+        self.secs = float(secs)
+
+    def get_real_secs(self):
+        return self.secs
+
+    def __add__(self, other):
+        other = other.secs if isinstance(other, TimeSpec) else other
+        return TimeSpec(self.secs + other)
+
+    def __repr__(self):
+        return f"TimeSpec({self.secs})"
+
+
+class TuneRequest():
+    def __init__(self, target_freq=0.0, lo_off=0.0):
+        self.target_freq = float(target_freq)
+        self.lo_off = float(lo_off)
+
+
+class RXMetadata():
+    def __init__(self):
+        self.error_code = RXMetadataErrorCode.none
+        self.has_time_spec = False
+        self.time_spec = TimeSpec()
+        self.start_of_burst = False
+        self.end_of_burst = False
+        self.out_of_sequence = False
+
+    def strerror(self):
+        return f"ERROR_CODE_{self.error_code.name.upper()}"
+
+
+class TXMetadata():
+    def __init__(self):
+        self.has_time_spec = False
+        self.time_spec = TimeSpec()
+        self.start_of_burst = False
+        self.end_of_burst = False
+
+
+class TXAsyncMetadata():
+    def __init__(self):
+        self.channel = 0
+        self.has_time_spec = False
+        self.time_spec = TimeSpec()
+        self.event_code = TXMetadataEventCode.burst_ack
+
+
+class StreamCMD():
+    def __init__(self, mode):
+        self.stream_mode = mode
+        self.num_samps = 0
+        self.stream_now = True
+        self.time_spec = TimeSpec()
+
+
+class StreamArgs():
+    def __init__(self, cpu_format, otw_format):
+        self.cpu_format = cpu_format
+        self.otw_format = otw_format
+        self.channels = [0]
+        self.args = ""
+
+
+def parse_device_args(device_args):
+    """Parse 'key=value,key=value' into a dict. Repeated tone/burst values are split on ';'."""
+    config = {}
+    for item in filter(None, (part.strip() for part in device_args.split(','))):
+        key, _, value = item.partition('=')
+        config[key.strip()] = value.strip()
+    return config
+
+
+class SignalModel():
+    """
+    Precomputes a table of samples (noise, tones and bursts) that the streamer
+    serves cyclically. Serving from the table costs one memcpy per recv, which is
+    about what a real device's DMA copy costs, so benchmarks measure the host path.
+    """
+    def __init__(self, sample_rate, noise=0.001, tones=(), bursts=(), table_size=1 << 20, seed=0):
+        self.sample_rate = sample_rate
+        self.table_size = table_size
+        rng = np.random.default_rng(seed)
+        t = np.arange(table_size) / sample_rate
+        # Snap offsets to a whole number of cycles per table so the table wraps without a phase jump
+        resolution = sample_rate / table_size
+
+        table = (rng.standard_normal(table_size) + 1j * rng.standard_normal(table_size)) * (noise / np.sqrt(2))
+        for freq, amplitude in tones:
+            freq = round(freq / resolution) * resolution
+            table += amplitude * np.exp(2j * np.pi * freq * t)
+        for period, duration, amplitude, freq in bursts:
+            freq = round(freq / resolution) * resolution
+            period_samps = max(int(period * sample_rate), 1)
+            duration_samps = int(duration * sample_rate)
+            gate = (np.arange(table_size) % period_samps) < duration_samps
+            table += gate * amplitude * np.exp(2j * np.pi * freq * t)
+        self.table = table.astype(np.complex64)
+        self.table_sc16 = np.empty(table_size * 2, dtype=np.int16)
+        self.table_sc16[0::2] = np.clip(self.table.real * 32767, -32768, 32767)
+        self.table_sc16[1::2] = np.clip(self.table.imag * 32767, -32768, 32767)
+
+    @classmethod
+    def from_device_args(cls, sample_rate, config, chan=0):
+        tones = []
+        for tone in filter(None, config.get('tone', '').split(';')):
+            freq, _, amplitude = tone.partition(':')
+            tones.append((float(freq), float(amplitude or 0.05)))
+        bursts = []
+        for burst in filter(None, config.get('burst', '').split(';')):
+            fields = [float(f) for f in burst.split(':')]
+            period, duration, amplitude, freq = (fields + [0.5, 0.02, 0.1, 0.0][len(fields):])[:4]
+            bursts.append((period, duration, amplitude, freq))
+        return cls(sample_rate,
+                   noise=float(config.get('noise', 0.001)),
+                   tones=tones,
+                   bursts=bursts,
+                   # Channels share tones and bursts but get their own noise
+                   seed=int(config.get('seed', 0)) + chan)
+
+    def fill(self, start, out, cpu_format):
+        """Copy samples [start, start + n) of the stream into every row of out."""
+        n = out.shape[-1]
+        if cpu_format == 'fc32':
+            table = self.table
+        else:
+            table = self.table_sc16.view(np.uint32)
+            out = out.view(np.uint32)
+        offset = start % self.table_size
+        filled = 0
+        while filled < n:
+            count = min(n - filled, self.table_size - offset)
+            out[..., filled:filled + count] = table[offset:offset + count]
+            filled += count
+            offset = 0
+
+
+class SimRXStreamer():
+    max_num_samps = 2040
+
+    def __init__(self, device, stream_args):
+        self.device = device
+        self.cpu_format = stream_args.cpu_format
+        self.channels = list(stream_args.channels)
+        self.streaming = False
+        self.samples_left = None
+        self.next_sample = 0
+        self.start_time = 0.0
+        self.overflows = 0
+        self.dropped_samples = 0
+        self.late = False
+        self.lock = threading.Lock()
+
+    def get_num_channels(self):
+        return len(self.channels)
+
+    def get_max_num_samps(self):
+        return self.max_num_samps
+
+    def issue_stream_cmd(self, stream_cmd):
+        with self.lock:
+            if stream_cmd.stream_mode == StreamMode.stop_cont:
+                self.streaming = False
+                return
+            # Read the time before building the signal tables, which takes a while, so a timed
+            # command issued just ahead of its start isn't late because of the sim itself
+            now = self.device.get_time_now().get_real_secs()
+            self.signals = [self.device.signal_model(chan) for chan in self.channels]
+            self.rate = self.device.get_rx_rate(self.channels[0])
+            self.start_time = now if stream_cmd.stream_now else stream_cmd.time_spec.get_real_secs()
+            # A timed command whose time already passed is rejected by the device
+            self.late = self.device.realtime and self.start_time < now
+            self.next_sample = 0
+            self.samples_left = None if stream_cmd.stream_mode == StreamMode.start_cont else stream_cmd.num_samps
+            self.streaming = True
+
+    def recv(self, buffer, metadata, timeout=0.1):
+        """Fill buffer (channels x samples) and return the number of samples per channel received."""
+        if not buffer.flags.c_contiguous:
+            # Like pyuhd, which converts the buffer with NPY_ARRAY_CARRAY: a non-contiguous
+            # one is filled as a temporary copy and the caller never sees the samples
+            buffer = np.ascontiguousarray(buffer)
+        metadata.error_code = RXMetadataErrorCode.none
+        metadata.start_of_burst = False
+        metadata.end_of_burst = False
+        with self.lock:
+            if not self.streaming:
+                time.sleep(timeout)
+                metadata.error_code = RXMetadataErrorCode.timeout
+                return 0
+            if self.late:
+                self.late = False
+                self.streaming = False
+                metadata.error_code = RXMetadataErrorCode.late
+                return 0
+            nsamps = buffer.shape[-1]
+            if self.samples_left is not None:
+                nsamps = min(nsamps, self.samples_left)
+            if self.device.realtime:
+                deadline = time.perf_counter() + timeout
+                produced = (self.device.get_time_now().get_real_secs() - self.start_time) * self.rate
+                backlog = produced - self.next_sample
+                if backlog > self.device.rx_buffer_samps:
+                    # Host fell behind: the device drops everything it could not buffer
+                    dropped = int(backlog)
+                    self.next_sample += dropped
+                    self.overflows += 1
+                    self.dropped_samples += dropped
+                    metadata.error_code = RXMetadataErrorCode.overflow
+                    return 0
+                wait = (self.next_sample + nsamps - produced) / self.rate
+                if wait > 0:
+                    if time.perf_counter() + wait > deadline:
+                        nsamps = max(int(backlog + (deadline - time.perf_counter()) * self.rate), 0)
+                        wait = (self.next_sample + nsamps - produced) / self.rate
+                    time.sleep(max(wait, 0))
+                if nsamps == 0:
+                    metadata.error_code = RXMetadataErrorCode.timeout
+                    return 0
+            for row, signal in zip(buffer, self.signals):
+                signal.fill(self.next_sample, row[:nsamps], self.cpu_format)
+            metadata.has_time_spec = True
+            metadata.time_spec = TimeSpec(self.start_time + self.next_sample / self.rate)
+            metadata.start_of_burst = self.next_sample == 0
+            self.next_sample += nsamps
+            if self.samples_left is not None:
+                self.samples_left -= nsamps
+                if self.samples_left == 0:
+                    metadata.end_of_burst = True
+                    self.streaming = False
+            return nsamps
+
+
+class SimTXStreamer():
+    max_num_samps = 2040
+
+    def __init__(self, device, stream_args):
+        self.device = device
+        self.cpu_format = stream_args.cpu_format
+        self.channels = list(stream_args.channels)
+        self.samples_sent = 0
+        self.next_time = None
+        self.events = deque()
+        self.events_ready = threading.Condition()
+
+    def get_num_channels(self):
+        return len(self.channels)
+
+    def get_max_num_samps(self):
+        return self.max_num_samps
+
+    def post_event(self, event_code, secs):
+        with self.events_ready:
+            self.events.append((event_code, secs))
+            self.events_ready.notify()
+
+    def recv_async_msg(self, async_metadata, timeout=0.1):
+        """Pop the next async TX event into async_metadata. Returns False on timeout."""
+        with self.events_ready:
+            if not self.events_ready.wait_for(lambda: self.events, timeout):
+                return False
+            event_code, secs = self.events.popleft()
+        async_metadata.event_code = event_code
+        async_metadata.has_time_spec = True
+        async_metadata.time_spec = TimeSpec(secs)
+        return True
+
+    def send(self, buffer, metadata, timeout=0.1):
+        nsamps = buffer.shape[-1]
+        if self.device.realtime:
+            rate = self.device.get_tx_rate(self.channels[0])
+            now = self.device.get_time_now().get_real_secs()
+            start = metadata.time_spec.get_real_secs() if metadata.has_time_spec else now
+            if metadata.start_of_burst and start < now:
+                self.post_event(TXMetadataEventCode.time_error, start)
+            if self.next_time is not None and self.next_time < now and not metadata.start_of_burst:
+                # The device ran dry in the middle of a burst
+                self.post_event(TXMetadataEventCode.underflow, self.next_time)
+            if self.next_time is None or self.next_time < now or metadata.start_of_burst:
+                self.next_time = max(start, now)
+            self.next_time += nsamps / rate
+            # Block while the device buffer is full, like the real streamer does
+            ahead = self.next_time - now - self.device.tx_buffer_samps / rate
+            if ahead > 0:
+                time.sleep(ahead)
+            if metadata.end_of_burst:
+                self.post_event(TXMetadataEventCode.burst_ack, self.next_time)
+                self.next_time = None
+        elif metadata.end_of_burst:
+            self.post_event(TXMetadataEventCode.burst_ack, self.device.get_time_now().get_real_secs())
+        self.samples_sent += nsamps
+        return nsamps
+
+
+class SimMultiUSRP():
+    def __init__(self, device_args=""):
+        self.config = parse_device_args(device_args)
+        self.realtime = self.config.get('realtime', '1') not in ('0', 'false', 'False')
+        self.rx_buffer_samps = int(float(self.config.get('rx_buffer_samps', 1 << 22)))
+        self.tx_buffer_samps = int(float(self.config.get('tx_buffer_samps', 1 << 16)))
+        self.rx_rate = {}
+        self.rx_freq = {}
+        self.rx_gain = {}
+        self.tx_rate = {}
+        self.tx_freq = {}
+        self.tx_gain = {}
+        self.time_offset = time.perf_counter()
+        self.signal_models = {}
+        logger.info(f"Using simulated USRP ({'realtime' if self.realtime else 'unpaced'}): {device_args or 'defaults'}")
+
+    def get_rx_num_channels(self):
+        return int(self.config.get('channels', 2))
+
+    def get_tx_num_channels(self):
+        return int(self.config.get('channels', 2))
+
+    def set_rx_rate(self, rate, chan=0):
+        self.rx_rate[chan] = float(rate)
+
+    def get_rx_rate(self, chan=0):
+        return self.rx_rate.get(chan, 1e6)
+
+    def set_rx_freq(self, tune_request, chan=0):
+        self.rx_freq[chan] = getattr(tune_request, 'target_freq', tune_request)
+
+    def get_rx_freq(self, chan=0):
+        return self.rx_freq.get(chan, 0.0)
+
+    def set_rx_gain(self, gain, chan=0):
+        self.rx_gain[chan] = gain
+
+    def get_rx_gain(self, chan=0):
+        return self.rx_gain.get(chan, 0)
+
+    def set_tx_rate(self, rate, chan=0):
+        self.tx_rate[chan] = float(rate)
+
+    def get_tx_rate(self, chan=0):
+        return self.tx_rate.get(chan, 1e6)
+
+    def set_tx_freq(self, tune_request, chan=0):
+        self.tx_freq[chan] = getattr(tune_request, 'target_freq', tune_request)
+
+    def get_tx_freq(self, chan=0):
+        return self.tx_freq.get(chan, 0.0)
+
+    def set_tx_gain(self, gain, chan=0):
+        self.tx_gain[chan] = gain
+
+    def get_tx_gain(self, chan=0):
+        return self.tx_gain.get(chan, 0)
+
+    def get_time_now(self, mboard=0):
+        return TimeSpec(time.perf_counter() - self.time_offset)
+
+    def set_time_now(self, time_spec, mboard=0):
+        self.time_offset = time.perf_counter() - time_spec.get_real_secs()
+
+    def signal_model(self, chan=0):
+        rate = self.get_rx_rate(chan)
+        if self.signal_models.get(chan, (None, None))[0] != rate:
+            self.signal_models[chan] = (rate, SignalModel.from_device_args(rate, self.config, chan))
+        return self.signal_models[chan][1]
+
+    def get_rx_stream(self, stream_args):
+        return SimRXStreamer(self, stream_args)
+
+    def get_tx_stream(self, stream_args):
+        return SimTXStreamer(self, stream_args)
+
+
+usrp = SimpleNamespace(MultiUSRP=SimMultiUSRP, StreamArgs=StreamArgs)
+types = SimpleNamespace(
+    RXMetadata=RXMetadata,
+    RXMetadataErrorCode=RXMetadataErrorCode,
+    TXMetadata=TXMetadata,
+    TXAsyncMetadata=TXAsyncMetadata,
+    TXMetadataEventCode=TXMetadataEventCode,
+    StreamCMD=StreamCMD,
+    StreamMode=StreamMode,
+    TimeSpec=TimeSpec,
+    TuneRequest=TuneRequest,
+)
+libpyuhd = SimpleNamespace(types=SimpleNamespace(tune_request=TuneRequest))
@@ -0,0 +1,66 @@
+"""
+Fixtures that run the server on the simulated device backend (sim_uhd), so the
+whole RX path can be tested without a radio.
+"""
+import os
+import socket
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import server
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def server_args(*extra):
+    """Server options for the sim backend on free ports. extra overrides the defaults."""
+    return server.build_parser().parse_args([
+        '--tx_sample_rate', '2e6', '--tx_center_freq', '434e6', '--tx_channel_freq', '40000', '--tx_gain', '10',
+        '--rx_sample_rate', '2e6', '--rx_center_freq', '434e6', '--rx_channel_freq', '25000', '--rx_gain', '50',
+        '--device', 'sim', '--device_args', 'realtime=0,tone=25000:0.1',
+        '--rx_port', str(free_port()), '--tx_port', str(free_port()), '--metrics_port', '0',
+        *extra,
+    ])
+
+
+@pytest.fixture
+def rx_node():
+    """Start an RX_Node on the sim backend: rx_node(*options) returns (node, addr). Stopped after the test."""
+    nodes = []
+
+    def start(*extra):
+        transceiver = server.Transceiver(server_args(*extra))
+        node = server.RX_Node(transceiver)
+        node.start()
+        nodes.append(node)
+        return node, ('localhost', transceiver.rx_port)
+
+    yield start
+    for node in nodes:
+        node.stop()
+        node.join()
+
+
+@pytest.fixture
+def tx_node():
+    """Start a TX_Node on the sim backend: tx_node(*options) returns (node, addr). Stopped after the test."""
+    nodes = []
+
+    def start(*extra):
+        transceiver = server.Transceiver(server_args(*extra))
+        node = server.TX_Node(transceiver)
+        node.start()
+        nodes.append(node)
+        return node, ('localhost', transceiver.tx_port)
+
+    yield start
+    for node in nodes:
+        node.stop()
+        node.join()
@@ -0,0 +1,18 @@
+import numpy as np
+import pytest
+
+import client
+
+
+@pytest.mark.parametrize('component, expected', [('i', [-1, 1]), ('q', [-2, 2]), ('magnitude', [0.5, np.hypot(1, 2)])])
+def test_minmax_decimator_component(component, expected):
+    data = np.array([1 + 2j, -1 - 2j, 0.5 + 0j, 0.5 + 0j], dtype=np.complex64)
+    decimator = client.MinMaxDecimator(1, component)
+    out = decimator.process(data)
+    assert list(decimator.x) == [0, 0]
+    np.testing.assert_allclose(out, expected, rtol=1e-6)
+
+
+def test_minmax_decimator_rejects_unknown_component():
+    with pytest.raises(ValueError):
+        client.MinMaxDecimator(10, 'phase')
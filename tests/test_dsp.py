@@ -0,0 +1,129 @@
+import warnings
+
+import numpy as np
+import pytest
+
+import dsp
+import protocol
+
+
+def noise(n, rms=0.01, seed=0):
+    rng = np.random.default_rng(seed)
+    return ((rng.standard_normal(n) + 1j * rng.standard_normal(n)) * rms / np.sqrt(2)).astype(np.complex64)
+
+
+def test_burst_detector_recovers_after_silence():
+    detector = dsp.BurstDetector()
+    x = noise(20000)
+    x[5000:8000] += 0.5
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        assert detector.process(np.zeros(10000, dtype=np.complex64)) == []
+        bursts = detector.process(x)
+    assert [(b.start, b.stop) for b in bursts] == [(15000, 18000)]
+    assert np.isfinite(bursts[0].snr_db)
+    assert detector.pending is None
+
+
+def tone(n, freq, sample_rate=2e6, amplitude=0.1):
+    return (amplitude * np.exp(2j * np.pi * freq * np.arange(n) / sample_rate)).astype(np.complex64)
+
+
+def chunked(stage, data, axis=-1, sizes=(1000, 4093, 777, 20000)):
+    """Feed data to stage in uneven frames and join the outputs along axis."""
+    out, start, i = [], 0, 0
+    while start < len(data):
+        size = sizes[i % len(sizes)]
+        out.append(stage.process(data[start:start + size]))
+        start += size
+        i += 1
+    return np.concatenate(out, axis=axis)
+
+
+def test_ddc_mixes_the_offset_to_dc():
+    x = tone(64000, 40000) + noise(64000, 0.001)
+    ddc = dsp.DDC(2e6, 40000, 8)
+    y = ddc.process(x)
+    assert len(y) == 8000 and ddc.output_rate == 250000
+    assert abs(np.abs(y[100:].mean()) - 0.1) < 0.002
+
+
+def test_ddc_frames_match_the_whole_stream():
+    x = tone(30000, 40000) + noise(30000)
+    whole = dsp.DDC(2e6, 40000, 8).process(x)
+    np.testing.assert_allclose(chunked(dsp.DDC(2e6, 40000, 8), x), whole, atol=1e-5)
+
+
+def test_ddc_converts_sc16():
+    x = tone(8000, 40000)
+    iq = np.empty(2 * len(x), dtype=np.int16)
+    iq[0::2], iq[1::2] = x.real * 32767, x.imag * 32767
+    y = dsp.DDC(2e6, 40000, 8).process(iq.view(protocol.SC16))
+    np.testing.assert_allclose(y, dsp.DDC(2e6, 40000, 8).process(x), atol=1e-4)
+
+
+def test_channelizer_puts_a_tone_in_its_channel():
+    channelizer = dsp.Channelizer(2e6, 8)
+    assert channelizer.channel_offset(1) == 250000 and channelizer.channel_offset(7) == -250000
+    out = channelizer.process(tone(64000, 250000) + tone(64000, -500000, amplitude=0.05))
+    assert out.shape == (8, 8000)
+    levels = np.abs(out[:, 100:]).mean(axis=1)
+    assert abs(levels[1] - 0.1) < 0.005 and abs(levels[6] - 0.05) < 0.005
+    assert np.delete(levels, [1, 6]).max() < 0.005
+
+
+def test_channelizer_frames_match_the_whole_stream():
+    x = tone(30000, 250000) + noise(30000)
+    whole = dsp.Channelizer(2e6, 8).process(x)
+    np.testing.assert_allclose(chunked(dsp.Channelizer(2e6, 8), x), whole, atol=1e-5)
+
+
+def test_welch_psd_peak_and_rows():
+    psd = dsp.WelchPSD(fft_size=256, overlap=0.5)
+    rows = psd.process(tone(10000, 2e6 / 256 * 10, amplitude=1.0))
+    assert rows.shape == (1, 256) and rows.dtype == np.float32
+    assert np.argmax(rows[0]) == 128 + 10
+    assert len(dsp.WelchPSD(fft_size=256).process(np.zeros(100, dtype=np.complex64))) == 0
+
+
+def test_welch_psd_averages_match_the_whole_stream():
+    x = tone(50000, 30000) + noise(50000)
+    whole = dsp.WelchPSD(fft_size=256, overlap=0.5, averages=10).process(x)
+    # 389 segments of 256 at a step of 128 make 38 rows of 10
+    assert whole.shape == (38, 256)
+    np.testing.assert_allclose(chunked(dsp.WelchPSD(fft_size=256, overlap=0.5, averages=10), x, axis=0), whole, atol=1e-3)
+
+
+def test_welch_psd_frames_shorter_than_the_fft():
+    x = noise(1000)
+    psd = dsp.WelchPSD(fft_size=256, overlap=0.5)
+    rows = [psd.process(frame) for frame in np.split(x, 10)]
+    assert [len(r) for r in rows] == [0, 0, 1, 1, 0, 1, 1, 1, 1, 0]
+    whole = dsp.WelchPSD(fft_size=256, overlap=0.5, averages=1).process(x)
+    np.testing.assert_allclose(np.concatenate(rows), whole, atol=1e-3)
+
+
+def test_welch_psd_rejects_unknown_window():
+    with pytest.raises(ValueError):
+        dsp.WelchPSD(window='kaiser')
+
+
+def test_burst_detector_finds_bursts_across_frames():
+    x = noise(100000)
+    x[10000:12000] += 0.3
+    # Straddles the frame boundaries at 20000 and 40000
+    x[19000:41000] += 0.3
+    detector = dsp.BurstDetector(window=64)
+    bursts = [burst for frame in np.split(x, 5) for burst in detector.process(frame)]
+    assert [(b.start, b.stop) for b in bursts] == [(10000, 12000), (19000, 41000)]
+    assert all(abs(b.snr_db - 10 * np.log10(0.09 / 1e-4)) < 1 for b in bursts)
+
+
+def test_burst_detector_merges_close_runs():
+    x = noise(20000)
+    x[5000:6000] += 0.3
+    x[6200:7000] += 0.3
+    apart = dsp.BurstDetector(window=64).process(x)
+    merged = dsp.BurstDetector(window=64, min_gap=300).process(x)
+    assert [(b.start, b.stop) for b in apart] == [(5000, 6000), (6200, 7000)]
+    assert [(b.start, b.stop) for b in merged] == [(5000, 7000)]
@@ -0,0 +1,20 @@
+import parallel
+
+
+def spectrum_rows(data, header):
+    return data.reshape(header.channels, header.count).shape
+
+
+def test_averaged_spectrum_frames_fit_the_slots(rx_node):
+    node, addr = rx_node()
+    # 64000 sample frames make 250 segments of 512 at 50% overlap, so up to 63 rows of 4
+    with parallel.ParallelPipeline(addr, spectrum_rows, workers=1, stream='spectrum', fft_size=512, averages=4) as pipeline:
+        assert pipeline.stream_info['max_rows'] == 63
+        shapes = []
+        for header, shape in pipeline.results():
+            shapes.append(shape)
+            if len(shapes) == 5:
+                break
+    node.stop()
+    assert all(rows >= 62 and bins == 512 for rows, bins in shapes)
+    assert pipeline.skipped.value == 0
@@ -0,0 +1,90 @@
+import asyncio
+import threading
+
+import pytest
+
+from pipeline import AsyncFrameQueue, FrameQueue
+
+
+@pytest.mark.parametrize('policy, kept, dropped', [
+    ('drop_oldest', [2, 3, 4], 2),
+    ('drop_newest', [0, 1, 2], 2),
+])
+def test_frame_queue_drop_policies(policy, kept, dropped):
+    queue = FrameQueue(3, policy)
+    results = [queue.put(frame) for frame in range(5)]
+    assert results == [True] * 3 + [policy == 'drop_oldest'] * 2
+    assert [queue.get(timeout=0) for _ in range(3)] == kept
+    assert (queue.dropped, queue.queued) == (dropped, 3 + (dropped if policy == 'drop_oldest' else 0))
+    assert queue.get(timeout=0) is None
+
+
+def test_frame_queue_block_waits_for_room_and_close():
+    queue = FrameQueue(1, 'block')
+    assert queue.put(0)
+    assert not queue.put(1, timeout=0.05)
+    getter = threading.Timer(0.05, queue.get)
+    getter.start()
+    assert queue.put(1, timeout=5)
+    getter.join()
+    # close() wakes a blocked producer, and what is queued can still be drained
+    threading.Timer(0.05, queue.close).start()
+    assert not queue.put(2)
+    assert queue.get() == 1 and queue.get() is None
+    assert queue.dropped == 0
+
+
+def test_frame_queue_notifies_on_put_and_close():
+    calls = []
+    queue = FrameQueue(1, 'drop_newest', notify=lambda: calls.append(len(queue)))
+    queue.put(0)
+    queue.put(1)
+    queue.close()
+    # A dropped frame wakes nobody
+    assert calls == [1, 1]
+
+
+def test_frame_queue_rejects_bad_settings():
+    with pytest.raises(ValueError):
+        FrameQueue(4, 'drop_random')
+    with pytest.raises(ValueError):
+        AsyncFrameQueue(0)
+
+
+@pytest.mark.parametrize('policy, kept', [('drop_oldest', [2, 3, 4]), ('drop_newest', [0, 1, 2])])
+def test_async_frame_queue_drop_policies(policy, kept):
+    async def run():
+        queue = AsyncFrameQueue(3, policy)
+        for frame in range(5):
+            await queue.put(frame)
+        queue.close()
+        out = []
+        while True:
+            frame = await queue.get()
+            if frame is None:
+                break
+            out.append(frame)
+        return out, queue.dropped
+    assert asyncio.run(run()) == (kept, 2)
+
+
+def test_async_frame_queue_block_waits_for_the_consumer():
+    async def run():
+        queue = AsyncFrameQueue(2, 'block')
+
+        async def produce():
+            for frame in range(10):
+                assert await queue.put(frame)
+                assert len(queue) <= 2
+            queue.close()
+
+        producer = asyncio.create_task(produce())
+        out = []
+        while True:
+            frame = await queue.get()
+            if frame is None:
+                break
+            out.append(frame)
+        await producer
+        return out, queue.dropped
+    assert asyncio.run(run()) == (list(range(10)), 0)
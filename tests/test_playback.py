@@ -0,0 +1,97 @@
+import concurrent.futures
+import time
+
+import numpy as np
+import pytest
+
+import client
+import playback
+import server
+from conftest import server_args
+
+
+def playback_args(path, *extra):
+    args = server_args('--rx_frame_samps', '1000', *extra)
+    args.playback_file = str(path)
+    args.playback_mode = 'fast'
+    args.playback_loop = False
+    return args
+
+
+def test_playback_frames_then_eof(tmp_path):
+    samples = (np.arange(2500) * (1 + 1j)).astype(np.complex64)
+    path = tmp_path / 'capture.cf32'
+    samples.tofile(path)
+    source = playback.Playback(playback_args(path))
+    frames = [source.read_frame() for _ in range(3)]
+    with pytest.raises(EOFError):
+        source.read_frame()
+    assert [frame.seq for frame in frames] == [0, 1, 2]
+    assert [len(frame.data) for frame in frames] == [1000, 1000, 500]
+    np.testing.assert_array_equal(np.concatenate([frame.data for frame in frames]), samples)
+    assert source.rx_frames.value == 3 and source.rx_samples.value == 2500
+    # The RX settings RX_Node reads come from the shared RX_Source setup
+    assert source.rx_device_channels == [0] and source.rx_cpu_format == 'fc32'
+    assert source.num_samps == 1000
+
+
+def test_playback_through_rx_node(tmp_path):
+    samples = (np.arange(100500) * (1 - 1j)).astype(np.complex64)
+    path = tmp_path / 'capture.cf32'
+    samples.tofile(path)
+    node = server.RX_Node(playback.Playback(playback_args(path)))
+    node.start()
+    try:
+        # Fast playback makes block the default policy, so nothing is lost
+        sock = client.StreamSocket(('localhost', node.receiver.rx_port), formats=['fc32'])
+        assert sock.stream_info['policy'] == 'block'
+        frames = []
+        while True:
+            data = sock.next()
+            if len(data) == 0:
+                break
+            frames.append(data.copy())
+        sock.close()
+    finally:
+        node.stop()
+        node.join()
+    assert [len(data) for data in frames] == [1000] * 100 + [500]
+    np.testing.assert_array_equal(np.concatenate(frames), samples)
+
+
+def test_slow_client_only_loses_its_own_frames(tmp_path):
+    # 100 frames of 10 ms, 16 MB, more than the socket buffers hold
+    samples = np.zeros(100 * 20000, dtype=np.complex64)
+    path = tmp_path / 'capture.cf32'
+    samples.tofile(path)
+    args = playback_args(path, '--rx_frame_samps', '20000')
+    args.playback_mode = 'realtime'
+    node = server.RX_Node(playback.Playback(args))
+    node.start()
+    addr = ('localhost', node.receiver.rx_port)
+
+    def read_all(sock, pause=0.0):
+        seqs = []
+        while len(sock.next()):
+            seqs.append(sock.header.seq)
+            time.sleep(pause)
+        sock.close()
+        return seqs
+
+    try:
+        # Playback starts with the slow client, so its queue gets every frame
+        slow = client.StreamSocket(addr, formats=['fc32'], policy='drop_oldest')
+        fast = client.StreamSocket(addr, formats=['fc32'], policy='drop_oldest', queue_frames=16)
+        queue = next(c.frames for c in node.clients if c.addr[1] == slow.getsockname()[1])
+        with concurrent.futures.ThreadPoolExecutor(1) as executor:
+            slow_seqs = executor.submit(read_all, slow, 0.05)
+            fast_seqs = read_all(fast)
+            slow_seqs = slow_seqs.result()
+    finally:
+        node.stop()
+        node.join()
+    # The fast client saw every frame from the one it joined at, up to the end of the file
+    assert fast_seqs == list(range(fast_seqs[0], 100)) and fast.skipped == 0
+    # The slow one missed exactly the frames its queue dropped
+    assert slow_seqs[0] == 0 and slow_seqs[-1] == 99
+    assert queue.dropped > 10 and slow.skipped == queue.dropped == 100 - len(slow_seqs)
@@ -0,0 +1,230 @@
+import asyncio
+import socket
+
+import numpy as np
+import pytest
+from numpysocket import NumpySocket
+
+import client
+import protocol
+
+
+def sc16(n, seed=0):
+    return np.random.default_rng(seed).integers(-2000, 2000, 2 * n, dtype=np.int16).view(protocol.SC16)
+
+
+@pytest.mark.parametrize('data', [
+    np.arange(1000, dtype=np.complex64) * (1 - 1j),
+    sc16(1000),
+    np.arange(2 * 300, dtype=np.float32).reshape(2, 300),
+    np.zeros((2, 0), dtype=np.complex64),
+], ids=['fc32', 'sc16', 'rows', 'empty'])
+def test_frames_round_trip(data):
+    a, b = socket.socketpair()
+    with a, b:
+        protocol.send_frame(a, data, 7, timestamp=1.5, capture_time=2.5)
+        reader = protocol.FrameReader(b)
+        header = reader.read_header()
+        out = reader.read_payload(header)
+    assert (header.seq, header.timestamp, header.capture_time) == (7, 1.5, 2.5)
+    assert header.dtype == data.dtype
+    assert out.shape == data.shape
+    np.testing.assert_array_equal(out, data)
+
+
+def test_frame_reader_into_a_buffer_and_end_of_stream():
+    data = np.arange(100, dtype=np.complex64)
+    a, b = socket.socketpair()
+    with b:
+        protocol.send_frame(a, data, 0)
+        a.close()
+        reader = protocol.FrameReader(b)
+        buffer = np.zeros(data.nbytes + 64, dtype=np.uint8)
+        out = reader.read_payload(reader.read_header(), buffer)
+        assert np.shares_memory(out, buffer)
+        np.testing.assert_array_equal(out, data)
+        assert reader.read_header() is None
+
+
+def test_bad_frame_header():
+    a, b = socket.socketpair()
+    with a, b:
+        a.sendall(b'\0' * protocol.FRAME_HEADER.size)
+        with pytest.raises(ValueError):
+            protocol.FrameReader(b).read_header()
+
+
+def test_sc16_to_fc32_scales_to_full_scale():
+    data = np.array([[32767, -32768], [0, 16384]], dtype=np.int16).reshape(-1).view(protocol.SC16)
+    out = protocol.sc16_to_fc32(data)
+    assert out.dtype == np.complex64
+    np.testing.assert_allclose(out, [32767 / 32768 - 1j, 0.5j])
+
+
+def test_handshake_messages():
+    a, b = socket.socketpair()
+    with a, b:
+        protocol.send_message(b, {'format': 'fc32'})
+        assert protocol.request_stream(a, stream='iq') == {'format': 'fc32'}
+
+        async def hello():
+            reader, writer = await asyncio.open_connection(sock=b)
+            message = await protocol.read_hello(reader)
+            writer.transport.pause_reading()
+            return message
+        assert asyncio.run(hello()) == {'stream': 'iq'}
+
+
+def test_request_stream_from_a_server_without_handshake():
+    a, b = socket.socketpair()
+    with a, b:
+        b.sendall(b'12:not a hello')
+        assert protocol.request_stream(a, stream='iq') is None
+
+
+def receive(sock, frames=3):
+    out = []
+    for _ in range(frames):
+        data = sock.next()
+        assert len(data)
+        out.append(data.copy())
+    sock.close()
+    return out
+
+
+def tone_level(data):
+    return np.abs(data).mean()
+
+
+@pytest.mark.parametrize('options, formats, dtype', [
+    ((), ('sc16', 'fc32'), np.complex64),
+    (('--rx_cpu_format', 'sc16'), ('sc16', 'fc32'), protocol.SC16),
+    (('--rx_cpu_format', 'sc16'), ('fc32',), np.complex64),
+])
+def test_iq_stream(rx_node, options, formats, dtype):
+    node, addr = rx_node('--rx_frame_samps', '10000', *options)
+    sock = client.StreamSocket(addr, formats=formats)
+    info = sock.stream_info
+    assert info['protocol'] == 'frame'
+    assert protocol.FORMATS[info['format']] == dtype
+    assert info['frame_size'] == 10000 and info['sample_rate'] == 2e6
+    for data in receive(sock):
+        assert data.shape == (10000,) and data.dtype == np.complex64
+        assert tone_level(data) > 0.05
+
+
+def test_npy_stream(rx_node):
+    node, addr = rx_node('--rx_frame_samps', '10000')
+    sock = client.StreamSocket(addr, protocols=['npy'])
+    assert sock.stream_info['protocol'] == 'npy'
+    for data in receive(sock):
+        assert data.shape == (10000,)
+        assert tone_level(data) > 0.05
+
+
+def test_legacy_client_without_hello(rx_node):
+    node, addr = rx_node('--rx_frame_samps', '10000')
+    sock = NumpySocket()
+    sock.connect(addr)
+    with sock:
+        data = sock.recv()
+    assert data.dtype == np.complex64 and data.shape == (10000,)
+
+
+def test_ddc_stream(rx_node):
+    node, addr = rx_node('--rx_decimation', '8')
+    sock = client.StreamSocket(addr, stream='ddc')
+    info = sock.stream_info
+    assert info['stream'] == 'ddc' and info['sample_rate'] == 2e6 / 8
+    assert info['center_freq'] == 434e6 + 25000
+    frames = receive(sock)
+    # The tone sits on rx_channel_freq, so after the DDC it is DC
+    last = frames[-1]
+    assert abs(len(last) - info['frame_size']) <= 1
+    assert abs(np.abs(last.mean()) - 0.1) < 0.01
+
+
+def test_channel_stream(rx_node):
+    node, addr = rx_node('--rx_channels', '8', '--device_args', 'realtime=0,tone=250000:0.1')
+    sock = client.StreamSocket(addr, stream='channel', channel=1)
+    info = sock.stream_info
+    assert info['channel'] == 1 and info['sample_rate'] == 2e6 / 8
+    assert info['center_freq'] == 434e6 + 250000
+    level = tone_level(receive(sock)[-1])
+    other = client.StreamSocket(addr, stream='channel', channel=3)
+    assert level > 0.05 and tone_level(receive(other)[-1]) < 0.01
+
+
+def test_spectrum_stream(rx_node):
+    node, addr = rx_node()
+    sock = client.StreamSocket(addr, stream='spectrum', fft_size=256, overlap=0.25, window='blackman')
+    info = sock.stream_info
+    assert info['stream'] == 'spectrum'
+    assert (info['fft_size'], info['overlap'], info['window']) == (256, 0.25, 'blackman')
+    assert info['bin_width'] == 2e6 / 256 and info['max_rows'] == 1
+    rows = np.atleast_2d(receive(sock)[-1])
+    assert rows.dtype == np.float32 and rows.shape == (1, 256)
+    # 25 kHz is bin 3.2 above the center
+    assert np.argmax(rows[0]) - 128 == 3
+
+
+@pytest.mark.parametrize('settings', [{'overlap': 1.5}, {'fft_size': 10**12}, {'averages': 10**12}])
+def test_bad_spectrum_settings_are_refused(rx_node, settings):
+    node, addr = rx_node()
+    sock = client.StreamSocket(addr, stream='spectrum', **settings)
+    # The server hangs up instead of answering, so the stream ends before the first frame
+    assert len(sock.next()) == 0
+    sock.close()
+    # Other clients are still served
+    assert len(receive(client.StreamSocket(addr))) == 3
+
+
+class BrokenProcessor():
+    def process(self, data):
+        raise MemoryError
+
+
+def test_failing_stream_only_disconnects_its_clients(rx_node):
+    node, addr = rx_node()
+    spectrum = client.StreamSocket(addr, stream='spectrum')
+    iq = client.StreamSocket(addr, policy='block')
+    assert len(spectrum.next())
+    product, = node.processors
+    node.processors[product] = BrokenProcessor()
+    while len(spectrum.next()):
+        pass
+    spectrum.close()
+    assert len(receive(iq, 10)) == 10
+
+
+def test_device_channels_stream(rx_node):
+    node, addr = rx_node('--rx_device_channels', '0', '1', '--rx_center_freqs', '434e6', '868e6')
+    both = client.StreamSocket(addr, device_channels=[1, 0])
+    assert both.stream_info['device_channels'] == [1, 0]
+    assert both.stream_info['center_freqs'] == [868e6, 434e6]
+    data = receive(both)[-1]
+    assert data.shape == (2, both.frame_size)
+    assert tone_level(data[0]) > 0.05 and tone_level(data[1]) > 0.05
+
+    second = client.StreamSocket(addr, device_channels=[1])
+    assert second.stream_info['center_freq'] == 868e6
+    assert receive(second)[-1].ndim == 1
+
+
+def test_client_that_stops_reading_is_cut_off_before_the_ring_wraps(rx_node):
+    node, addr = rx_node('--rx_frame_samps', '100000', '--rx_ring_frames', '12', '--device_args', 'realtime=0,tone=30007:0.1')
+    stalled = socket.socket()
+    stalled.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+    stalled.connect(addr)
+    with stalled:
+        protocol.request_stream(stalled, stream='iq', formats=['fc32'], protocols=['frame'], policy='drop_oldest')
+        # A lossless client sets the pace, so the stalled one falls a whole ring behind
+        sock = client.StreamSocket(addr, formats=['fc32'], policy='block')
+        frames = [sock.next().copy() for _ in range(40)]
+        # The node hung up on the stalled client and kept serving the other one
+        assert len(node.clients) == 1 and sock.skipped == 0
+        sock.close()
+    # Every frame the node did send is one piece of the tone, not parts of two ring slots
+    for data in frames:
+        steps = np.angle(data[1:] * data[:-1].conj())
+        assert np.abs(steps - np.median(steps)).max() < 0.2
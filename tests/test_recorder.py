@@ -0,0 +1,152 @@
+import json
+import os
+import threading
+import time
+
+import numpy as np
+from loguru import logger
+
+import protocol
+import recorder
+
+
+def record(rec, node, until, timeout=10):
+    """Run rec.loop() until until(rec) holds, then stop the node so the loop ends."""
+    thread = threading.Thread(target=rec.loop)
+    thread.start()
+    deadline = time.monotonic() + timeout
+    while not until(rec) and time.monotonic() < deadline:
+        time.sleep(0.01)
+    node.stop()
+    thread.join(timeout)
+    assert not thread.is_alive()
+
+
+def test_sigmf_stream_records_segments(rx_node, tmp_path):
+    # The unpaced sim outruns the recorder, so it sets the pace instead of losing frames
+    node, addr = rx_node('--rx_cpu_format', 'sc16', '--rx_overflow_policy', 'block')
+    rec = recorder.SigMFRecorder(addr, str(tmp_path), segment_mb=1)
+    record(rec, node, lambda r: r.recorded >= 20 * 64000)
+
+    assert rec.recorded >= 20 * 64000
+    # sc16 frames of 64000 samples are 256000 bytes, four to a 1 MiB segment
+    assert rec.segment_index >= 4
+    segments = []
+    for index in range(rec.segment_index + 1):
+        base = os.path.join(str(tmp_path), f"capture-{index:04d}")
+        with open(base + '.sigmf-meta') as f:
+            meta = json.load(f)
+        assert meta['global']['core:datatype'] == 'ci16_le'
+        assert meta['captures'][0]['core:sample_start'] == 0
+        segments.append(np.fromfile(base + '.sigmf-data', dtype=protocol.SC16))
+    assert sum(len(data) for data in segments) == rec.recorded
+    # The sim tone is 0.1 full scale, so the samples are real ones and not the sparse file's zeros.
+    # The last segment may be empty, if the node stopped in the middle of its first frame
+    samples = protocol.sc16_to_fc32(segments[0])
+    assert np.abs(samples).mean() > 0.05
+
+
+def test_sigmf_frames_stay_valid_after_rotation(rx_node, tmp_path):
+    # The unpaced sim outruns the recorder, so it sets the pace instead of losing frames
+    node, addr = rx_node('--rx_cpu_format', 'sc16', '--rx_overflow_policy', 'block')
+    rec = recorder.SigMFRecorder(addr, str(tmp_path), segment_mb=1)
+    kept, copies = [], []
+    for data in rec.frames():
+        kept.append(data)
+        copies.append(data.copy())
+        if len(kept) == 20:
+            break
+    # Four frames to a segment, so the first ones were received into closed segments
+    assert rec.segment_index >= 4
+    node.stop()
+    for data, copy in zip(kept, copies):
+        np.testing.assert_array_equal(data, copy)
+
+
+def burst_frames(rng, bursts, frames=4, frame_samps=20000):
+    """Noise frames with 0.5 amplitude bursts at the given (start, stop) sample ranges."""
+    x = ((rng.standard_normal(frames * frame_samps) + 1j * rng.standard_normal(frames * frame_samps)) * 0.001).astype(np.complex64)
+    for start, stop in bursts:
+        x[start:stop] += 0.5
+    return np.split(x, frames)
+
+
+def run_bursts(rec, frames):
+    warnings = []
+    sink = logger.add(lambda message: warnings.append(message), level='WARNING')
+    try:
+        for data in frames:
+            rec.loop_func(data)
+        rec.loop_exit()
+    finally:
+        logger.remove(sink)
+    with open(os.path.join(os.path.dirname(rec.data_path), 'index.jsonl')) as f:
+        return [json.loads(line) for line in f], warnings
+
+
+def test_burst_at_stream_start_keeps_quiet(rx_node, tmp_path):
+    node, addr = rx_node()
+    rec = recorder.BurstRecorder(addr, str(tmp_path), pre=0.01, post=0.001)
+    node.stop()
+    rng = np.random.default_rng(1)
+    # The first burst starts before a whole pre trigger (20000 samples) has arrived
+    records, warnings = run_bursts(rec, burst_frames(rng, [(3000, 5000), (50000, 52000)]))
+    assert warnings == []
+    assert [r['burst_samples'] for r in records] == [2000, 2000]
+    assert records[0]['trigger'] == 3000 and records[1]['trigger'] == 20000
+    data = np.fromfile(rec.data_path, dtype=np.complex64)
+    assert len(data) == sum(r['samples'] for r in records)
+    first = data[records[0]['trigger']:records[0]['trigger'] + 2000]
+    assert np.abs(first).min() > 0.4
+
+
+def test_burst_longer_than_history_warns(rx_node, tmp_path):
+    node, addr = rx_node()
+    rec = recorder.BurstRecorder(addr, str(tmp_path), pre=0.001, post=0.001, history=0.01)
+    node.stop()
+    rng = np.random.default_rng(2)
+    records, warnings = run_bursts(rec, burst_frames(rng, [(30000, 70000)]))
+    assert len(records) == 1 and len(warnings) == 1
+    assert 'outgrew the history' in warnings[0]
+
+
+def test_sample_history_wraps():
+    history = recorder.SampleHistory(10)
+    history.append(np.arange(7, dtype=np.complex64))
+    history.append(np.arange(7, 13, dtype=np.complex64))
+    assert (history.start(), history.end) == (3, 13)
+    assert np.concatenate(history.read(0, 20)).real.tolist() == list(range(3, 13))
+    assert len(history.read(5, 12)) == 2
+    history.append(np.arange(13, 40, dtype=np.complex64))
+    assert np.concatenate(history.read(0, 40)).real.tolist() == list(range(30, 40))
+
+
+def test_burst_recorder_records_sim_bursts(rx_node, tmp_path):
+    # A 2000 sample burst every 20000 samples
+    node, addr = rx_node('--rx_frame_samps', '10000', '--device_args', 'realtime=1,noise=0.001,burst=0.01:0.001:0.3:0')
+    rec = recorder.BurstRecorder(addr, str(tmp_path), pre=0.0005, post=0.0005, history=0.1)
+    record(rec, node, lambda r: r.recorded >= 5)
+
+    assert rec.recorded >= 5
+    with open(tmp_path / 'index.jsonl') as f:
+        records = [json.loads(line) for line in f]
+    assert len(records) == rec.recorded
+    data = np.fromfile(rec.data_path, dtype=np.complex64)
+    assert len(data) == sum(r['samples'] for r in records)
+    for r in records[1:-1]:
+        assert abs(r['burst_samples'] - 2000) <= 2 and r['trigger'] == 1000
+        assert abs(r['snr_db'] - 10 * np.log10(0.09 / 1e-6)) < 1
+        burst = data[r['offset'] + r['trigger']:r['offset'] + r['trigger'] + r['burst_samples']]
+        assert np.abs(burst).min() > 0.25
+    assert all(b['device_time'] - a['device_time'] > 0 for a, b in zip(records, records[1:]))
+
+
+def test_sigmf_segments_rotate_by_time(rx_node, tmp_path):
+    node, addr = rx_node('--rx_frame_samps', '20000', '--device_args', 'realtime=1,tone=25000:0.1')
+    rec = recorder.SigMFRecorder(addr, str(tmp_path), segment_seconds=0.05)
+    record(rec, node, lambda r: r.segment_index >= 2)
+    assert rec.segment_index >= 2
+    with open(tmp_path / 'capture-0001.sigmf-meta') as f:
+        meta = json.load(f)
+    assert meta['global']['core:sample_rate'] == 2e6
+    assert meta['captures'][0]['core:frequency'] == 434e6
@@ -0,0 +1,137 @@
+import numpy as np
+
+import server
+from conftest import server_args
+from pipeline import FrameQueue
+
+
+def test_chunked_multichannel_read_fills_every_row():
+    transceiver = server.Transceiver(server_args('--rx_device_channels', '0', '1', '--rx_frame_samps', '10000',
+                                                 '--rx_chunk_samps', '1000'))
+    transceiver.start_streaming()
+    try:
+        data = transceiver.read()
+    finally:
+        transceiver.stop_streaming()
+    assert data.shape == (2, 10000)
+    # The sim tone is 0.1 full scale on both channels, in the last chunk as much as the first
+    assert np.abs(data[:, :1000]).mean(axis=1).min() > 0.05
+    assert np.abs(data[:, -1000:]).mean(axis=1).min() > 0.05
+
+
+def test_chunked_multichannel_capture_at():
+    transceiver = server.Transceiver(server_args('--rx_device_channels', '0', '1', '--rx_chunk_samps', '1000'))
+    frame = transceiver.capture_at(transceiver.time_now(), 5000)
+    assert frame.data.shape == (2, 5000)
+    assert np.abs(frame.data[:, -1000:]).mean(axis=1).min() > 0.05
+
+
+def test_delayed_start_publishes_a_filled_first_frame():
+    transceiver = server.Transceiver(server_args('--device_args', 'realtime=1,tone=25000:0.1', '--rx_start_delay', '0.3',
+                                                 '--rx_frame_samps', '20000'))
+    transceiver.start_streaming()
+    try:
+        frame = transceiver.read_frame()
+    finally:
+        transceiver.stop_streaming()
+    assert frame is not None and frame.seq == 0
+    assert frame.timestamp > 0
+    assert np.abs(frame.data).mean() > 0.05
+
+
+def test_read_without_stream_publishes_nothing():
+    transceiver = server.Transceiver(server_args())
+    assert transceiver.read_frame() is None
+    assert transceiver.frame_seq == -1
+
+
+def test_timed_capture_just_ahead_of_start():
+    transceiver = server.Transceiver(server_args('--device_args', 'realtime=1,tone=25000:0.1'))
+    frame = transceiver.capture_at(transceiver.time_now() + 0.02, 2000)
+    assert frame is not None
+
+
+def test_replay_sends_a_writeable_copy_of_cached_waveforms():
+    transceiver = server.Transceiver(server_args())
+    tone = transceiver.tone()
+    assert not tone.flags.writeable
+    replay = transceiver.send_loop(tone, repeats=3)
+    replay.join(5)
+    assert replay.sent == 3
+    assert replay.data.flags.writeable and replay.data.flags.c_contiguous
+    assert transceiver.tone() is tone
+
+
+class FailingSource():
+    def __init__(self):
+        self.streaming = False
+
+    def start_streaming(self):
+        self.streaming = True
+
+    def stop_streaming(self):
+        self.streaming = False
+
+    def read_frame(self):
+        raise RuntimeError("device went away")
+
+
+def test_capture_closes_the_queue_when_the_source_fails():
+    source = FailingSource()
+    frames = FrameQueue(4, 'block')
+    capture = server.RX_Capture(source, frames)
+    capture.start()
+    capture.join(5)
+    assert not capture.is_alive()
+    assert frames.closed and not source.streaming
+
+
+def paced_transceiver():
+    return server.Transceiver(server_args('--device_args', 'realtime=1,tone=25000:0.1'))
+
+
+def test_scheduled_captures_start_at_their_times():
+    transceiver = paced_transceiver()
+    scheduler = transceiver.start_scheduler()
+    try:
+        now = transceiver.time_now()
+        # Added out of order, run in start time order. Far enough apart for the sim, which
+        # builds its signal tables on every stream command
+        times = {scheduler.capture_at(now + offset, 2000): now + offset for offset in (0.9, 0.3, 0.6)}
+        frames = [scheduler.captures.get(timeout=2) for _ in times]
+    finally:
+        transceiver.stop_scheduler()
+    assert all(frame is not None for frame in frames)
+    assert [frame.timestamp for frame in frames] == sorted(times.values())
+    assert all(frame.timestamp == times[frame.seq] for frame in frames)
+    assert all(frame.data.shape == (2000,) for frame in frames)
+    assert (scheduler.rx.executed, scheduler.rx.missed, scheduler.failed) == (3, 0, 0)
+
+
+def test_late_scheduled_capture_is_counted_as_missed():
+    transceiver = paced_transceiver()
+    scheduler = transceiver.start_scheduler()
+    try:
+        scheduler.capture_at(transceiver.time_now() - 0.1, 2000)
+        # The device rejects it, the capture yields no frame
+        assert scheduler.captures.get(timeout=1) is None
+    finally:
+        transceiver.stop_scheduler()
+    assert (scheduler.rx.executed, scheduler.rx.missed, scheduler.failed) == (1, 1, 1)
+
+
+def test_scheduled_burst_plays_at_its_time():
+    transceiver = paced_transceiver()
+    scheduler = transceiver.start_scheduler()
+    data = np.asarray(transceiver.tone()[:20000]).copy()
+    try:
+        when = transceiver.time_now() + 0.1
+        scheduler.send_at(when, data)
+        events = transceiver.uhd.types.TXAsyncMetadata()
+        assert transceiver.tx_streamer.recv_async_msg(events, 2)
+    finally:
+        transceiver.stop_scheduler()
+    # The burst is acknowledged where it ends, so it started on time
+    assert events.event_code == transceiver.uhd.types.TXMetadataEventCode.burst_ack
+    assert abs(events.time_spec.get_real_secs() - (when + len(data) / 2e6)) < 1e-9
+    assert (scheduler.tx.executed, scheduler.tx.missed) == (1, 0)
@@ -0,0 +1,73 @@
+import time
+
+import numpy as np
+
+import client
+import sim_uhd
+
+# Frames of 10 ms at the sim's 2 Msps
+FRAME = (0.1 * np.exp(2j * np.pi * np.arange(20000) / 80)).astype(np.complex64)
+PACED = ('--device_args', 'realtime=1')
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_burst_starts_once_prefilled(tx_node):
+    node, addr = tx_node(*PACED, '--tx_prefill_frames', '4')
+    sock = client.Transmitter(addr)
+    assert sock.stream_info['prefill_frames'] == 4
+    for _ in range(3):
+        sock.transmit(FRAME)
+    assert wait_for(lambda: node.frames_received == 3)
+    time.sleep(0.1)
+    assert node.bursts == 0 and node.samples_sent == 0
+    sock.transmit(FRAME)
+    assert wait_for(lambda: node.samples_sent >= 4 * len(FRAME))
+    assert node.bursts == 1
+    sock.close()
+
+
+def test_dry_buffer_ends_the_burst(tx_node):
+    node, addr = tx_node(*PACED)
+    sock = client.Transmitter(addr)
+    for _ in range(20):
+        sock.transmit(FRAME)
+    # The 200 ms queued play out and the feeder waits a frame for more before it gives up
+    assert wait_for(lambda: node.starved == 1)
+    for _ in range(20):
+        sock.transmit(FRAME)
+    sock.close()
+    assert wait_for(lambda: node.connection is None and node.burst_acks == 2)
+    stats = node.stats()
+    assert stats['frames_received'] == 40 and stats['samples_sent'] == 40 * len(FRAME)
+    assert (stats['bursts'], stats['starved'], stats['underflows']) == (2, 1, 0)
+
+
+def test_device_events_are_counted(tx_node):
+    node, addr = tx_node()
+    streamer = node.transmitter.tx_streamer
+    codes = sim_uhd.TXMetadataEventCode
+    for code in (codes.underflow, codes.underflow_in_packet, codes.seq_error, codes.time_error, codes.burst_ack):
+        streamer.post_event(code, 1.0)
+    assert wait_for(lambda: node.burst_acks == 1)
+    assert (node.underflows, node.seq_errors, node.time_errors) == (2, 1, 1)
+
+
+def test_stop_ends_a_session_in_progress(tx_node):
+    node, addr = tx_node(*PACED, '--tx_queue_frames', '4', '--tx_prefill_frames', '2')
+    sock = client.Transmitter(addr)
+    for _ in range(4):
+        sock.transmit(FRAME)
+    assert wait_for(lambda: node.bursts == 1)
+    node.stop()
+    node.join(5)
+    assert not node.is_alive()
+    # The node hung up on the client
+    sock.settimeout(5)
+    assert len(sock.recv()) == 0
+    sock.close()
@@ -0,0 +1,104 @@
+"""
+Precomputed TX waveforms. Generated buffers are cached by their parameters, so a
+beacon or test tone is built once and every later transmission reuses it.
+
+Cached buffers are loop ready: tones hold a whole number of cycles, so sending the
+same buffer back to back is phase continuous.
+"""
+from collections import OrderedDict
+from fractions import Fraction
+
+import numpy as np
+
+
+# Loop buffers are tiled up to at least this many samples so each send call carries
+# enough samples to keep the radio busy
+MIN_LOOP_SAMPS = 1 << 15
+# Longest tone period searched for an exact whole number of cycles
+MAX_PERIOD_SAMPS = 1 << 20
+
+
+def readonly(array):
+    array.flags.writeable = False
+    return array
+
+
+def tile(period, min_samps=MIN_LOOP_SAMPS):
+    """Repeat period until it holds at least min_samps samples."""
+    return np.tile(period, -(-min_samps // len(period)))
+
+
+def tone(sample_rate, offset, amplitude=0.5, min_samps=MIN_LOOP_SAMPS):
+    """
+    Complex tone at offset Hz from the center frequency. The buffer is a whole number
+    of periods when the offset is a rational fraction of the rate with a short enough
+    period, otherwise the frequency is nudged by under one cycle per buffer so it loops.
+    """
+    ratio = Fraction(offset / sample_rate).limit_denominator(MAX_PERIOD_SAMPS)
+    num_samps = ratio.denominator
+    cycles = ratio.numerator
+    if abs(ratio - offset / sample_rate) > 1e-12:
+        num_samps = min_samps
+        cycles = round(offset / sample_rate * num_samps)
+    n = np.arange(num_samps)
+    period = (amplitude * np.exp(2j * np.pi * cycles * n / num_samps)).astype(np.complex64)
+    return tile(period, min_samps)
+
+
+def fsk(sample_rate, offset, deviation, symbol_rate, bits, amplitude=0.5, gap=0.0):
+    """
+    Phase continuous binary FSK of the bit pattern at offset Hz, followed by gap seconds
+    of silence. Patterns whose phase doesn't close have a phase step where the buffer
+    repeats, so loop those with a gap.
+    """
+    samples_per_symbol = int(round(sample_rate / symbol_rate))
+    symbols = np.repeat(np.where(np.asarray(bits) > 0, 1.0, -1.0), samples_per_symbol)
+    step = 2 * np.pi * (offset + deviation * symbols) / sample_rate
+    phase = np.cumsum(step) - step[0]
+    burst = (amplitude * np.exp(1j * phase)).astype(np.complex64)
+    return np.concatenate((burst, np.zeros(int(gap * sample_rate), dtype=np.complex64)))
+
+
+class WaveformCache():
+    """
+    LRU cache of generated waveforms, capped at max_bytes in total. Entries are
+    shared, so they are read-only. tx_streamer copies read-only buffers on every send,
+    so a caller that sends one over and over makes its own writeable copy first.
+    """
+    GENERATORS = {'tone': tone, 'fsk': fsk}
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, kind, **params):
+        """Return the cached waveform of kind ('tone' or 'fsk') with params, generating it on a miss."""
+        key = (kind,) + tuple(sorted((name, tuple(value) if isinstance(value, (list, np.ndarray)) else value)
+                                     for name, value in params.items()))
+        if key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        self.misses += 1
+        waveform = readonly(self.GENERATORS[kind](**params))
+        if waveform.nbytes > self.max_bytes:
+            # Too big to keep, but still usable once
+            return waveform
+        self.entries[key] = waveform
+        self.nbytes += waveform.nbytes
+        while self.nbytes > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.nbytes -= evicted.nbytes
+            self.evictions += 1
+        return waveform
+
+    def clear(self):
+        self.entries.clear()
+        self.nbytes = 0